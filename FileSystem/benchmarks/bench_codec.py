@@ -0,0 +1,71 @@
+'''
+Codec microbenchmark.
+
+Encodes and decodes FS replies of different sizes with the binary
+codec and with dill, and a file chunk to show the zero copy path.
+
+Run from the FileSystem folder:
+    python benchmarks/bench_codec.py
+    python benchmarks/bench_codec.py --sizes 1000 100000
+'''
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import codec
+from protocol import *
+
+def namespace(size, servers=5):
+    '''
+    Description: FS with size files, some with a few versions
+    '''
+    nodes = ['10.0.0.{}/30000'.format(i) for i in range(servers)]
+    files = {'files': [{'Type': 'Root'}]}
+    for i in range(size):
+        name = 'file{}.txt'.format(i)
+        versions = []
+        for v in range(1 + i % 3):
+            versions.append({'Type': 'F', 'Parent': 'files', 'Node': nodes[i % servers],
+                             'Path': 'files/{}{}'.format(v if v else '', name), 'Version': v,
+                             'Size': 1024 * (i % 64), 'Also': [nodes[(i + 1) % servers]]})
+        files[name] = versions
+    return files
+
+def timed(fn, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        took = time.perf_counter() - start
+        best = took if best == None else min(best, took)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description='Codec microbenchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print('{:>10} {:>7} {:>12} {:>12} {:>12}'.format('entries', 'codec', 'encode ms', 'decode ms', 'bytes'))
+    for size in args.sizes:
+        command = CommandObject(FS, namespace(size), id=1, reply=True)
+        repeat = args.repeat if size < 1000000 else 1
+        for name in ['binary', 'dill']:
+            took, parts = timed(lambda: codec.encode(command, name), repeat)
+            frame = b''.join(parts)
+            decodeTook, _ = timed(lambda: codec.decode(frame, CommandObject), repeat)
+            print('{:>10} {:>7} {:>12.1f} {:>12.1f} {:>12}'.format(size, name, took * 1000,
+                                                                decodeTook * 1000, len(frame)))
+
+    #a file chunk is passed on without being copied
+    chunk = CommandObject(FILECHUNK, {'Xfer': 1, 'Data': os.urandom(CHUNK_SIZE)})
+    took, parts = timed(lambda: codec.encode(chunk), 1000)
+    frame = b''.join(parts)
+    decodeTook, _ = timed(lambda: codec.decode(frame, CommandObject), 1000)
+    print('{:>10} {:>7} {:>12.4f} {:>12.4f} {:>12}'.format('chunk', 'binary', took * 1000,
+                                                        decodeTook * 1000, len(frame)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+'''
+Digest anti-entropy benchmark.
+
+Two servers share a namespace, one of them missed a few changes. Shows
+the bytes sent when they compare digests and exchange the buckets that
+differ, next to sending the whole FS.
+
+Run from the FileSystem folder:
+    python benchmarks/bench_digest.py
+    python benchmarks/bench_digest.py --sizes 1000000 --changes 10
+'''
+import os
+import sys
+import time
+import argparse
+import copy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import codec
+from digest import Digest
+from protocol import *
+
+def namespace(size, servers=5):
+    '''
+    Description: FS with size files
+    '''
+    nodes = ['10.0.0.{}/30000'.format(i) for i in range(servers)]
+    files = {'files': [{'Type': 'Root'}]}
+    for i in range(size):
+        name = 'file{}.txt'.format(i)
+        files[name] = [{'Type': 'F', 'Parent': 'files', 'Node': nodes[i % servers],
+                        'Path': 'files/{}'.format(name), 'Version': 0,
+                        'Size': 1024 * (i % 64), 'Also': [nodes[(i + 1) % servers]]}]
+    return files
+
+def build(files, buckets):
+    digest = Digest(buckets)
+    for name, versions in files.items():
+        digest.toggle(name, versions, 1)
+    return digest
+
+def frameSize(command):
+    return sum(len(part) for part in codec.encode(command))
+
+def main():
+    parser = argparse.ArgumentParser(description='Digest anti-entropy benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--changes', type=int, default=10)
+    parser.add_argument('--buckets', type=int, default=65536)
+    args = parser.parse_args()
+
+    print('{:>10} {:>8} {:>12} {:>12} {:>12} {:>12}'.format('entries', 'changes', 'digest B', 'names B',
+                                                          'full FS B', 'build s'))
+    for size in args.sizes:
+        local = namespace(size)
+        remote = copy.deepcopy(local)
+        #changes the local server missed
+        for i in range(args.changes):
+            remote['new{}.txt'.format(i)] = [{'Type': 'F', 'Parent': 'files', 'Node': '10.0.0.0/30000',
+                                              'Path': 'files/new{}.txt'.format(i), 'Version': 0,
+                                              'Also': []}]
+        start = time.perf_counter()
+        localDigest = build(local, args.buckets)
+        took = time.perf_counter() - start
+        remoteDigest = build(remote, args.buckets)
+
+        #the local server sends its summary, gets the buckets of the
+        #groups that differ, asks for the buckets that differ
+        summary = localDigest.summary()
+        groups = remoteDigest.differingGroups(summary)
+        leaves = remoteDigest.leavesOf(groups)
+        buckets = localDigest.differingBuckets(leaves)
+        names = remoteDigest.namesIn(buckets)
+        frames = [CommandObject(DIGEST, summary),
+                  CommandObject(DIGEST, {'Leaves': leaves}, id=1, reply=True),
+                  CommandObject(DIGEST, {'Want': buckets}),
+                  CommandObject(FS, {name: remote[name] for name in names}, id=1, reply=True)]
+        full = CommandObject(FS, remote, id=1, reply=True)
+        print('{:>10} {:>8} {:>12} {:>12} {:>12} {:>12.1f}'.format(size, args.changes,
+                                                                 sum(frameSize(f) for f in frames[:3]),
+                                                                 frameSize(frames[3]), frameSize(full), took))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Placement simulation benchmark.
+
+Places synthetic names with the hash ring for a few vnode counts and
+shows how even the primaries are, the share of names whose primary
+or copies move when a server joins or leaves, and the lookup rate.
+Hashing names modulo the number of servers is shown for comparison.
+
+Run from the FileSystem folder:
+    python benchmarks/bench_placement.py
+    python benchmarks/bench_placement.py --names 100000 --servers 20 --vnodes 16 64
+'''
+import os
+import sys
+import time
+import argparse
+import statistics
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings as s
+import placement
+
+def servers(count, weights={}):
+    return {'10.0.0.{}/30000'.format(i): {'weight': weights.get(i, 1)} for i in range(count)}
+
+def place(ring, names, copies):
+    '''
+    Description: Primary and copies of every name
+    '''
+    return [ring.preferred(name, copies) for name in names]
+
+def balance(placed, nodes):
+    counts = {node: 0 for node in nodes}
+    for nodes in placed:
+        counts[nodes[0]] += 1
+    mean = statistics.mean(counts.values())
+    return max(counts.values()) / mean, statistics.pstdev(counts.values()) / mean, counts
+
+def moved(before, after):
+    primaries = sum(1 for a, b in zip(before, after) if not a[0] == b[0])
+    copies = sum(len(set(a) - set(b)) for a, b in zip(before, after))
+    return primaries / len(before), copies / sum(len(a) for a in before)
+
+def modulo(names, count):
+    return [[placement.ringHash(name) % count] for name in names]
+
+def main():
+    parser = argparse.ArgumentParser(description='Placement simulation benchmark')
+    parser.add_argument('--names', type=int, default=100000)
+    parser.add_argument('--servers', type=int, default=10)
+    parser.add_argument('--copies', type=int, default=3)
+    parser.add_argument('--vnodes', type=int, nargs='+', default=[1, 16, 64, 256])
+    args = parser.parse_args()
+
+    s.init()
+    names = ['file{}.txt'.format(i) for i in range(args.names)]
+    print('{} names, {} servers, {} copies'.format(args.names, args.servers, args.copies))
+    print('{:>8} {:>8} {:>8} {:>10} {:>10} {:>10} {:>10} {:>12}'.format(
+        'vnodes', 'max/avg', 'stdev', 'join prim', 'join copy', 'leave prim', 'leave copy', 'lookups/s'))
+    for vnodes in args.vnodes:
+        ring = placement.RingPlacement(vnodes)
+        s.SERVERS = servers(args.servers)
+        start = time.perf_counter()
+        before = place(ring, names, args.copies)
+        rate = len(names) / (time.perf_counter() - start)
+        peak, spread, _ = balance(before, s.SERVERS.keys())
+        s.SERVERS = servers(args.servers + 1)
+        joined = moved(before, place(ring, names, args.copies))
+        s.SERVERS = servers(args.servers)
+        del s.SERVERS['10.0.0.0/30000']
+        left = moved(before, place(ring, names, args.copies))
+        print('{:>8} {:>8.2f} {:>8.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.0f}'.format(
+            vnodes, peak, spread, joined[0], joined[1], left[0], left[1], rate))
+
+    before = modulo(names, args.servers)
+    joined = moved(before, modulo(names, args.servers + 1))
+    print('{:>8} {:>8} {:>8} {:>10.3f} {:>10} {:>10} {:>10} {:>12}'.format('modulo', '', '', joined[0],
+                                                                            '', '', '', ''))
+    print('ideal join {:.3f}, ideal leave {:.3f}'.format(1 / (args.servers + 1), 1 / args.servers))
+
+    #one server with twice the capacity
+    ring = placement.RingPlacement(args.vnodes[-1])
+    s.SERVERS = servers(args.servers, {0: 2})
+    _, _, counts = balance(place(ring, names, 1), s.SERVERS.keys())
+    print('weight 2 server share {:.3f}, expected {:.3f}'.format(counts['10.0.0.0/30000'] / len(names),
+                                                                 2 / (args.servers + 1)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+'''
+Metadata microbenchmarks.
+
+Builds synthetic namespaces with files of one to ten versions and
+times the functions of services.py that work on the FS, with the
+peak memory each of them allocates (measured with tracemalloc in a
+second run, so tracing does not slow down the timed one).
+
+Run from the FileSystem folder:
+    python benchmarks/bench_services.py
+    python benchmarks/bench_services.py --sizes 10000 100000 --calls 5000
+    python benchmarks/bench_services.py --only findFile rename
+'''
+import os
+import sys
+import time
+import random
+import argparse
+import tracemalloc
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings as s
+import services as sr
+import placement
+from digest import Digest
+
+def versions(rng):
+    '''
+    Description: Number of versions of a file, most files have one
+    '''
+    roll = rng.random()
+    if roll < 0.7:
+        return 1
+    if roll < 0.9:
+        return rng.randint(2, 3)
+    return rng.randint(4, 10)
+
+def setup(size, servers, seed):
+    '''
+    Description: Builds a namespace of size files spread over the servers
+    '''
+    rng = random.Random(seed)
+    s.init()
+    s.HOST, s.PORT = '127.0.0.1', 30000
+    s.SERVERS = {'127.0.0.1/{}'.format(30000 + i): {} for i in range(servers)}
+    s.PLACER = placement.LoadPlacement()
+    s.DIGEST = Digest(s.DIGEST_BUCKETS)
+    nodes = list(s.SERVERS.keys())
+    s.FILES = {'files': [{'Type': 'Root'}]}
+    for i in range(size):
+        name = 'file{}.txt'.format(i)
+        node = nodes[i % servers]
+        s.FILES[name] = [{'Type': 'F', 'Parent': 'files', 'Node': node,
+                          'Path': 'files/{}{}'.format(v if v else '', name), 'Version': v,
+                          'Size': 1024 * rng.randint(0, 64), 'Also': [nodes[(i + 1) % servers]]}
+                         for v in range(versions(rng))]
+    s.CHANGES = deque(maxlen=s.CHANGELOG_SIZE)
+    sr.buildIndex()
+
+def remote(size, count, rng):
+    '''
+    Description: FS sent by another server, count files with a new
+    version and count new files
+    '''
+    fs = {}
+    for i in rng.sample(range(size), count):
+        name = 'file{}.txt'.format(i)
+        last = dict(s.FILES[name][-1])
+        last['Version'] += 1
+        fs[name] = s.FILES[name] + [last]
+    for i in range(count):
+        fs['remote{}.txt'.format(i)] = [{'Type': 'F', 'Parent': 'files', 'Node': '127.0.0.1/30001',
+                                         'Path': 'files/remote{}.txt'.format(i), 'Version': 0,
+                                         'Size': 1024, 'Also': []}]
+    return fs
+
+def cases(size, calls, seed):
+    '''
+    Description: Functions to time, every one is called calls times
+    (updateFs and buildIndex once) and returns the number of calls
+    '''
+    rng = random.Random(seed)
+    names = ['file{}.txt'.format(i) for i in rng.sample(range(size), min(calls, size))]
+    ring = placement.RingPlacement()
+
+    def nodeToSaveOn():
+        for name in names:
+            sr.NodeToSaveOn(name)
+        return len(names)
+
+    def ringNodeToSaveOn():
+        s.PLACER = ring
+        try:
+            return nodeToSaveOn()
+        finally:
+            s.PLACER = placement.LoadPlacement()
+
+    def replicate():
+        for name in names:
+            sr.replicate('127.0.0.1/30000', name)
+        return len(names)
+
+    def checkName():
+        for name in names:
+            sr.checkName(name)
+        return len(names)
+
+    def findFile():
+        for name in names:
+            sr.findFile(name)
+        return len(names)
+
+    def updateFs():
+        sr.updateFs(remote(size, min(calls, size) // 10, rng))
+        return 1
+
+    def rename():
+        for i, name in enumerate(names):
+            sr.rename(name, 'moved{}.txt'.format(i))
+        #put them back for the next case
+        for i, name in enumerate(names):
+            sr.rename('moved{}.txt'.format(i), name)
+        return 2 * len(names)
+
+    def buildIndex():
+        sr.buildIndex()
+        return 1
+
+    return {'NodeToSaveOn': nodeToSaveOn, 'NodeToSaveOn ring': ringNodeToSaveOn, 'replicate': replicate,
+            'checkName': checkName, 'findFile': findFile, 'updateFs': updateFs, 'rename': rename,
+            'buildIndex': buildIndex}
+
+def measure(fn):
+    '''
+    Description: Time of a call of fn in microseconds
+    '''
+    start = time.perf_counter()
+    count = fn()
+    return 1e6 * (time.perf_counter() - start) / count
+
+def peak(fn):
+    '''
+    Description: Peak memory allocated while running fn, in KB
+    '''
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description='Metadata microbenchmarks')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--servers', type=int, default=5)
+    parser.add_argument('--calls', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='+', default=None, help='names of the functions to run')
+    args = parser.parse_args()
+
+    print('{:>10} {:>20} {:>14} {:>14}'.format('files', 'function', 'us/call', 'peak KB'))
+    for size in args.sizes:
+        start = time.perf_counter()
+        setup(size, args.servers, args.seed)
+        print('{:>10} {:>20} {:>14.0f} {:>14}'.format(size, 'setup (total)', 1e6 * (time.perf_counter() - start), ''))
+        for name, fn in cases(size, args.calls, args.seed).items():
+            if not args.only == None and not name in args.only:
+                continue
+            took = measure(fn)
+            memory = peak(fn)
+            print('{:>10} {:>20} {:>14.2f} {:>14.1f}'.format(size, name, took, memory))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+'''
+Create throughput benchmark.
+
+Times the metadata part of a CREATE (name check, placement, replica
+selection and the change record) on synthetic namespaces, next to the
+full scan of the FS that placement used to do on every create.
+
+Run from the FileSystem folder:
+    python benchmarks/create.py
+    python benchmarks/create.py --sizes 10000 100000 --creates 5000
+'''
+import os
+import sys
+import time
+import argparse
+from collections import Counter, deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import settings as s
+import services as sr
+import placement
+
+def setup(size, servers):
+    '''
+    Description: Builds a namespace of size files spread over the servers
+    '''
+    s.init()
+    s.HOST, s.PORT = '127.0.0.1', 30000
+    s.PLACER = placement.LoadPlacement()
+    s.SERVERS = {'127.0.0.1/{}'.format(30000 + i): {} for i in range(servers)}
+    nodes = list(s.SERVERS.keys())
+    s.FILES = {'files': [{'Type': 'Root'}]}
+    for i in range(size):
+        node = nodes[i % servers]
+        s.FILES['file{}.txt'.format(i)] = [{'Type': 'F', 'Parent': 'files', 'Node': node,
+                                            'Path': 'files/file{}.txt'.format(i), 'Version': 0,
+                                            'Size': 1024 * (i % 64),
+                                            'Also': [nodes[(i + 1) % servers]]}]
+    s.CHANGES = deque(maxlen=s.CHANGELOG_SIZE)
+    sr.buildIndex()
+
+def create(i):
+    '''
+    Description: The metadata work of one CREATE
+    '''
+    name = sr.checkName('new{}.txt'.format(i))
+    node = sr.NodeToSaveOn(name)
+    entry = {'Type': 'F', 'Parent': 'files', 'Node': node, 'Path': 'files/{}'.format(name),
+             'Version': 0, 'Also': list(sr.replicate(node, name))}
+    sr.makeChange('PUT', name, [entry])
+
+def scan():
+    '''
+    Description: The per create scan of the FS done before the load index
+    '''
+    counts = Counter()
+    for items, des in s.FILES.items():
+        if 'Node' in des[-1].keys():
+            counts[des[-1]['Node']] += 1
+        if 'Also' in des[-1].keys() and len(des[-1]['Also']) > 0:
+            counts[des[-1]['Also'][-1]] += 1
+    return counts.most_common()
+
+def rate(fn, count):
+    start = time.perf_counter()
+    for i in range(count):
+        fn(i)
+    return count / (time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description='CREATE throughput benchmark')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--servers', type=int, default=5)
+    parser.add_argument('--creates', type=int, default=10000)
+    parser.add_argument('--scans', type=int, default=5)
+    args = parser.parse_args()
+
+    print('{:>10} {:>16} {:>16}'.format('files', 'creates/s', 'old creates/s'))
+    for size in args.sizes:
+        setup(size, args.servers)
+        creates = rate(create, args.creates)
+        #two scans per create: NodeToSaveOn and replicate
+        scans = rate(lambda i: scan(), args.scans) / 2
+        print('{:>10} {:>16.0f} {:>16.1f}'.format(size, creates, scans))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,306 @@
+'''
+Cluster load benchmark.
+
+Starts a cluster of servers on localhost ports, each in its own folder
+with a generated config, and runs clients against it with a mix of
+CREATE, FILE, UPDATE, GIVEFILE, RENAME and FS requests. Reports the
+throughput and latency of every kind of request and the replication
+lag the servers measured. Runs are repeatable: every client has its
+own seeded random generator and makes a fixed number of requests.
+
+Run from the FileSystem folder:
+    python benchmarks/load.py
+    python benchmarks/load.py --servers 5 --clients 16 --ops 500
+    python benchmarks/load.py --mix GIVEFILE=80,FILE=20 --sizes 4096:1,1048576:1
+    python benchmarks/load.py --set writeConcern=majority --set placement=ring --json run.json
+'''
+import os
+import sys
+import io
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from session import Client
+from protocol import *
+
+SERVER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server.py')
+
+def weights(text, convert):
+    '''
+    Description: Parses 'a=1,b=2' (or 'a:1,b:2') into keys and weights
+    '''
+    keys, values = [], []
+    for part in text.split(','):
+        key, weight = part.replace(':', '=').split('=')
+        keys.append(convert(key))
+        values.append(float(weight))
+    return keys, values
+
+def setting(text):
+    key, value = text.split('=', 1)
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+class Cluster():
+    '''
+    Description: Servers started on localhost ports, stopped and
+    removed at the end
+    '''
+    def __init__(self, count, base, root, settings):
+        self.root = root
+        self.ports = [base + i for i in range(count)]
+        servers = {'127.0.0.1/{}'.format(port): {'ip': '127.0.0.1', 'port': port} for port in self.ports}
+        self.procs = []
+        for i, port in enumerate(self.ports):
+            folder = os.path.join(root, 'n{}'.format(i))
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+            config = {'host': '127.0.0.1', 'port': port, 'servers': servers, 'root': 'files'}
+            config.update(settings)
+            with open(os.path.join(folder, 'config.txt'), 'w') as f:
+                json.dump(config, f)
+            log = open(os.path.join(folder, 'log'), 'w')
+            self.procs.append(subprocess.Popen([sys.executable, '-u', SERVER], cwd=folder,
+                                               stdout=log, stderr=subprocess.STDOUT))
+
+    async def stats(self, port):
+        client = Client('127.0.0.1', port, exitOnError=False)
+        try:
+            message = await client.request(CommandObject(STATS))
+            return None if message == None else message.data
+        finally:
+            await client.close()
+
+    async def ready(self, timeout=30.0):
+        '''
+        Description: Waits until every server is up and connected
+        to all the others
+        '''
+        end = time.monotonic() + timeout
+        for port in self.ports:
+            while True:
+                try:
+                    stats = await self.stats(port)
+                    if not stats == None and all(peer['Alive'] for peer in stats['Peers']['Peers'].values()):
+                        break
+                except OSError:
+                    pass
+                if time.monotonic() > end:
+                    raise RuntimeError('Cluster not ready, see the logs in {}'.format(self.root))
+                await asyncio.sleep(0.2)
+
+    def stop(self):
+        for proc in self.procs:
+            proc.terminate()
+        for proc in self.procs:
+            proc.wait()
+
+class Worker():
+    '''
+    Description: One client sending requests to one server. It only
+    works on the files it created, so clients never wait on each other
+    for a name.
+    '''
+    def __init__(self, number, port, args, results):
+        self.number = number
+        self.port = port
+        self.args = args
+        self.results = results
+        self.random = random.Random(args.seed * 1000 + number)
+        self.ops, self.opWeights = weights(args.mix, str)
+        self.sizes, self.sizeWeights = weights(args.sizes, int)
+        self.clients = {}
+        self.names = []
+        self.written = set()
+        self.created = 0
+
+    def client(self, port):
+        if not port in self.clients.keys():
+            self.clients[port] = Client('127.0.0.1', port, exitOnError=False)
+        return self.clients[port]
+
+    def record(self, op, seconds, ok):
+        if not op in self.results.keys():
+            self.results[op] = {'Times': [], 'Errors': 0}
+        if ok:
+            self.results[op]['Times'].append(seconds)
+        else:
+            self.results[op]['Errors'] += 1
+
+    async def create(self):
+        name = 'w{}-{}.bin'.format(self.number, self.created)
+        self.created += 1
+        message = await self.client(self.port).request(CommandObject(CREATE, {name: {'Type': 'F', 'Parent': 'files'}}))
+        ok = not message == None and message.command == FS
+        if ok:
+            self.names.append(name)
+        return ok
+
+    async def write(self, name):
+        size = int(self.random.choices(self.sizes, self.sizeWeights)[0])
+        body = self.random.randbytes(size)
+        message = await self.client(self.port).sendFile(name, io.BytesIO(body))
+        if not message == None and message.command == SUCCESS:
+            self.written.add(name)
+            return True
+        return False
+
+    async def read(self, name):
+        port = self.port
+        #a server without the file sends the client on, at most a few times
+        for _ in range(3):
+            message = None
+            async for message in self.client(port).stream(CommandObject(GIVEFILE, {'Name': name, 'Stream': True})):
+                pass
+            if message == None or not message.command == CONN:
+                break
+            port = int(message.data['PORT'])
+        return not message == None and message.command in [FILEEND, NOTMODIFIED]
+
+    async def run(self):
+        for _ in range(self.args.warmup):
+            await self.create()
+        for _ in range(self.args.ops):
+            op = self.random.choices(self.ops, self.opWeights)[0]
+            if len(self.names) == 0 and not op in ['CREATE', 'FS']:
+                op = 'CREATE'
+            #only files with a body can be read
+            if op == 'GIVEFILE' and len(self.written) == 0:
+                op = 'FILE'
+            if op == 'GIVEFILE':
+                name = self.random.choice(sorted(self.written))
+            else:
+                name = self.random.choice(self.names) if len(self.names) > 0 else None
+            start = time.perf_counter()
+            try:
+                ok = await asyncio.wait_for(self.request(op, name), self.args.timeout)
+            except (asyncio.TimeoutError, OSError):
+                ok = False
+            self.record(op, time.perf_counter() - start, ok)
+        for client in self.clients.values():
+            await client.close()
+
+    async def request(self, op, name):
+        '''
+        Description: Sends one request, True if it worked
+        '''
+        if op == 'CREATE':
+            ok = await self.create()
+        elif op == 'FILE':
+            ok = await self.write(name)
+        elif op == 'GIVEFILE':
+            ok = await self.read(name)
+        elif op == 'UPDATE':
+            message = await self.client(self.port).request(CommandObject(UPDATE, name))
+            ok = not message == None and message.command == FS
+            #the new version has no body until it is written
+            self.written.discard(name)
+        elif op == 'RENAME':
+            new = 'w{}-{}.bin'.format(self.number, self.created)
+            self.created += 1
+            message = await self.client(self.port).request(CommandObject(RENAME, {'old': name, 'new': new}))
+            ok = not message == None and message.command == FS
+            if ok:
+                self.names[self.names.index(name)] = new
+                if name in self.written:
+                    self.written.remove(name)
+                    self.written.add(new)
+        else:
+            message = await self.client(self.port).request(CommandObject(FS))
+            ok = not message == None and message.command == FS
+        return ok
+
+def percentile(ordered, p):
+    if len(ordered) == 0:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(SERVER)).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def bench(args):
+    root = args.dir if not args.dir == None else tempfile.mkdtemp(prefix='dsbench')
+    cluster = Cluster(args.servers, args.port, root, dict(setting(text) for text in args.set))
+    try:
+        await cluster.ready()
+        results = {}
+        workers = [Worker(i, cluster.ports[i % args.servers], args, results) for i in range(args.clients)]
+        start = time.perf_counter()
+        await asyncio.gather(*[worker.run() for worker in workers])
+        took = time.perf_counter() - start
+        #replicas ACK in the background with the 'async' write concern
+        await asyncio.sleep(args.settle)
+        servers = {port: await cluster.stats(port) for port in cluster.ports}
+    finally:
+        cluster.stop()
+        if args.dir == None:
+            shutil.rmtree(root, ignore_errors=True)
+
+    report = {'Commit': commit(), 'Args': vars(args), 'Seconds': took, 'Ops': {}, 'Replication': {}}
+    total = 0
+    for op, result in sorted(results.items()):
+        ordered = sorted(result['Times'])
+        total += len(ordered)
+        report['Ops'][op] = {'Count': len(ordered), 'Errors': result['Errors'], 'Rate': len(ordered) / took,
+                             'P50': 1000 * percentile(ordered, 50), 'P95': 1000 * percentile(ordered, 95),
+                             'P99': 1000 * percentile(ordered, 99)}
+    report['Rate'] = total / took
+    for port, stats in servers.items():
+        replicator = stats['Replicator']
+        report['Replication'][port] = {'Writes': replicator['Writes'], 'Acks': replicator['Acks'],
+                                       'Failed': replicator['Failed'], 'Lagging': len(replicator['Lagging']),
+                                       'P50': replicator['Replica']['P50'], 'P99': replicator['Replica']['P99']}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Cluster load benchmark')
+    parser.add_argument('--servers', type=int, default=3)
+    parser.add_argument('--port', type=int, default=42000, help='port of the first server')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--ops', type=int, default=200, help='requests per client')
+    parser.add_argument('--warmup', type=int, default=5, help='files every client creates first')
+    parser.add_argument('--mix', default='CREATE=10,FILE=25,UPDATE=5,GIVEFILE=50,RENAME=5,FS=5')
+    parser.add_argument('--sizes', default='1024=50,65536=40,1048576=10', help='file size=weight')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--set', action='append', default=[], help='config setting of every server, key=value')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds before a request counts as failed')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds to wait for replication at the end')
+    parser.add_argument('--dir', default=None, help='folder for the servers, kept after the run')
+    parser.add_argument('--json', default=None, help='file to write the report to')
+    args = parser.parse_args()
+
+    report = asyncio.run(bench(args))
+    print('commit {}, {} servers, {} clients, {} requests each, {:.2f}s'.format(
+        report['Commit'], args.servers, args.clients, args.ops, report['Seconds']))
+    print('{:>10} {:>8} {:>7} {:>10} {:>9} {:>9} {:>9}'.format('request', 'count', 'errors', 'req/s',
+                                                               'p50 ms', 'p95 ms', 'p99 ms'))
+    for op, result in report['Ops'].items():
+        print('{:>10} {:>8} {:>7} {:>10.1f} {:>9.2f} {:>9.2f} {:>9.2f}'.format(
+            op, result['Count'], result['Errors'], result['Rate'], result['P50'], result['P95'], result['P99']))
+    print('{:>10} {:>8} {:>7} {:>10.1f}'.format('all', '', '', report['Rate']))
+    print('replication lag (send to ACK)')
+    print('{:>10} {:>8} {:>8} {:>8} {:>8} {:>9} {:>9}'.format('server', 'writes', 'acks', 'failed', 'lagging',
+                                                              'p50 ms', 'p99 ms'))
+    for port, result in report['Replication'].items():
+        print('{:>10} {:>8} {:>8} {:>8} {:>8} {:>9.2f} {:>9.2f}'.format(
+            port, result['Writes'], result['Acks'], result['Failed'], result['Lagging'],
+            result['P50'], result['P99']))
+    if not args.json == None:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+
+if __name__ == '__main__':
+    main()
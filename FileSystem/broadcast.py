@@ -0,0 +1,75 @@
+import asyncio
+
+import settings as s
+import services as sr
+from protocol import *
+
+class Broadcaster():
+    '''
+    Description: Sends local changes to the other servers. Changes made
+    within a short window are sent together as one DELTA per server,
+    or earlier once maxChanges are waiting. Changes are taken from the
+    change log, so they always go out in sequence order.
+    '''
+    def __init__(self, local, window=0.005, maxChanges=256):
+        self.local = local
+        self.window = window
+        self.maxChanges = maxChanges
+        #last sequence number sent
+        self.sent = s.SEQ
+        self.wakeup = asyncio.Event()
+        self.full = asyncio.Event()
+        #Sends: DELTAs sent, Saved: DELTAs one send per change would add
+        self.counters = {'Changes': 0, 'Flushes': 0, 'Sends': 0, 'Saved': 0}
+
+    def notify(self, count=1):
+        '''
+        Description: Called after local changes were made. They are
+        sent once the window is over.
+        '''
+        self.counters['Changes'] += count
+        if s.SEQ - self.sent >= self.maxChanges:
+            self.full.set()
+        self.wakeup.set()
+
+    async def run(self):
+        '''
+        Description: Waits for changes, lets more gather for the window
+        or until there are maxChanges, then sends them.
+        '''
+        while True:
+            await self.wakeup.wait()
+            if not self.full.is_set():
+                try:
+                    await asyncio.wait_for(self.full.wait(), self.window)
+                except asyncio.TimeoutError:
+                    pass
+            self.wakeup.clear()
+            self.full.clear()
+            self.flush()
+
+    def flush(self):
+        '''
+        Description: Sends every change not sent yet to all the other
+        connected servers.
+        '''
+        changes = sr.changesSince(self.sent)
+        self.sent = s.SEQ
+        if changes == None:
+            #the log was truncated, servers that miss changes ask for a SYNC
+            return
+        if len(changes) == 0:
+            return
+        command = CommandObject(DELTA, {'Origin': self.local,
+                                        'Epoch': s.EPOCH,
+                                        'Changes': changes})
+        peers = [name for name in s.SERVERS.keys()
+                 if not name == self.local and name in s.CONNECTIONS.keys()]
+        for name in peers:
+            s.CONNECTIONS[name].push(command)
+        self.counters['Flushes'] += 1
+        self.counters['Sends'] += len(peers)
+        self.counters['Saved'] += (len(changes) - 1) * len(peers)
+
+    def stats(self):
+        return dict(self.counters)
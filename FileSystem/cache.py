@@ -0,0 +1,83 @@
+import asyncio
+from collections import OrderedDict
+
+class LRUCache():
+    '''
+    Description: Size bounded cache of file contents in memory. The
+    least recently used entries are dropped once maxBytes are used.
+    Misses on a key already being loaded wait for that load instead
+    of reading the disk again.
+    '''
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        #entries larger than this are never cached
+        self.itemBytes = maxBytes // 16
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.loading = {}
+        self.counters = {'Hits': 0, 'Misses': 0, 'Merged': 0, 'Evictions': 0, 'Invalidations': 0}
+
+    def fits(self, size):
+        return size <= self.itemBytes
+
+    async def get(self, key, load):
+        '''
+        Description: Returns the value of key, calls load() to read it
+        on a miss.
+        '''
+        if key in self.entries.keys():
+            self.entries.move_to_end(key)
+            self.counters['Hits'] += 1
+            return self.entries[key]
+        if key in self.loading.keys():
+            self.counters['Merged'] += 1
+            return await asyncio.shield(self.loading[key])
+        self.counters['Misses'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            value = await load()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            #nobody may be waiting, mark the exception as seen
+            future.exception()
+            raise
+        else:
+            future.set_result(value)
+            #not cached if the key was invalidated while loading
+            if self.loading.get(key) is future:
+                self.put(key, value)
+            return value
+        finally:
+            if self.loading.get(key) is future:
+                del self.loading[key]
+
+    def put(self, key, value):
+        if not self.fits(len(value)):
+            return
+        self.invalidate(key, count=False)
+        self.entries[key] = value
+        self.bytes += len(value)
+        while self.bytes > self.maxBytes:
+            _, old = self.entries.popitem(last=False)
+            self.bytes -= len(old)
+            self.counters['Evictions'] += 1
+
+    def invalidate(self, key, count=True):
+        '''
+        Description: Drops a key whose contents changed
+        '''
+        if key in self.entries.keys():
+            self.bytes -= len(self.entries.pop(key))
+            if count:
+                self.counters['Invalidations'] += 1
+        self.loading.pop(key, None)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['Entries'] = len(self.entries)
+        stats['Bytes'] = self.bytes
+        return stats
@@ -0,0 +1,219 @@
+import os
+import asyncio
+import hashlib
+
+from protocol import CHUNK_SIZE
+
+class ChunkStore():
+    '''
+    Description: Content addressed store of file bodies. A body is cut
+    into chunks of CHUNK_SIZE bytes, every chunk is saved once under
+    its sha256 no matter how many versions or files hold it. Versions
+    in the FS list their chunks in 'Chunks'.
+    A chunk is counted once for every version on this server that
+    holds it and removed when nothing holds it anymore.
+    '''
+    def __init__(self, root, disk):
+        self.root = root
+        self.disk = disk
+        self.present = set()
+        self.refs = {}
+        #chunks being saved, never removed until unpinned
+        self.pinned = {}
+        #chunks no version holds anymore
+        self.garbage = set()
+        #chunks being removed: {hash: task}
+        self.removing = {}
+        #chunks being written: {hash: task}
+        self.writing = {}
+        self.counters = {'Written': 0, 'Deduplicated': 0, 'Removed': 0}
+
+    def path(self, h):
+        return os.path.join(self.root, h[:2], h)
+
+    def open(self):
+        '''
+        Description: Finds the chunks on disk. Called on boot.
+        '''
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        for folder in os.listdir(self.root):
+            for name in os.listdir(os.path.join(self.root, folder)):
+                if name.endswith('.tmp'):
+                    os.remove(os.path.join(self.root, folder, name))
+                else:
+                    self.present.add(name)
+
+    def sweep(self):
+        '''
+        Description: Removes the chunks no version holds, left by
+        transfers that never finished. Called on boot once the FS
+        is indexed.
+        '''
+        for h in [h for h in self.present if not h in self.refs.keys()]:
+            os.remove(self.path(h))
+            self.present.discard(h)
+            self.counters['Removed'] += 1
+
+    def has(self, h):
+        return h in self.present
+
+    def missing(self, hashes):
+        return [h for h in hashes if not h in self.present]
+
+    async def put(self, data):
+        '''
+        Description: Saves a chunk unless it is already stored.
+        Returns its hash. The chunk stays pinned until unpin().
+        '''
+        h = hashlib.sha256(data).hexdigest()
+        self.pinned[h] = self.pinned.get(h, 0) + 1
+        if h in self.removing.keys():
+            await self.removing[h]
+        if h in self.present:
+            self.counters['Deduplicated'] += 1
+        elif h in self.writing.keys():
+            #the same chunk put at the same time is written once
+            await asyncio.shield(self.writing[h])
+            self.counters['Deduplicated'] += 1
+        else:
+            self.writing[h] = asyncio.ensure_future(self.save(h, data))
+            await asyncio.shield(self.writing[h])
+        return h
+
+    async def save(self, h, data):
+        try:
+            await self.disk.run('chunk write', self.write, h, data)
+            self.present.add(h)
+            self.counters['Written'] += 1
+        finally:
+            del self.writing[h]
+
+    def write(self, h, data):
+        path = self.path(h)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+        os.replace(path + '.tmp', path)
+
+    def unpin(self, hashes):
+        '''
+        Description: Ends the pin of put(). A chunk no version holds
+        yet is kept, the FS change naming it may still be on its way.
+        '''
+        for h in hashes:
+            self.pinned[h] -= 1
+            if self.pinned[h] == 0:
+                del self.pinned[h]
+
+    async def get(self, h):
+        return await self.disk.run('chunk read', self.read, h)
+
+    def read(self, h):
+        with open(self.path(h), 'rb') as f:
+            return f.read()
+
+    async def putBody(self, data):
+        '''
+        Description: Saves a whole body, returns the hashes of its chunks.
+        The chunks stay pinned until unpin().
+        '''
+        return [await self.put(data[i:i + CHUNK_SIZE]) for i in range(0, len(data), CHUNK_SIZE)]
+
+    async def getBody(self, hashes):
+        return b''.join([await self.get(h) for h in hashes])
+
+    def writer(self):
+        return ChunkWriter(self)
+
+    def ref(self, hashes, sign):
+        '''
+        Description: Counts (sign 1) or stops counting (sign -1) the
+        chunks of a version held by this server.
+        '''
+        for h in hashes:
+            count = self.refs.get(h, 0) + sign
+            if count > 0:
+                self.refs[h] = count
+            else:
+                self.refs.pop(h, None)
+                self.collect(h)
+
+    def collect(self, h):
+        '''
+        Description: Removes a chunk in the background if nothing holds
+        it anymore. Counts drop to 0 for a moment while a change is
+        applied, so chunks are only looked at once the change is done.
+        '''
+        if len(self.garbage) == 0:
+            try:
+                asyncio.get_running_loop().call_soon(self.collectGarbage)
+            except RuntimeError:
+                #booting, sweep() removes it
+                return
+        self.garbage.add(h)
+
+    def collectGarbage(self):
+        garbage, self.garbage = self.garbage, set()
+        for h in garbage:
+            if h in self.refs.keys() or h in self.pinned.keys() or h in self.removing.keys():
+                continue
+            if not h in self.present:
+                continue
+            self.present.discard(h)
+            self.removing[h] = asyncio.get_running_loop().create_task(self.remove(h))
+
+    async def remove(self, h):
+        try:
+            await self.disk.run('chunk remove', os.remove, self.path(h))
+            self.counters['Removed'] += 1
+        except OSError as e:
+            print(e)
+        finally:
+            del self.removing[h]
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['Chunks'] = len(self.present)
+        stats['Refs'] = sum(self.refs.values())
+        return stats
+
+class ChunkWriter():
+    '''
+    Description: Cuts a body received in pieces of any size into
+    chunks and saves them.
+    '''
+    def __init__(self, store):
+        self.store = store
+        self.buffer = bytearray()
+        self.hashes = []
+        self.size = 0
+
+    async def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= CHUNK_SIZE:
+            self.hashes.append(await self.store.put(bytes(self.buffer[:CHUNK_SIZE])))
+            del self.buffer[:CHUNK_SIZE]
+
+    async def close(self):
+        '''
+        Description: Saves the rest of the body. Returns the hashes of
+        the chunks and the size of the body.
+        '''
+        if len(self.buffer) > 0:
+            self.hashes.append(await self.store.put(bytes(self.buffer)))
+            self.buffer = bytearray()
+        return self.hashes, self.size
+
+    def release(self, keep=True):
+        '''
+        Description: Unpins the chunks, once they are in the FS or
+        the transfer failed. Unless keep is set, the chunks no version
+        holds are removed.
+        '''
+        hashes, self.hashes = self.hashes, []
+        self.store.unpin(hashes)
+        if not keep:
+            for h in hashes:
+                self.store.collect(h)
@@ -0,0 +1,347 @@
+'''
+Command line client, for moving many files in and out of the file
+system without the GUI.
+
+A folder is uploaded under a folder of the same name (or --to). Every
+file and folder is named by its path from there, so names stay unique
+and a download puts the files back in the same tree. Files are sent
+and fetched by --jobs transfers at the same time. An interrupted run
+is resumed by running it again: files whose body is already the same
+on both sides are skipped, bodies are only saved once complete.
+Folders and files are added to the FS with BATCH, many in a frame.
+
+Usage, from the FileSystem folder:
+    python cli.py ls
+    python cli.py upload ~/photos --jobs 16
+    python cli.py upload ~/photos --to backup
+    python cli.py download photos restore/
+'''
+import os
+import sys
+import json
+import time
+import hashlib
+import asyncio
+import argparse
+
+from protocol import *
+from session import Client
+from filecache import bodyTag
+
+def remoteTag(entry):
+    if not 'Chunks' in entry.keys():
+        return None
+    return hashlib.sha256(''.join(entry['Chunks']).encode('ascii')).hexdigest()
+
+def same(entry, path):
+    '''
+    Description: Checks the latest version of a file has the body
+    of a local file
+    '''
+    if not os.path.isfile(path) or not 'Chunks' in entry.keys():
+        return False
+    if 'Size' in entry.keys() and not entry['Size'] == os.path.getsize(path):
+        return False
+    return remoteTag(entry) == bodyTag(path)
+
+def boot(config):
+    '''
+    Description: Server of the client config, like the GUI
+    '''
+    try:
+        with open(config, 'r') as f:
+            data = json.load(f)
+        return (data.get('host'), data.get('port'), data.get('codec', 'binary'))
+    except (OSError, ValueError) as e:
+        print('Boot Error: {}'.format(e))
+    return (None, None, 'binary')
+
+class Progress():
+    '''
+    Description: Files and bytes moved, printed every second and at
+    the end
+    '''
+    def __init__(self, total, quiet=False):
+        self.total = total
+        self.quiet = quiet
+        self.start = time.perf_counter()
+        self.counters = {'Done': 0, 'Skipped': 0, 'Failed': 0, 'Bytes': 0}
+
+    def add(self, kind, size=0):
+        self.counters[kind] += 1
+        self.counters['Bytes'] += size
+
+    def line(self):
+        took = time.perf_counter() - self.start
+        files = self.counters['Done'] + self.counters['Skipped'] + self.counters['Failed']
+        return '{}/{} files, {} done, {} skipped, {} failed, {:.1f} MB, {:.1f} files/s, {:.2f} MB/s, {:.1f}s'.format(
+            files, self.total, self.counters['Done'], self.counters['Skipped'], self.counters['Failed'],
+            self.counters['Bytes'] / 1048576, self.counters['Done'] / took if took else 0.0,
+            self.counters['Bytes'] / 1048576 / took if took else 0.0, took)
+
+    async def show(self):
+        while not self.quiet:
+            await asyncio.sleep(1)
+            print(self.line(), flush=True)
+
+class Cli():
+    '''
+    Description: Runs the transfers. Every job has its own connections,
+    one to the server of the config and one to every server it is sent
+    on to for a file.
+    '''
+    def __init__(self, ip, port, codec='binary', jobs=8, quiet=False, batchSize=256):
+        self.ip = ip
+        self.port = port
+        self.codec = codec
+        self.jobs = jobs
+        self.quiet = quiet
+        self.batchSize = batchSize
+        self.clients = [{} for _ in range(jobs)]
+        self.Fs = {}
+
+    def client(self, job, ip=None, port=None):
+        key = (ip or self.ip, int(port or self.port))
+        if not key in self.clients[job].keys():
+            self.clients[job][key] = Client(key[0], key[1], self.codec, exitOnError=False)
+        return self.clients[job][key]
+
+    async def close(self):
+        for clients in self.clients:
+            for client in clients.values():
+                await client.close()
+
+    async def getFs(self):
+        message = await self.client(0).request(CommandObject(FS))
+        if message == None or not message.command == FS:
+            raise OSError('Cannot get the FS from {}:{}'.format(self.ip, self.port))
+        self.Fs = message.data
+        return self.Fs
+
+    async def run(self, items, work, progress):
+        '''
+        Description: Runs work(job, item) for every item, jobs at a time
+        '''
+        queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+
+        async def worker(job):
+            while not queue.empty():
+                item = queue.get_nowait()
+                try:
+                    kind, size = await work(job, item)
+                except (OSError, ValueError) as e:
+                    print('{}: {}'.format(item[0], e))
+                    kind, size = 'Failed', 0
+                progress.add(kind, size)
+
+        shower = asyncio.ensure_future(progress.show())
+        try:
+            await asyncio.gather(*[worker(job) for job in range(min(self.jobs, max(1, len(items))))])
+        finally:
+            shower.cancel()
+        print(progress.line())
+        return progress.counters['Failed'] == 0
+
+    async def batch(self, ops):
+        '''
+        Description: Sends operations in BATCH frames of at most
+        batchSize operations, returns the result of every one
+        '''
+        results = []
+        for i in range(0, len(ops), self.batchSize):
+            message = await self.client(0).request(CommandObject(BATCH, {'Ops': ops[i:i + self.batchSize]}))
+            if message == None or not message.command == BATCH:
+                raise OSError('Cannot change the FS')
+            results.extend(message.data['Results'])
+        return results
+
+    async def upload(self, local, to=None, parent='files'):
+        '''
+        Description: Sends a local folder and everything in it. The
+        folders and files are added to the FS in batches first, then
+        the bodies are sent.
+        '''
+        local = os.path.abspath(local)
+        top = to or os.path.basename(local)
+        await self.getFs()
+        folders = [(top, parent)]
+        files = []
+        for path, dirs, names in os.walk(local):
+            rel = os.path.relpath(path, local)
+            folder = top if rel == '.' else '{}/{}'.format(top, rel.replace(os.sep, '/'))
+            dirs.sort()
+            for d in dirs:
+                folders.append(('{}/{}'.format(folder, d), folder))
+            for n in sorted(names):
+                if not n.endswith('.part'):
+                    files.append(('{}/{}'.format(folder, n), folder, os.path.join(path, n)))
+        progress = Progress(len(files), self.quiet)
+        #parents are always made before their children
+        ops = [{'Command': NEWFOLDER, 'Data': {name: {'Type': 'D', 'Parent': folderParent}}}
+               for name, folderParent in folders if not name in self.Fs.keys()]
+        for result in await self.batch(ops):
+            if not result['Status'] == 'SUCCESS':
+                raise OSError('Cannot make folder {}'.format(result.get('Name')))
+
+        pending = []
+        ops = []
+        for name, folder, path in files:
+            entry = self.Fs[name][-1] if name in self.Fs.keys() else None
+            if entry == None:
+                ops.append({'Command': CREATE, 'Data': {name: {'Type': 'F', 'Parent': folder}}})
+            elif same(entry, path):
+                progress.add('Skipped')
+                continue
+            elif 'Chunks' in entry.keys():
+                #a new version of a file that changed
+                ops.append({'Command': UPDATE, 'Data': name})
+            else:
+                #a version without its body, from an upload that stopped
+                pending.append((name, path))
+                continue
+            pending.append((name, path, len(ops) - 1))
+        results = await self.batch(ops)
+        items = []
+        for item in pending:
+            if len(item) == 2:
+                items.append(item)
+            elif results[item[2]]['Status'] == 'SUCCESS':
+                #the server names a file that was made in the meantime differently
+                items.append((results[item[2]]['Name'], item[1]))
+            else:
+                print('{}: {}'.format(item[0], results[item[2]].get('Reason')))
+                progress.add('Failed')
+        return await self.run(items, self.uploadFile, progress)
+
+    async def uploadFile(self, job, item):
+        name, path = item
+        with open(path, 'rb') as f:
+            message = await self.client(job).sendFile(name, f)
+        if message == None or not message.command == SUCCESS:
+            raise OSError('Upload failed: {}'.format(None if message == None else message.data))
+        return ('Done', os.path.getsize(path))
+
+    def localPath(self, name, dest):
+        '''
+        Description: Where a file goes, the names of its folders from
+        the root of the FS
+        '''
+        parts = []
+        while name in self.Fs.keys() and not self.Fs[name][-1]['Type'] == 'Root':
+            parts.append(name.rsplit('/', 1)[-1])
+            name = self.Fs[name][-1].get('Parent')
+        return os.path.join(dest, *reversed(parts))
+
+    def inside(self, name, folder):
+        while name in self.Fs.keys():
+            if name == folder:
+                return True
+            name = self.Fs[name][-1].get('Parent')
+        return False
+
+    async def download(self, folder, dest):
+        '''
+        Description: Fetches a folder of the FS and everything in it
+        '''
+        await self.getFs()
+        if not folder in self.Fs.keys():
+            raise OSError('{} is not in the FS'.format(folder))
+        files = [(name, self.localPath(name, dest)) for name, versions in sorted(self.Fs.items())
+                 if versions[-1]['Type'] == 'F' and self.inside(name, folder)]
+        return await self.run(files, self.downloadFile, Progress(len(files), self.quiet))
+
+    async def downloadFile(self, job, item):
+        name, path = item
+        entry = self.Fs[name][-1]
+        if same(entry, path):
+            return ('Skipped', 0)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        client = self.client(job)
+        #a server without the file sends the client on, at most a few times
+        for _ in range(3):
+            message = await self.fetch(client, name, path)
+            if message == None or not message.command == CONN:
+                break
+            client = self.client(job, message.data['IP'], message.data['PORT'])
+        if message == None or not message.command == FILEEND:
+            raise OSError('Download failed')
+        return ('Done', os.path.getsize(path))
+
+    async def fetch(self, client, name, path):
+        '''
+        Description: Streams a file into a .part file, which becomes the
+        file once it is complete
+        '''
+        f = None
+        message = None
+        try:
+            async for message in client.stream(CommandObject(GIVEFILE, {'Name': name, 'Stream': True})):
+                if message.command == FILESTART:
+                    f = open(path + '.part', 'wb')
+                elif message.command == FILECHUNK:
+                    f.write(message.data['Data'])
+        finally:
+            if not f == None:
+                f.close()
+        if not message == None and message.command == FILEEND:
+            os.replace(path + '.part', path)
+        elif not f == None:
+            os.remove(path + '.part')
+        return message
+
+    def ls(self, folder):
+        for name, versions in sorted(self.Fs.items()):
+            entry = versions[-1]
+            if entry.get('Parent') == folder:
+                size = entry.get('Size', '') if entry['Type'] == 'F' else ''
+                print('{:>4} {:>12} {:>4} {}'.format(entry['Type'], size, len(versions), name))
+
+async def main(args):
+    #a config is not needed when the server is given
+    ip, port, codec = (args.host, args.port, args.codec)
+    if None in [ip, port]:
+        ip, port, codec = boot(args.config)
+        ip = args.host or ip
+        port = args.port or port
+    if None in [ip, port]:
+        print('Error in Boot. Reconfigure')
+        return False
+    cli = Cli(ip, port, codec, args.jobs, args.quiet, args.batch)
+    try:
+        if args.command == 'ls':
+            await cli.getFs()
+            cli.ls(args.folder)
+            return True
+        if args.command == 'upload':
+            return await cli.upload(args.local, args.to, args.parent)
+        return await cli.download(args.folder, args.dest)
+    except OSError as e:
+        print(e)
+        return False
+    finally:
+        await cli.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Command line client')
+    parser.add_argument('--config', default='clientconfig.txt')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=None)
+    parser.add_argument('--codec', default='binary', help='codec when the server is given')
+    parser.add_argument('--jobs', type=int, default=8, help='transfers at the same time')
+    parser.add_argument('--quiet', action='store_true', help='only print the summary')
+    parser.add_argument('--batch', type=int, default=256, help='changes to the FS sent in one frame')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ls = commands.add_parser('ls', help='list a folder')
+    ls.add_argument('folder', nargs='?', default='files')
+    upload = commands.add_parser('upload', help='send a local folder')
+    upload.add_argument('local')
+    upload.add_argument('--to', default=None, help='name of the folder in the FS')
+    upload.add_argument('--parent', default='files', help='folder of the FS to put it in')
+    download = commands.add_parser('download', help='fetch a folder of the FS')
+    download.add_argument('folder')
+    download.add_argument('dest')
+    args = parser.parse_args()
+
+    sys.exit(0 if asyncio.run(main(args)) else 1)
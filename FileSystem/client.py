@@ -1,77 +1,28 @@
 import asyncio
-import dill
-import struct
 import os, sys, json
 import functools
 
 from PyQt5 import QtCore, QtGui, QtWidgets
 import gui as main
+from names import NameIndex
+from protocol import *
+from session import Client
+from filecache import FileCache, bodyTag
 
-CREATE, UPDATE, FS, FILE, REPLICATEFILE, GIVEFILE, NEWFOLDER, RENAME, QUIT, ERROR, SUCCESS, CONN, INVALID, DEL = range(14)
-IP, PORT, TEMP = None, None, None
-
-class CommandObject(object):
-    '''A command object to pass. It ensures security'''
-    def __init__(self, command, data=None):
-        self.command = command
-        self.data = data
-
-class Client():
-
-    def __init__(self, ip, port):
-        self.ip = ip
-        self.port = port
-        self.reader = None
-        self.writer = None
-
-    async def __aenter__(self):
-        '''
-        Description: Function to enter and connect with the server
-        '''
-        try:
-            self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
-        except Exception as e:
-            print(e)
-            sys.exit()
-
-    async def send(self, data):
-        '''
-        Description: Function to send data to the server
-        '''
-        datatoSend = dill.dumps(data)
-        header = struct.pack('!I', len(datatoSend))
-        self.writer.write(header + datatoSend)
-
-    async def receive(self):
-        '''
-        Description: Function to receive data from the server
-        '''
-        try:
-            header = await self.reader.readexactly(4)
-            length = struct.unpack('!I', header)[0]
-
-            data = await self.reader.readexactly(length)
-            message = dill.loads(data)
-            if not message.command in [CREATE, UPDATE, REPLICATEFILE, GIVEFILE, NEWFOLDER, RENAME, QUIT, INVALID, DEL]:
-                return message
-        except (asyncio.CancelledError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionResetError) as e:
-            print(e)
-
-    async def __aexit__(self, *args, **kwargs):
-        '''
-        Description: Loop to run upon closing the server
-        '''
-        self.writer.transport.close()
-        #print('Exiting')
-
+IP, PORT, TEMP, CODEC = None, None, None, 'binary'
 
 class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
 
     def __init__(self):
         super(Browser, self).__init__()
         self.loop = asyncio.get_event_loop()
-        self.client = Client(IP, PORT)
+        self.client = Client(IP, PORT, CODEC)
+        #connections to the other servers files were found on
+        self.clients = {(IP, PORT): self.client}
+        #copies of the files opened before
+        self.cache = FileCache(os.path.join(TEMP, 'cache'))
         self.Fs = self.getFs()
+        self.names = NameIndex(self.Fs)
         self.setupUi(self)
         self.treeWidget.setContextMenuPolicy(QtCore.Qt.CustomContextMenu)
         self.treeWidget.customContextMenuRequested.connect(self.contextMenu)
@@ -91,7 +42,7 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         Description: Checks if nay files in temp folder not sent to
         server. Sends file to server.
         '''
-        onlyfiles = [f for f in os.listdir('temp/') if os.path.isfile(os.path.join('temp/', f))]
+        onlyfiles = [f for f in os.listdir('temp/') if os.path.isfile(os.path.join('temp/', f)) and not f.endswith('.part')]
         if len(onlyfiles) > 0:
             for file in onlyfiles:
                 await self.__saveFileOnClose(file,0)
@@ -108,14 +59,12 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         Description: Refreshes the client after every 5 secs to ensure
         the single system image requirement.
         '''
-        async with self.client:
-            data = CommandObject(FS)
-            await self.client.send(data)
-            message = await self.client.receive()
-            if message.command == FS:
-                self.Fs = message.data
-                self.treeWidget.clear()
-                self.populate()
+        data = CommandObject(FS)
+        message = await self.client.request(data)
+        if message.command == FS:
+            self.Fs = message.data
+            self.treeWidget.clear()
+            self.populate()
 
 
     def closeEvent(self, event):
@@ -130,11 +79,12 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         command to the server, then kill all the child processes and
         quit the app
         '''
-        async with self.client:
-            data = CommandObject(QUIT)
-            await self.client.send(data)
-            for process in self.processes:
-                process.kill()
+        data = CommandObject(QUIT)
+        await self.client.send(data)
+        for client in self.clients.values():
+            await client.close()
+        for process in self.processes:
+            process.kill()
 
     def populate(self):
         '''
@@ -168,11 +118,9 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         Description: Connect to Client. Ask for Fs.
         Return FS
         '''
-        async with self.client:
-            data = CommandObject(FS)
-            await self.client.send(data)
-            message = await self.client.receive()
-            return message.data if message.command == FS else None
+        data = CommandObject(FS)
+        message = await self.client.request(data)
+        return message.data if message.command == FS else None
 
 
     def contextMenu(self):
@@ -254,13 +202,8 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
             parent.setDisabled(False)
 
         #check name
-        if name in self.Fs.keys():
-            i = 1
-            temp = name.rsplit('.',1)
-            name = '{}({}).{}'.format(temp[0],i,temp[1])
-            while name in self.Fs.keys():
-                i += 1
-                name = '{}({}).{}'.format(temp[0],i,temp[1])
+        self.names.use(self.Fs)
+        name = self.names.allocate(name)
 
         #update FS
         self.Fs[name] = {'Type' : type, 'Parent': parent.text(0)}
@@ -274,22 +217,18 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
             await self.__NewFsSave(name)
 
         elif command == 'newfolder':
-            async with self.client:
-                await self.client.send(CommandObject(NEWFOLDER , {name : self.Fs[name]}))
-                message = await self.client.receive()
-                if message.command == FS:
-                    self.Fs = message.data
-                    self.treeWidget.clear()
-                    self.populate()
+            message = await self.client.request(CommandObject(NEWFOLDER , {name : self.Fs[name]}))
+            if message.command == FS:
+                self.Fs = message.data
+                self.treeWidget.clear()
+                self.populate()
 
         elif command == 'rename':
-            async with self.client:
-                await self.client.send(CommandObject(RENAME, {'old': oldName, 'new' : name}))
-                message = await self.client.receive()
-                if message.command == FS:
-                    self.Fs = message.data
-                    self.treeWidget.clear()
-                    self.populate()
+            message = await self.client.request(CommandObject(RENAME, {'old': oldName, 'new' : name}))
+            if message.command == FS:
+                self.Fs = message.data
+                self.treeWidget.clear()
+                self.populate()
 
 
 
@@ -334,15 +273,13 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         Waits for reply and updates the current client Fs
         '''
         #send addition to fs
-        async with self.client:
-            await self.client.send(CommandObject(CREATE, {name : self.Fs[name]}))
-            message = await self.client.receive()
-            if message.command == FS:
-                self.Fs = message.data
-                self.treeWidget.clear()
-                self.populate()
-            else:
-                print('Error')
+        message = await self.client.request(CommandObject(CREATE, {name : self.Fs[name]}))
+        if message.command == FS:
+            self.Fs = message.data
+            self.treeWidget.clear()
+            self.populate()
+        else:
+            print('Error')
 
 
     def saveFileOnClose(self, name, exitStatus):
@@ -359,18 +296,21 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
 
         if exitStatus == 0 and os.path.isfile(TEMP+'/'+name):
             #properly shutdown and check if file exists
-            with open(TEMP+'/'+name, 'r') as f:
-                data = f.read()
-                #send file contents to server
-                async with self.client:
-                    await self.client.send(CommandObject(FILE, {name : data}))
-                    #wait for success and delete file from the client end.
-                    message = await self.client.receive()
-                    if message.command == SUCCESS:
-                        os.remove(TEMP+'/'+name)
-                    elif message.command == ERROR:
-                        await self.__NewFsSave(name)
-                        await self.client.send(CommandObject(FILE, {name : data}))
+            with open(TEMP+'/'+name, 'rb') as f:
+                #stream file contents to server
+                message = await self.client.sendFile(name, f)
+                #wait for success and delete file from the client end.
+                #the file is not in the FS, a write concern error has data
+                if message.command == ERROR and message.data == None:
+                    await self.__NewFsSave(name)
+                    f.seek(0)
+                    message = await self.client.sendFile(name, f)
+            if message.command == SUCCESS:
+                #the copy saved is the latest version, UPDATE made it when
+                #the file was opened, so opening it again needs no download
+                if isinstance(self.Fs.get(name), list):
+                    self.cache.add(name, len(self.Fs[name]) - 1, bodyTag(TEMP+'/'+name), TEMP+'/'+name)
+                os.remove(TEMP+'/'+name)
 
     def openFile(self):
         '''
@@ -390,48 +330,81 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         name = item.text(0)
 
         #send request to server for file and wait for answer
-        data = CommandObject(GIVEFILE, name)
-        async with self.client:
-            await self.client.send(data)
-
-            message = await self.client.receive()
-            #if proper command received
-            if message.command == FILE:
-                await self.startFile(name, message.data)
-
-            elif message.command == CONN:
-            #connect to a different client and send the file
-                new_client = Client(message.data['IP'], int(message.data['PORT']))
-                async with new_client:
-                    await new_client.send(CommandObject(GIVEFILE, name))
-                    file = await new_client.receive()
-                    if file.command == FILE:
-                        #FIGURE THIS OUT
-                        await self.startFile(name, message.data)
-            else:
-                print('File Cannot Open')
-                return
-
-
-    async def startFile(self, name, data):
-        '''
-        Description: Save the file in the temp folder.
+        message = await self.download(self.client, name)
+
+        #a server without the file sends the client on to one that
+        #has it, at most a few times
+        for _ in range(3):
+            if not message.command == CONN:
+                break
+            #ask the other server for the file, its connection is kept
+            new_client = self.getClient(message.data['IP'], int(message.data['PORT']))
+            message = await self.download(new_client, name)
+
+        #if proper command received
+        if message.command in [FILEEND, NOTMODIFIED]:
+            await self.startFile(name)
+        else:
+            print('File Cannot Open')
+            return
+
+    async def download(self, client, name):
+        '''
+        Description: Streams a file from a server into the temp folder.
+        If the cache has the latest version of the file it is copied
+        from there instead. Returns the last reply of the server.
+        '''
+        path = '{}/{}'.format(TEMP, name)
+        data = {'Name': name, 'Stream': True}
+        cached = self.cache.lookup(name)
+        if not cached == None:
+            data['IfNotVersion'] = cached['Version']
+            data['IfNotTag'] = cached['Tag']
+        start = None
+        f = None
+        try:
+            async for message in client.stream(CommandObject(GIVEFILE, data)):
+                if message.command == FILESTART:
+                    start = message.data
+                    f = open(path + '.part', 'wb')
+                elif message.command == FILECHUNK:
+                    f.write(message.data['Data'])
+        finally:
+            if not f == None:
+                f.close()
+        if message.command == NOTMODIFIED:
+            self.cache.copyTo(name, path)
+        elif message.command == FILEEND:
+            os.replace(path + '.part', path)
+            if not start.get('Tag') == None:
+                self.cache.add(name, start['Version'], start['Tag'], path)
+        elif not f == None:
+            os.remove(path + '.part')
+        return message
+
+    def getClient(self, ip, port):
+        '''
+        Description: Returns the connection to a server, made the
+        first time it is needed.
+        '''
+        if not (ip, port) in self.clients.keys():
+            self.clients[(ip, port)] = Client(ip, port, CODEC)
+        return self.clients[(ip, port)]
+
+
+    async def startFile(self, name):
+        '''
+        Description: Open the file saved in the temp folder.
         Make a new process, open the file
         '''
-        #save the file in temp folder
         args = "gedit {}/{}".format(TEMP, name)
-        try:
-            with open('{}/{}'.format(TEMP,name), 'w+') as f:
-                f.write(data)
-        except IOError as e:
-            print(e)
         #open the file
         process = QtCore.QProcess(self)
         process.finished.connect(functools.partial(self.saveFileOnClose, name))
         process.start(args)
         self.processes.append(process)
         #send the update command
-        await sendUpdate(name)
+        await self.sendUpdate(name)
 
 
     async def sendUpdate(self, name):
@@ -440,8 +413,7 @@ class Browser(main.Ui_MainWindow,QtWidgets.QMainWindow):
         update the FS.
         '''
         data = CommandObject(UPDATE, name)
-        await self.client.send(data)
-        message = await self.client.receive()
+        message = await self.client.request(data)
         if message.command == FS:
             self.Fs = message.data
             self.treeWidget.clear()
@@ -460,11 +432,12 @@ def boot(config):
             IP = data['host'] if 'host' in data else ''
             PORT = data['port'] if 'port' in data else ''
             temp = data['root'] if 'root' in data else ''
+            codec = data['codec'] if 'codec' in data else 'binary'
             #make temp folder
             if not os.path.isdir(temp):
                 os.mkdir(temp)
             f.close()
-            return (IP, PORT, temp)
+            return (IP, PORT, temp, codec)
 
     except OSError as e:
         #error in open
@@ -477,14 +450,14 @@ def boot(config):
         print('Boot Error: {}'.format(e))
         f = open(config, 'w+')
         f.close()
-    return (None, None, None)
+    return (None, None, None, None)
 
 if __name__ == '__main__':
 
     #read from file
     config = 'clientconfig.txt'
 
-    IP, PORT, TEMP = boot(config)
+    IP, PORT, TEMP, CODEC = boot(config)
 
     if None in [IP, PORT, TEMP]:
         print('Error in Boot. Reconfigure')
@@ -0,0 +1,294 @@
+'''
+Binary codec for CommandObject frames.
+
+Wire format of a frame body (the 4 byte length comes before it).
+The first byte is the version. dill pickles start with 0x80, so frames
+from servers and clients still on dill are told apart and decoded
+with dill during the transition. Unpickling runs code the sender
+chooses, so once every node sends binary dill frames are rejected
+with allowDill off (the acceptDill setting of the server).
+
+version 1:
+    version   1 byte
+    command   1 byte
+    flags     1 byte    bit 0: reply, bit 1: id follows
+    id        8 bytes   only if flag bit 1
+    data      value
+
+A value is a 1 byte tag followed by:
+    NONE, TRUE, FALSE     nothing
+    BYTE                  1 byte unsigned
+    INT                   8 byte signed
+    BIGINT                STR of the decimal digits
+    FLOAT                 8 byte double
+    STR, SHORTSTR         4 or 1 byte length, utf-8, the string is numbered
+    REF, SHORTREF         4 or 2 byte number of a string already in the frame
+    BYTES                 4 byte length, raw bytes
+    LIST, SHORTLIST       4 or 1 byte count, values
+    DICT, SHORTDICT       4 or 1 byte count, key value pairs
+Only these plain types can be decoded, never code or objects.
+'''
+import struct
+import dill
+
+from protocol import *
+
+VERSION = 1
+DILL_VERSION = 0x80
+
+NONE, TRUE, FALSE, INT, BIGINT, FLOAT, STR, REF, BYTES, LIST, DICT, BYTE, SHORTSTR, SHORTREF, SHORTLIST, SHORTDICT = range(16)
+
+#bytes at least this long are sent and received without a copy
+ZERO_COPY = 4096
+
+#type of data every command can carry
+SCHEMA = {
+    CREATE: (dict,),
+    UPDATE: (str,),
+    FS: (type(None), dict),
+    FILE: (dict, str),
+    REPLICATEFILE: (dict,),
+    GIVEFILE: (str, dict),
+    NEWFOLDER: (dict,),
+    RENAME: (dict,),
+    QUIT: (type(None),),
+    ERROR: (type(None), str, dict),
+    SUCCESS: (type(None), str, dict),
+    CONN: (dict,),
+    INVALID: (type(None), str, dict),
+    DEL: (str,),
+    DELTA: (dict,),
+    SYNC: (dict,),
+    FILESTART: (dict,),
+    FILECHUNK: (dict,),
+    FILEEND: (type(None), dict),
+    CHUNKS: (dict,),
+    GIVECHUNKS: (dict,),
+    CHUNKDATA: (dict,),
+    NOTMODIFIED: (dict,),
+    ACK: (dict,),
+    DIGEST: (dict,),
+    HELLO: (dict,),
+    PING: (dict,),
+    PONG: (dict,),
+    STATS: (type(None), dict),
+    BATCH: (dict,),
+}
+
+HEADER = struct.Struct('!BBB')
+ID = struct.Struct('!Q')
+LENGTH = struct.Struct('!I')
+SHORT = struct.Struct('!H')
+INTEGER = struct.Struct('!q')
+DOUBLE = struct.Struct('!d')
+
+def encode(command, codec='binary'):
+    '''
+    Description: Encodes a command object. Returns a list of buffers
+    that make up the frame body. Large byte strings are passed on as
+    they are instead of being copied into the frame.
+    '''
+    if codec == 'dill':
+        return [dill.dumps(plain(command))]
+
+    out = bytearray()
+    parts = []
+    strings = {}
+
+    def value(v):
+        nonlocal out
+        t = type(v)
+        if t is str:
+            index = strings.get(v)
+            if index is None:
+                strings[v] = len(strings)
+                b = v.encode('utf-8')
+                if len(b) < 256:
+                    out.append(SHORTSTR)
+                    out.append(len(b))
+                else:
+                    out.append(STR)
+                    out += LENGTH.pack(len(b))
+                out += b
+            elif index < 65536:
+                out.append(SHORTREF)
+                out += SHORT.pack(index)
+            else:
+                out.append(REF)
+                out += LENGTH.pack(index)
+        elif t is dict:
+            if len(v) < 256:
+                out.append(SHORTDICT)
+                out.append(len(v))
+            else:
+                out.append(DICT)
+                out += LENGTH.pack(len(v))
+            for key, item in v.items():
+                value(key)
+                value(item)
+        elif t is list or t is tuple:
+            if len(v) < 256:
+                out.append(SHORTLIST)
+                out.append(len(v))
+            else:
+                out.append(LIST)
+                out += LENGTH.pack(len(v))
+            for item in v:
+                value(item)
+        elif v is None:
+            out.append(NONE)
+        elif t is bool:
+            out.append(TRUE if v else FALSE)
+        elif t is int:
+            if 0 <= v < 256:
+                out.append(BYTE)
+                out.append(v)
+            elif -0x8000000000000000 <= v <= 0x7fffffffffffffff:
+                out.append(INT)
+                out += INTEGER.pack(v)
+            else:
+                out.append(BIGINT)
+                value(str(v))
+        elif t is float:
+            out.append(FLOAT)
+            out += DOUBLE.pack(v)
+        elif t is bytes or t is bytearray or t is memoryview:
+            out.append(BYTES)
+            out += LENGTH.pack(len(v))
+            if len(v) >= ZERO_COPY:
+                parts.append(out)
+                parts.append(v)
+                out = bytearray()
+            else:
+                out += v
+        elif t is set:
+            value(list(v))
+        else:
+            raise TypeError('Cannot encode {}'.format(t))
+
+    flags = (1 if command.reply else 0) | (2 if not command.id == None else 0)
+    out += HEADER.pack(VERSION, command.command, flags)
+    if not command.id == None:
+        out += ID.pack(command.id)
+    value(command.data)
+    parts.append(out)
+    return parts
+
+def decode(data, factory, allowDill=True):
+    '''
+    Description: Decodes a frame body into a command object made
+    with factory(command, data, id, reply). Byte strings in the data
+    are memoryviews of the frame, not copies.
+    '''
+    if len(data) == 0:
+        raise ValueError('Empty frame')
+    if data[0] == DILL_VERSION and not allowDill:
+        raise ValueError('dill frames are not accepted')
+    if data[0] == DILL_VERSION:
+        message = dill.loads(data)
+        return factory(message.command, message.data, getattr(message, 'id', None),
+                       getattr(message, 'reply', False))
+    if not data[0] == VERSION:
+        raise ValueError('Unknown frame version {}'.format(data[0]))
+
+    buf = memoryview(data)
+    strings = []
+    pos = 0
+
+    def value():
+        nonlocal pos
+        tag = buf[pos]
+        pos += 1
+        if tag == SHORTSTR:
+            n = buf[pos]
+            pos += 1
+            v = str(buf[pos:pos + n], 'utf-8')
+            pos += n
+            strings.append(v)
+            return v
+        if tag == SHORTREF:
+            index = SHORT.unpack_from(buf, pos)[0]
+            pos += 2
+            return strings[index]
+        if tag == SHORTDICT:
+            n = buf[pos]
+            pos += 1
+            v = {}
+            for _ in range(n):
+                key = value()
+                v[key] = value()
+            return v
+        if tag == SHORTLIST:
+            n = buf[pos]
+            pos += 1
+            return [value() for _ in range(n)]
+        if tag == BYTE:
+            pos += 1
+            return buf[pos - 1]
+        if tag == STR:
+            n = LENGTH.unpack_from(buf, pos)[0]
+            pos += 4
+            v = str(buf[pos:pos + n], 'utf-8')
+            pos += n
+            strings.append(v)
+            return v
+        if tag == REF:
+            index = LENGTH.unpack_from(buf, pos)[0]
+            pos += 4
+            return strings[index]
+        if tag == DICT:
+            n = LENGTH.unpack_from(buf, pos)[0]
+            pos += 4
+            v = {}
+            for _ in range(n):
+                key = value()
+                v[key] = value()
+            return v
+        if tag == LIST:
+            n = LENGTH.unpack_from(buf, pos)[0]
+            pos += 4
+            return [value() for _ in range(n)]
+        if tag == INT:
+            v = INTEGER.unpack_from(buf, pos)[0]
+            pos += 8
+            return v
+        if tag == NONE:
+            return None
+        if tag == TRUE:
+            return True
+        if tag == FALSE:
+            return False
+        if tag == BIGINT:
+            return int(value())
+        if tag == FLOAT:
+            v = DOUBLE.unpack_from(buf, pos)[0]
+            pos += 8
+            return v
+        if tag == BYTES:
+            n = LENGTH.unpack_from(buf, pos)[0]
+            pos += 4
+            v = buf[pos:pos + n]
+            pos += n
+            return v if n >= ZERO_COPY else bytes(v)
+        raise ValueError('Unknown tag {}'.format(tag))
+
+    version, command, flags = HEADER.unpack_from(buf, 0)
+    pos = HEADER.size
+    id = None
+    if flags & 2:
+        id = ID.unpack_from(buf, pos)[0]
+        pos += ID.size
+    payload = value()
+    if command in SCHEMA.keys() and not isinstance(payload, SCHEMA[command]):
+        raise ValueError('Bad data for command {}'.format(command))
+    return factory(command, payload, id, bool(flags & 1))
+
+def plain(command):
+    '''
+    Description: Copy of a command dill can pickle. Chunks received
+    without a copy are memoryviews, which dill cannot pickle.
+    '''
+    data = command.data
+    if isinstance(data, dict) and any(isinstance(v, memoryview) for v in data.values()):
+        data = {key: bytes(v) if isinstance(v, memoryview) else v for key, v in data.items()}
+    return CommandObject(command.command, data, command.id, command.reply)
@@ -1,20 +1,27 @@
 import queue
 import struct
+import itertools
+import functools
 import asyncio
-import dill
+import time
 import json, os
 
 import settings as s
 import services as sr
+from protocol import *
+import codec
+import diskio
+import metrics
+from session import Client
 
-CREATE, UPDATE, FS, FILE, REPLICATEFILE, GIVEFILE, NEWFOLDER, RENAME, QUIT, ERROR, SUCCESS, CONN, INVALID, DEL = range(14)
-
-class CommandObject(object):
-    '''A command object to pass. It ensures security'''
-
-    def __init__(self, command, data=None):
-        self.command = command
-        self.data = data
+def fileName(data):
+    '''
+    Description: Name of the file asked for by GIVEFILE. Older clients
+    send just the name.
+    '''
+    if isinstance(data, dict):
+        return data['Name']
+    return data
 
 class Connection():
     '''
@@ -23,20 +30,168 @@ class Connection():
     def __init__(self, reader, writer):
         self.reader = reader
         self.writer = writer
-        self.msg_q = asyncio.Queue()
-        self.write_q = asyncio.Queue()
+        #bounded, a slow sender or receiver holds up the other side
+        #instead of the server buffering without limit
+        self.msg_q = asyncio.Queue(s.MSG_QUEUE)
+        self.write_q = asyncio.Queue(s.WRITE_QUEUE)
+        #drain() waits once HIGH_WATER bytes are buffered, until LOW_WATER
+        self.writer.transport.set_write_buffer_limits(high=s.HIGH_WATER, low=s.LOW_WATER)
+        self.counters = {'Frames': 0, 'Writes': 0, 'Bytes': 0, 'Dropped': 0, 'FramesIn': 0, 'BytesIn': 0}
         self.readTask = asyncio.create_task(self.read())
         self.handleTask = asyncio.create_task(self.handle())
         self.writeTask = asyncio.create_task(self.write())
         self.local_server = '{}/{}'.format(s.HOST,s.PORT)
-
+        self.codec = s.CODEC
+        #files being streamed to this server: {xfer: queue of chunks}
+        self.transfers = {}
+        #tasks saving the chunks of the transfers: {xfer: task}
+        self.spools = {}
+        #ids of the files this server streams on the connection
+        self.xferIds = itertools.count(1)
+        #requests sent to the server on the other side: {id: reply future}
+        self.pending = {}
+        self.requestIds = itertools.count(1)
+        #versions a replica is getting chunks for: {ack: missing chunks}
+        self.chunkAcks = {}
+        addr = writer.get_extra_info('peername')
+        self.address = '{}/{}'.format(addr[0], addr[1])
+        #name of the server on the other side, None for clients
+        self.node = None
+        self.closed = False
+        #commands running in their own task, cancelled with the connection
+        self.tasks = set()
+        #last change sent to the server on the other side in a DELTA,
+        #and the task sending what a dropped DELTA had
+        self.delivered = s.SEQ
+        self.behind = False
+        self.resyncTask = None
 
     async def sendFs(self):
         '''
         Description: Function to send initial FS on load.
+        The digest of the FS is sent, the other server sends back
+        the parts of its FS that differ.
         Only between servers
         '''
-        await self.write_q.put(CommandObject(FS))
+        await self.write_q.put(CommandObject(DIGEST, s.DIGEST.summary()))
+
+    async def reply(self, request, command):
+        '''
+        Description: Sends the reply to a request. The reply carries
+        the id of the request so the sender can match it. Nothing is
+        sent once the connection is closed.
+        '''
+        if self.closed:
+            return
+        command.id = request.id
+        command.reply = True
+        await self.write_q.put(command)
+
+    async def send(self, command):
+        '''
+        Description: Queues a command, False if the connection is closed
+        '''
+        if self.closed:
+            return False
+        await self.write_q.put(command)
+        return not self.closed
+
+    async def request(self, command):
+        '''
+        Description: Sends a request to the server on the other side and
+        waits for its reply, None if the connection ends first. Used
+        instead of a client connection when the request has to come
+        after the DELTAs sent on this connection.
+        '''
+        command.id = next(self.requestIds)
+        reply = asyncio.get_event_loop().create_future()
+        self.pending[command.id] = reply
+        try:
+            if not await self.send(command):
+                return None
+            return await reply
+        finally:
+            self.pending.pop(command.id, None)
+
+    def push(self, command):
+        '''
+        Description: Queues a command without waiting. If the queue is
+        full the command is dropped. Used for DELTA, a server that
+        misses one sends a SYNC when the next one comes. If no other
+        change comes it would stay behind, so the changes of a dropped
+        DELTA are sent again once there is room, as for a SYNC.
+        '''
+        try:
+            self.write_q.put_nowait(command)
+            if command.command == DELTA and not self.behind and len(command.data.get('Changes', [])) > 0:
+                self.delivered = command.data['Changes'][-1]['Seq']
+            return True
+        except asyncio.QueueFull:
+            self.counters['Dropped'] += 1
+            if command.command == DELTA:
+                self.behind = True
+                if self.resyncTask == None:
+                    self.resyncTask = asyncio.ensure_future(self.resync())
+            return False
+
+    async def resync(self):
+        try:
+            #DELTAs dropped while waiting for room are sent in the next round
+            while self.behind:
+                self.behind = False
+                since = self.delivered
+                self.delivered = s.SEQ
+                await self.sendSince(s.EPOCH, since)
+        except Exception as e:
+            print('Resync Error: {}'.format(e))
+        finally:
+            self.resyncTask = None
+
+    async def sendSince(self, epoch, since):
+        '''
+        Description: Sends the changes of this server after since. The
+        full FS and a reset are sent if the change log does not go back
+        that far, with the last change applied from the other server so
+        it knows which of its names this server has seen.
+        '''
+        since = since if epoch == s.EPOCH else 0
+        changes = sr.changesSince(since)
+        if not changes == None:
+            await self.write_q.put(CommandObject(DELTA, {'Origin': self.local_server,
+                                                         'Epoch': s.EPOCH,
+                                                         'Changes': changes}))
+        else:
+            await self.write_q.put(CommandObject(DIGEST, {'Names': s.FILES,
+                                                          'Removed': list(sr.removedNames()),
+                                                          'Full': True,
+                                                          'Applied': s.APPLIED.get(self.node)}))
+            await self.write_q.put(CommandObject(DELTA, {'Origin': self.local_server,
+                                                         'Epoch': s.EPOCH,
+                                                         'Reset': s.SEQ}))
+
+    def queueStats(self):
+        '''
+        Description: Depth of the queues, bytes waiting to be sent and
+        frames and bytes sent and read on the connection
+        '''
+        return {'MsgQueue': self.msg_q.qsize(),
+                'WriteQueue': self.write_q.qsize(),
+                'Buffered': self.writer.transport.get_write_buffer_size(),
+                'Frames': self.counters['Frames'],
+                'Writes': self.counters['Writes'],
+                'Bytes': self.counters['Bytes'],
+                'Dropped': self.counters['Dropped'],
+                'FramesIn': self.counters['FramesIn'],
+                'BytesIn': self.counters['BytesIn'],
+                'Peer': not self.node == None}
+
+    async def sendChanges(self, *changes):
+        '''
+        Description: Sends the change records of local mutations
+        to all the other servers instead of the whole FS. They are
+        sent with the other changes of the broadcast window.
+        '''
+        s.BROADCAST.notify(len(changes))
 
     async def read(self):
         '''
@@ -49,24 +204,96 @@ class Connection():
                 length = struct.unpack('!I', header)[0]
 
                 data = await self.reader.readexactly(length)
-                message = dill.loads(data)
-                print(message.command)
+                self.counters['FramesIn'] += 1
+                self.counters['BytesIn'] += length + 4
+                try:
+                    message = codec.decode(data, CommandObject, s.ACCEPT_DILL)
+                    #answer in the codec the other side uses
+                    self.codec = 'dill' if data[0] == codec.DILL_VERSION else 'binary'
+                    if not self.node == None:
+                        s.PEERS.seen(self.node)
+                    if self.answer(message):
+                        continue
+                except Exception as e:
+                    #bad frame, the next one can still be read
+                    print('Invalid message: {}'.format(e))
+                    await self.write_q.put(CommandObject(INVALID))
+                    continue
+                #a write waiting for the ACK may be the command holding
+                #up this connection, the chunks it needs are sent from here
+                if message.command == GIVECHUNKS:
+                    message.received = time.perf_counter()
+                    task = asyncio.ensure_future(self.work(message))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    continue
+                #chunks go to their transfer from here, never behind a
+                #command waiting for a lock or a worker
+                if message.command in [FILECHUNK, FILEEND]:
+                    await self.toTransfer(message)
+                    continue
+                if message.command == FILESTART and isinstance(message.data, dict) and 'Xfer' in message.data.keys():
+                    xfer = message.data['Xfer']
+                    self.transfers[xfer] = asyncio.Queue(s.TRANSFER_QUEUE)
+                    task = asyncio.ensure_future(self.spool(xfer))
+                    self.spools[xfer] = task
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                message.received = time.perf_counter()
                 await self.msg_q.put(message)
-            except (asyncio.CancelledError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionResetError) as e:
+            except (asyncio.CancelledError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError) as e:
                 await self.endConnection()
                 break
 
+    def answer(self, message):
+        '''
+        Description: Handles the messages read() does not queue, the
+        replies to requests, ACKs and heartbeats. Returns True if the
+        message was one of them.
+        '''
+        if message.reply and message.id in self.pending.keys():
+            if not self.pending[message.id].done():
+                self.pending[message.id].set_result(message)
+            return True
+        #a write waiting for the ACK holds a worker and a lock,
+        #it is never put behind commands that may wait for them
+        if message.command == ACK:
+            s.REPLICATOR.acked(message.data['Ack'])
+            return True
+        #heartbeats are answered here, not behind the commands
+        #waiting in the queue
+        if message.command == PING:
+            self.push(CommandObject(PONG, message.data))
+            return True
+        if message.command == PONG:
+            if not self.node == None:
+                s.PEERS.pong(self.node, message.data)
+            return True
+        return False
+
     async def write(self):
         '''
         Description: Writes to the reader object after
-        picking up from the queue
+        picking up from the queue. Every message already queued is
+        sent in one write, up to WRITE_BATCH messages, then waits
+        for the buffer to drain below the low water mark.
         '''
         while True:
             try:
-                command = await self.write_q.get()
-                data = dill.dumps(command)
-                header = struct.pack('!I', len(data))
-                self.writer.write(header + data)
+                batch = [await self.write_q.get()]
+                while len(batch) < s.WRITE_BATCH and not self.write_q.empty():
+                    batch.append(self.write_q.get_nowait())
+                buffers = []
+                for command in batch:
+                    parts = codec.encode(command, self.codec)
+                    length = sum(len(part) for part in parts)
+                    buffers.append(struct.pack('!I', length))
+                    buffers.extend(parts)
+                    self.counters['Bytes'] += length + 4
+                self.writer.writelines(buffers)
+                self.counters['Frames'] += len(batch)
+                self.counters['Writes'] += 1
+                await self.writer.drain()
             except asyncio.CancelledError as e:
                 print(e)
                 break
@@ -77,313 +304,1034 @@ class Connection():
 
     async def handle(self):
         '''
-        Description: Picks each command up. Handles the command
-        saves the result either error or success in the message queue
+        Description: Picks each command up and runs it. Commands on file
+        bodies (FILE, REPLICATEFILE, GIVEFILE, FILESTART) run
+        in their own task, which waits for a place in the worker pool of
+        the server, so a slow transfer does not hold up the rest of the
+        connection. Every other command runs in order on the connection.
+        The chunks of a FILESTART are saved by spool() as read() gets
+        them, read() also runs GIVECHUNKS in its own task.
+
+        Ordering: the names a command touches are locked before it runs,
+        in the order the commands were received.
+        - CREATE, NEWFOLDER, FS, HELLO, DIGEST, DELTA, SYNC, QUIT, CHUNKS, CHUNKDATA: run
+          one after the other in the order they arrived on the connection.
+        - UPDATE, RENAME, DEL, FILE, REPLICATEFILE, FILESTART: lock their
+          name(s), they wait for every earlier command on the same name.
+        - BATCH: locks the names of its UPDATE, RENAME and FILE operations
+          and runs in order on the connection.
+          The chunks of a FILESTART are written in the order received.
+        - GIVEFILE: shares the lock with other reads of the same file,
+          runs after earlier writes of the file and before later ones.
+        Commands on different files run in parallel.
         '''
         while True:
             command = await self.msg_q.get()
+            try:
+                names, shared = self.lockNames(command)
+            except (KeyError, TypeError, AttributeError) as e:
+                if command.command == FILESTART and isinstance(command.data, dict):
+                    self.endTransfer(command.data.get('Xfer'), None)
+                await self.reply(command, CommandObject(INVALID, {'Reason': str(e)}))
+                continue
+            await s.LOCKS.acquire(names, shared)
+            if command.command in [FILE, REPLICATEFILE, GIVEFILE, FILESTART]:
+                task = asyncio.ensure_future(self.work(command, worker=True))
+                #given back however the task ends, even cancelled before it ran
+                task.add_done_callback(functools.partial(self.unlock, names, shared))
+                self.tasks.add(task)
+                task.add_done_callback(self.tasks.discard)
+                if command.command == FILESTART:
+                    task.add_done_callback(functools.partial(self.endTransfer, command.data['Xfer']))
+            else:
+                try:
+                    await self.work(command)
+                finally:
+                    s.LOCKS.release(names, shared)
 
-            if command.command == CREATE:
-                '''
-                CREATE COMMAND:
-                File will be saved on the current node. Node to replicate on
-                will be figured out from the node which has the least number of
-                files saved. The node replication is the majority of the
-                participating servers.
-                '''
-                data = command.data
-                name = list(command.data.keys())[0]
-                #find node to save on
-                #check if file exists already or not.
-                #if exists create a new name for it
-                new_name = sr.checkName(name)
-
-                node = sr.NodeToSaveOn()
-                if not node == None:
-                    print(node)
-                    data[name]['Node'] = node
-                    data[name]['Path'] = 'files/{}'.format(name)
-                    data[name]['Version'] = 0
-                    #find node to replicate on
-                    nodesForReplication = sr.replicate(node)
-                    print(nodesForReplication)
-                    #if some node found
-                    if not nodesForReplication == None:
-                        #save the Also of the data
-                        data[name]['Also'] = list(nodesForReplication)
-
-                    #update the FS
-                    s.FILES[new_name] = [data[name]]
-                    #send an update to all servers
-                    for name in s.SERVERS.keys():
-                        if not name == self.local_server and name in s.CONNECTIONS.keys():
-                            print(name)
-                            print(s.FILES)
-                            await s.CONNECTIONS[name].write_q.put(CommandObject(FS, s.FILES))
-
-                    #make an update in the local file
-                    await self.updateFileFile()
-                    #send an update to client
-                    await self.write_q.put(CommandObject(FS, s.FILES))
-
-            if command.command == UPDATE:
-                '''
-                UPDATE COMMAND:
-                Updates the FS with the correct versioning and addes a new
-                script to the Fs.
-                '''
-                name = command.data
-                #update in list
-                if name in s.FILES.keys():
-                    #grab the last entry:
-                    fileInfo = s.FILES[name][-1]
-                    #add the new entry
-                    newEntry = {'Type':'F',
-                                'Parent':fileInfo['Parent'],
-                                'Version': len(s.FILES[name]),
-                                'Node':fileInfo['Node'],
-                                'Also':fileInfo['Also'], 'Path': 'files/{}{}'.format(len(s.FILES[name]), name)}
-
-                    s.FILES[name].append(newEntry)
+    def unlock(self, names, shared, task):
+        s.LOCKS.release(names, shared)
 
-                #make an update in the local file
-                await self.updateFileFile()
+    def endTransfer(self, xfer, task):
+        '''
+        Description: Forgets a transfer once its task is over, chunks
+        still coming for it are dropped. The chunks of a transfer that
+        never ran are let go.
+        '''
+        spool = self.spools.pop(xfer, None)
+        if spool == None:
+            return
+        if not spool.done():
+            spool.cancel()
+        elif not spool.cancelled() and spool.exception() == None:
+            spool.result()[0].release(keep=False)
+
+    async def toTransfer(self, message):
+        '''
+        Description: Hands a chunk to the transfer it belongs to. Waits
+        while TRANSFER_QUEUE chunks of the transfer are not saved yet.
+        '''
+        xfer = message.data.get('Xfer') if isinstance(message.data, dict) else None
+        if not xfer in self.transfers.keys():
+            return
+        await self.transfers[xfer].put(message)
+
+    async def spool(self, xfer):
+        '''
+        Description: Saves the chunks of a transfer in the chunk store as
+        they come, without waiting for the lock of the file or a worker,
+        so a transfer holds at most TRANSFER_QUEUE chunks in memory and
+        never holds up the others on the connection. Reads to FILEEND
+        even after an error. Returns the writer with the chunks pinned,
+        if they were all saved and the FILEEND.
+        '''
+        chunks = self.transfers[xfer]
+        writer = s.STORE.writer()
+        ok = True
+        try:
+            while True:
+                message = await chunks.get()
+                if message.command == FILEEND:
+                    break
+                if ok:
+                    try:
+                        await writer.write(message.data['Data'])
+                    except (IOError, OSError) as e:
+                        print(e)
+                        ok = False
+            if ok:
+                try:
+                    await writer.close()
+                except (IOError, OSError) as e:
+                    print(e)
+                    ok = False
+        except BaseException:
+            writer.release(keep=False)
+            raise
+        finally:
+            self.transfers.pop(xfer, None)
+            #a chunk read() is waiting to queue is dropped
+            while not chunks.empty():
+                chunks.get_nowait()
+        return writer, ok, message
+
+    def lockNames(self, command):
+        '''
+        Description: Returns the names a command works on and if their
+        locks can be shared with other commands.
+        '''
+        if command.command in [UPDATE, DEL]:
+            return ([command.data], False)
+        if command.command == RENAME:
+            return ([command.data['old'], command.data['new']], False)
+        if command.command in [FILE, REPLICATEFILE]:
+            return (list(command.data.keys()), False)
+        if command.command == FILESTART:
+            return ([command.data['Name']], False)
+        if command.command == GIVEFILE:
+            return ([fileName(command.data)], True)
+        if command.command == BATCH:
+            names = []
+            for op in command.data.get('Ops', []):
+                #bad operations get an error when the batch runs
+                try:
+                    if op['Command'] == UPDATE:
+                        names.append(str(op['Data']))
+                    elif op['Command'] == RENAME:
+                        names.extend([op['Data']['old'], op['Data']['new']])
+                    elif op['Command'] == FILE:
+                        names.extend(op['Data'].keys())
+                except (KeyError, TypeError, AttributeError):
+                    pass
+            #locked once each
+            return (list(dict.fromkeys(names)), False)
+        return ([], False)
 
-                #send an update to all servers
-                print(s.FILES)
-                for name in s.SERVERS.keys():
-                    if not name == self.local_server and name in s.CONNECTIONS.keys():
-                        print('here')
-                        await s.CONNECTIONS[name].write_q.put(CommandObject(FS, s.FILES))
+    async def work(self, command, worker=False):
+        '''
+        Description: Runs a command, in a place of the worker pool if
+        worker is set. The time it took and the time it waited since it
+        was read are recorded. A request that fails gets an ERROR so the
+        sender does not wait for a reply forever.
+        '''
+        if worker:
+            await s.WORKERS.acquire()
+        start = time.perf_counter()
+        try:
+            await self.process(command)
+        except Exception as e:
+            print('Error in command {}: {}'.format(command.command, e))
+            if not command.reply:
+                await self.reply(command, CommandObject(ERROR, {'Reason': str(e)}))
+        finally:
+            received = getattr(command, 'received', start)
+            s.METRICS.record(command.command, time.perf_counter() - start, start - received)
+            if worker:
+                s.WORKERS.release()
 
+    async def process(self, command):
+        '''
+        Description: Handles the command
+        saves the result either error or success in the message queue
+        '''
+
+        if command.command == CREATE:
+            '''
+            CREATE COMMAND:
+            File will be saved on the current node. The node to save on and
+            the nodes to replicate on are picked by the placement engine.
+            The node replication is the majority of the
+            participating servers.
+            '''
+            data = command.data
+            name = list(command.data.keys())[0]
+            #find node to save on
+            #check if file exists already or not.
+            #if exists create a new name for it
+            new_name = sr.checkName(name)
+
+            node = sr.NodeToSaveOn(new_name)
+            if not node == None:
+                print(node)
+                data[name]['Node'] = node
+                data[name]['Path'] = 'files/{}'.format(new_name)
+                data[name]['Version'] = 0
+                #find node to replicate on
+                nodesForReplication = sr.replicate(node, new_name)
+                print(nodesForReplication)
+                #if some node found
+                if not nodesForReplication == None:
+                    #save the Also of the data
+                    data[name]['Also'] = list(nodesForReplication)
+
+                #update the FS
+                change = sr.makeChange('PUT', new_name, [data[name]])
+                #send the change to all servers
+                await self.sendChanges(change)
+
+                #make an update in the local file
+                await self.updateFileFile(change)
                 #send an update to client
-                await self.write_q.put(CommandObject(FS, s.FILES))
-
-            if command.command == FS:
-                '''
-                FS COMMAND:
-                A command to send or receive nodes to replicate on.
-                If FS command with no data : FS requested.
-                If FS command with data : FS sent by a server
-                Update FS if sent.
-                '''
-                if command.data == None:
-                    #reply with FS
-                    await self.write_q.put(CommandObject(FS, s.FILES))
+                await self.reply(command, CommandObject(FS, s.FILES))
+            else:
+                await self.reply(command, CommandObject(ERROR))
+
+        if command.command == UPDATE:
+            '''
+            UPDATE COMMAND:
+            Updates the FS with the correct versioning and addes a new
+            script to the Fs.
+            '''
+            name = command.data
+            change = None
+            #update in list
+            if name in s.FILES.keys():
+                #grab the last entry:
+                fileInfo = s.FILES[name][-1]
+                #add the new entry
+                newEntry = {'Type':'F',
+                            'Parent':fileInfo['Parent'],
+                            'Version': len(s.FILES[name]),
+                            'Node':fileInfo['Node'],
+                            'Also':fileInfo['Also'], 'Path': 'files/{}{}'.format(len(s.FILES[name]), name)}
+
+                change = sr.makeChange('APPEND', name, newEntry)
+
+            if not change == None:
+                #make an update in the local file
+                await self.updateFileFile(change)
+                #send the change to all servers
+                await self.sendChanges(change)
+
+            #send an update to client
+            await self.reply(command, CommandObject(FS, s.FILES))
+
+        if command.command == FS:
+            '''
+            FS COMMAND:
+            A command to send or receive nodes to replicate on.
+            If FS command with no data : FS requested.
+            If FS command with data : FS sent by a server
+            Update FS if sent.
+            '''
+            if command.data == None:
+                #reply with FS
+                await self.reply(command, CommandObject(FS, s.FILES))
+            else:
+                await self.saveMerge(sr.updateFs(command.data))
+
+        if command.command == HELLO:
+            '''
+            HELLO COMMAND:
+            A server dialed this server and says who it is. The
+            connection is saved under its name and the digest of the FS
+            is sent back, so both servers catch up with each other.
+            Only between servers.
+            '''
+            node = command.data['Name']
+            if node in s.SERVERS.keys():
+                if s.CONNECTIONS.get(self.address) is self:
+                    del s.CONNECTIONS[self.address]
+                s.PEERS.up(node, self)
+                s.PEERS.seen(node)
+                await self.sendFs()
+
+        if command.command == DIGEST:
+            '''
+            DIGEST COMMAND:
+            Servers compare their FS a level of the digest at a time.
+            - 'Groups': a server connected and sent the group hashes of
+              its digest. The bucket hashes of the groups that differ are
+              sent back. If the digests cannot be compared the whole FS
+              is sent.
+            - 'Leaves': the bucket hashes of the groups that differ. The
+              buckets that differ are asked for with 'Want'.
+            - 'Want': the names in the buckets are sent back in 'Names'.
+            - 'Names': the names of some buckets ('Buckets'), or of the
+              whole FS, of the other server and the names it deleted or
+              renamed ('Removed'). They are merged with the FS. With
+              'Full' the other server is too far ahead for its changes to
+              be sent, the names it removed beyond 'Removed' are found
+              with the last change it applied from here ('Applied').
+            Only between servers.
+            '''
+            data = command.data
+            s.DIGEST.counters['Exchanges'] += 1
+            if 'Groups' in data.keys():
+                groups = s.DIGEST.differingGroups(data)
+                if groups == None:
+                    await self.reply(command, CommandObject(DIGEST, {'Names': s.FILES,
+                                                                     'Removed': list(sr.removedNames())}))
+                elif len(groups) > 0:
+                    await self.reply(command, CommandObject(DIGEST, {'Leaves': s.DIGEST.leavesOf(groups)}))
+            elif 'Leaves' in data.keys():
+                buckets = s.DIGEST.differingBuckets(data['Leaves'])
+                if len(buckets) > 0:
+                    await self.reply(command, CommandObject(DIGEST, {'Want': buckets}))
+            elif 'Want' in data.keys():
+                names = [name for name in s.DIGEST.namesIn(data['Want']) if name in s.FILES.keys()]
+                s.DIGEST.counters['Buckets'] += len(data['Want'])
+                s.DIGEST.counters['Names'] += len(names)
+                await self.reply(command, CommandObject(DIGEST, {'Names': {name: s.FILES[name] for name in names},
+                                                                 'Buckets': data['Want'],
+                                                                 'Removed': list(sr.removedNames(data['Want']))}))
+            elif 'Names' in data.keys():
+                if 'Buckets' in data.keys():
+                    covered = s.DIGEST.namesIn(data['Buckets'])
                 else:
-                    if not sr.updateFs(command.data):
-                        print('error in updating FS')
-                        await self.write_q.put(CommandObject(ERROR))
-                    else:
-                        #update FS
-                        await self.updateFileFile()
-
-            if command.command == NEWFOLDER:
-                '''
-                NEWFOLDER COMMAND:
-                A new folder was created in the client and an update was sent
-                to the server. Since this is just symbollic, so it is arbitary.
-                It is just a change in the FS
-                '''
-                data = command.data
-                name = list(command.data.keys())[0]
-                name = sr.checkName(name)
-                #update Fs
-                s.FILES[name] = [data[name]]
-
-                #send an update to all servers
-                for name in s.SERVERS.keys():
-                    if not name == self.local_server and name in s.CONNECTIONS.keys():
-                        await s.CONNECTIONS[name].write_q.put(CommandObject(FS, s.FILES))
-
-                #update Fs File
-                await self.updateFileFile()
+                    covered = list(s.FILES.keys())
+                removed = set(data.get('Removed', ()))
+                if data.get('Full'):
+                    removed |= sr.replacedNames(data['Names'], self.node, data.get('Applied'))
+                await self.saveMerge(sr.updateFs(data['Names'], covered, removed))
+
+        if command.command == DELTA:
+            '''
+            DELTA COMMAND:
+            Another server sends the changes made to its FS since the
+            last DELTA. Changes are applied in order of their sequence
+            number. If some changes were missed, a SYNC is sent back to
+            the origin. A DELTA with 'Reset' follows a full FS sent in
+            reply to a SYNC and marks where the origin's changes resume.
+            '''
+            data = command.data
+            if 'Reset' in data.keys():
+                s.APPLIED[data['Origin']] = (data['Epoch'], data['Reset'])
+            elif sr.applyChanges(data['Origin'], data['Epoch'], data['Changes']):
+                await self.updateFileFile(*data['Changes'])
+            else:
+                #peer is behind, ask the origin for what was missed
+                await self.updateFileFile(*data['Changes'])
+                epoch, last = s.APPLIED[data['Origin']]
+                await self.write_q.put(CommandObject(SYNC, {'Epoch': epoch, 'Since': last}))
+
+        if command.command == SYNC:
+            '''
+            SYNC COMMAND:
+            A server missed some of the changes sent by this server.
+            The missing changes are sent if the change log still has
+            them, else the full FS is sent followed by a reset.
+            Only between servers.
+            '''
+            await self.sendSince(command.data['Epoch'], command.data['Since'])
+
+        if command.command == NEWFOLDER:
+            '''
+            NEWFOLDER COMMAND:
+            A new folder was created in the client and an update was sent
+            to the server. Since this is just symbollic, so it is arbitary.
+            It is just a change in the FS
+            '''
+            data = command.data
+            name = list(command.data.keys())[0]
+            new_name = sr.checkName(name)
+            #update Fs
+            change = sr.makeChange('PUT', new_name, [data[name]])
+
+            #send the change to all servers
+            await self.sendChanges(change)
+
+            #update Fs File
+            await self.updateFileFile(change)
+
+            #send an update to client
+            await self.reply(command, CommandObject(FS, s.FILES))
+
+        if command.command == RENAME:
+            '''
+            RENAME COMMAND:
+            A file was renamed. Folders cannot be renamed.
+            Search for the old name and replace with new name in the fs
+            Update the fs.
+            '''
+            #a new file is being sent
+            oldName = command.data['old']
+            newName = command.data['new']
+            #if successful
+            if oldName in s.FILES.keys():
+                change = sr.makeChange('RENAME', oldName, newName)
+                #send the change to all servers
+                await self.sendChanges(change)
+                #update fs file
+                await self.updateFileFile(change)
 
                 #send an update to client
-                await self.write_q.put(CommandObject(FS, s.FILES))
-
-            if command.command == RENAME:
-                '''
-                RENAME COMMAND:
-                A file was renamed. Folders cannot be renamed.
-                Search for the old name and replace with new name in the fs
-                Update the fs.
-                '''
-                #a new file is being sent
-                oldName = command.data['old']
-                newName = command.data['new']
-                #if successful
-                if sr.rename(oldName, newName):
-                    #send an update to all servers
-                    for name in s.SERVERS.keys():
-                        if not name == self.local_server and name in s.CONNECTIONS.keys():
-                            await s.CONNECTIONS[name].write_q.put(CommandObject(DEL, oldName))
-                            await s.CONNECTIONS[name].write_q.put(CommandObject(FS, s.FILES))
-                    #update fs file
-                    await self.updateFileFile()
-
-                    #send an update to client
-                    await self.write_q.put(CommandObject(FS, s.FILES))
-
-            if command.command == FILE:
-                '''
-                FILE COMMAND:
-                A file is being sent. The file can be a new file or an updated
-                file. For both cases, we find the primary node where it is
-                saved on. If the primary node is the current node, then the
-                file is saved in the files folder on the current server. Else
-                the file is sent to the primary node. Once saved on the primary
-                node, the lazy appraoch is used and the file is copied to the
-                'Also' of file node with the replicate file command.
-                '''
-                #check if current server has to store it
-                data = command.data
-                name = list(command.data.keys())[0]
-                nodes = sr.findFile(name)
-                if nodes == False:
-                    await self.write_q.put(CommandObject(ERROR))
-                #if current server is the primary server
-                if nodes[0] == self.local_server:
-                    #save files in files folder
-                    #check if file exists
+                await self.reply(command, CommandObject(FS, s.FILES))
+
+        if command.command == FILE:
+            '''
+            FILE COMMAND:
+            A file is being sent. The file can be a new file or an updated
+            file. For both cases, we find the primary node where it is
+            saved on. If the primary node is the current node, then the
+            file is saved in the files folder on the current server. Else
+            the file is sent to the primary node. Once saved on the primary
+            node, the file is copied to the 'Also' of file node with the
+            chunks command. The reply is sent once the write concern is met.
+            '''
+            #check if current server has to store it
+            data = command.data
+            name = list(command.data.keys())[0]
+            nodes = sr.findFile(name)
+            if nodes == False:
+                await self.reply(command, CommandObject(ERROR))
+                return
+            saved = False
+            start = time.perf_counter()
+            #if current server is the primary server
+            if nodes[0] == self.local_server:
+                #save the file in the chunk store
+                try:
+                    await self.saveBody(name, command.data[name].encode('utf-8'))
+                    saved = True
+                except (IOError, OSError) as e:
+                    print(e)
+            else:
+                #else send it to the primary server
+                #check if the node is connected
+                if nodes[0] in s.CONNECTIONS.keys():
+                    #after the changes that made the file, the reply of
+                    #the primary is the reply to the client
+                    s.BROADCAST.flush()
+                    result = await s.CONNECTIONS[nodes[0]].request(CommandObject(FILE, command.data))
+                    if result == None:
+                        result = CommandObject(ERROR, {'Reason': 'Primary {} did not save the file'.format(nodes[0])})
+                    await self.reply(command, CommandObject(result.command, result.data))
+                    return
+                else:
+                    #primary server is not connected
+                    #make primary server the current server
+                    await self.setFields(name, Node=self.local_server)
                     try:
-                        #get path
-                        path = s.FILES[name][-1]['Path']
-                        with open(path, 'w+') as f:
-                            f.write(command.data[name])
+                        #the body is added to what this server has
+                        body = await self.readBody(name)
+                        await self.saveBody(name, body + command.data[name].encode('utf-8'))
+                        saved = True
                     except (IOError, OSError) as e:
                         print(e)
+            #send file to other servers, then a reply to the client
+            if saved:
+                s.REPLICATOR.latency['Primary'].add(time.perf_counter() - start)
+                await self.reply(command, await self.replicateWrite(name, nodes[1:]))
+            else:
+                await self.reply(command, CommandObject(ERROR))
+
+        if command.command == REPLICATEFILE:
+            '''
+            REPLICATEFILE COMMAND:
+            Using the lazy appraoch, the primary node is sending a copy of
+            the file to the secondary node. The secondary will also save
+            the file in its 'files' folder.
+            This is a server only command
+            '''
+            #file has come to be replicated
+            data = command.data
+            name = list(command.data.keys())[0]
+            path = s.FILES[name][-1]['Path']
+            try:
+                await s.DISK.run('write', diskio.writeText, path, command.data[name])
+                s.CACHE.invalidate((name, len(s.FILES[name]) - 1))
+                await self.reply(command, CommandObject(SUCCESS))
+            except (IOError, OSError) as e:
+                print(e)
+                await self.reply(command, CommandObject(ERROR))
+
+        if command.command == GIVEFILE:
+            '''
+            GIVEFILE COMMAND:
+            Either the client is asking the server for a file, or a
+            different server is asking for a file not on their node. The
+            current node will check if the file is saved on this node. If
+            found, the file is sent else a conn command is sent in
+            response. A client that has a copy of the file sends its
+            version and tag in 'IfNotVersion' and 'IfNotTag', NOTMODIFIED
+            is sent back if the copy is still the latest version.
+            Any server holding the latest version of the file sends it,
+            primary or replica. Otherwise a replica is picked by
+            readNodes, and the file is streamed from it with READ_PROXY.
+            'Local' asks for the file only if this server has it.
+            '''
+            name = fileName(command.data)
+            #new clients ask for the file to be streamed in chunks
+            stream = isinstance(command.data, dict) and 'Stream' in command.data.keys() and command.data['Stream']
+            local = isinstance(command.data, dict) and 'Local' in command.data.keys() and command.data['Local']
+            nodes = sr.findFile(name)
+            if nodes == False:
+                #file does not exist
+                await self.reply(command, CommandObject(ERROR))
+            #else file is on the current server
+            elif self.local_server in nodes and await self.stored(name):
+                version = len(s.FILES[name]) - 1
+                tag = sr.versionTag(s.FILES[name][-1])
+                if stream and not tag == None and command.data.get('IfNotVersion') == version \
+                        and command.data.get('IfNotTag') == tag:
+                    await self.reply(command, CommandObject(NOTMODIFIED, {'Name': name, 'Version': version}))
+                #check the file is stored
+                elif not await self.stored(name):
+                    await self.reply(command, CommandObject(ERROR))
+                elif stream:
+                    await self.sendFile(command, name)
                 else:
-                    #else send it to the primary server
-                    #check if the node is connected
-                    if nodes[0] in s.CONNECTIONS.keys():
-                        await s.CONNECTIONS[nodes[0]].write_q.put(CommandObject(FILE, command.data))
-                    else:
-                        #primary server is not connected
-                        #make primary server the current server
-                        s.FILES[name][-1]['Node'] = self.local_server
-                        try:
-                            #get path
-                            path = s.FILES[name][-1]['Path']
-                            with open(path, 'a+') as f:
-                                f.write(command.data[name])
-                        except (IOError, OSError) as e:
-                            print(e)
-                #send a reply to the client
-                await self.write_q.put(CommandObject(SUCCESS))
-                #send file to other servers
-                #lazy approach. Send file after sending success response
-                for i in range(1,len(nodes)):
-                    if nodes[i] in s.CONNECTIONS.keys():
-                        await s.CONNECTIONS[nodes[i]].write_q.put(CommandObject(REPLICATEFILE, command.data))
-
-            if command.command == REPLICATEFILE:
-                '''
-                REPLICATEFILE COMMAND:
-                Using the lazy appraoch, the primary node is sending a copy of
-                the file to the secondary node. The secondary will also save
-                the file in its 'files' folder.
-                This is a server only command
-                '''
-                #file has come to be replicated
-                data = command.data
-                name = list(command.data.keys())[0]
-                path = s.FILES[name][-1]['Path']
-                try:
-                    with open(path, 'w+') as f:
-                        f.write(command.data[name])
-                        await self.write_q.put(CommandObject(SUCCESS))
-                except (IOError, OSError) as e:
-                    print(e)
-                    await self.write_q.put(CommandObject(ERROR))
-
-            if command.command == GIVEFILE:
-                '''
-                GIVEFILE COMMAND:
-                Either the client is asking the server for a file, or a
-                different server is asking for a file not on their node. The
-                current node will check if the file is saved on this node. If
-                found, the file is sent else a conn command is sent in
-                response.
-                '''
-                nodes = sr.findFile(command.data)
-                if nodes == False:
-                    #file does not exist
-                    await self.write_q.put(CommandObject(ERROR))
-                #else file is on the current server
-                elif nodes[0] == self.local_server:
-                    #get file
-                    path = s.FILES[command.data][-1]['Path']
-                    #check path
-                    if os.path.isfile(path):
-                        with open(path, 'r') as f:
-                            data = f.read()
-                            #send file contents to server
-                            await self.write_q.put(CommandObject(FILE, data))
-                #file is not on the current server
+                    data = await self.readBody(name)
+                    #send file contents to server
+                    await self.reply(command, CommandObject(FILE, data.decode('utf-8')))
+            elif local:
+                await self.reply(command, CommandObject(ERROR))
+            #file is not on the current server
+            else:
+                candidates = sr.readNodes(name, exclude=[self.local_server])
+                if len(candidates) == 0:
+                    await self.reply(command, CommandObject(ERROR))
+                elif s.READ_PROXY and stream:
+                    await self.proxyFile(command, candidates)
                 else:
                     #send conn request to the client to connect with the
                     #other server
-                    for node in nodes:
-                        if node in s.CONNECTIONS.keys():
-                            IP, PORT = nodes[0].split('/')
-                            await self.write_q.put(CommandObject(CONN, {'IP': IP, 'PORT':PORT}))
-                            break
-
-            if command.command == DEL:
-                '''
-                DELETE COMMAND:
-                Delete an entry from the file structure.
-                Only between servers to update the FS correctly.
-                '''
-                toDelete = command.data
-                del s.FILES[toDelete]
-                #update FS
-                await updateFileFile()
-                #send success to sender
-                await self.write_q.put(CommandObject(SUCCESS))
-
-            if command.command == QUIT:
-                '''
-                QUIT COMMAND:
-                Quit command sent by a server or client. The server runs the
-                end connection callback
-                '''
-                await self.endConnection()
+                    IP, PORT = candidates[0].split('/')
+                    await self.reply(command, CommandObject(CONN, {'IP': IP, 'PORT':PORT}))
 
-            if command.command == [ERROR, SUCCESS, INVALID]:
-                '''
-                ERROR, SUCCESS and INVALID COMMAND:
-                Server can't do much.
-                '''
-            print('message processed')
+        if command.command == FILESTART:
+            '''
+            FILESTART, FILECHUNK and FILEEND COMMAND:
+            A file is streamed in chunks. FILESTART names the file and the
+            transfer, every FILECHUNK carries a part of the body and FILEEND
+            closes it. The reply to FILEEND says if the file was saved.
+            The primary writes chunks to the chunk store as they arrive and
+            once FILEEND comes sends the version to the replicas with CHUNKS.
+            A server that is not the primary passes the stream on to the
+            primary.
+            '''
+            await self.receiveFile(command)
 
+        if command.command == CHUNKS:
+            '''
+            CHUNKS, GIVECHUNKS and CHUNKDATA COMMAND:
+            The primary sends the chunks a version of a file is made of
+            to the replicas. A replica asks for the chunks it does not
+            have with GIVECHUNKS, the primary sends each with CHUNKDATA.
+            Chunks already stored for other versions or files are never
+            sent again. Once it has all of them, the replica sends back
+            an ACK with the 'Ack' of the CHUNKS. Only between servers.
+            '''
+            missing = s.STORE.missing(dict.fromkeys(command.data['Chunks']))
+            ack = command.data.get('Ack')
+            if len(missing) > 0:
+                if not ack == None:
+                    self.chunkAcks[ack] = set(missing)
+                await self.write_q.put(CommandObject(GIVECHUNKS, {'Name': command.data['Name'],
+                                                                  'Chunks': missing}))
+            elif not ack == None:
+                await self.write_q.put(CommandObject(ACK, {'Ack': ack, 'Node': self.local_server}))
 
-    async def updateFileFile(self):
+        if command.command == GIVECHUNKS:
+            for h in command.data['Chunks']:
+                if s.STORE.has(h):
+                    data = await s.STORE.get(h)
+                    await self.write_q.put(CommandObject(CHUNKDATA, {'Hash': h, 'Data': data}))
+
+        if command.command == CHUNKDATA:
+            h = await s.STORE.put(command.data['Data'])
+            s.STORE.unpin([h])
+            if not h == command.data['Hash']:
+                print('Chunk {} does not match its data'.format(command.data['Hash']))
+            for ack in list(self.chunkAcks.keys()):
+                self.chunkAcks[ack].discard(h)
+                if len(self.chunkAcks[ack]) == 0:
+                    del self.chunkAcks[ack]
+                    await self.write_q.put(CommandObject(ACK, {'Ack': ack, 'Node': self.local_server}))
+
+        if command.command == DEL:
+            '''
+            DELETE COMMAND:
+            Delete an entry from the file structure.
+            Only between servers to update the FS correctly.
+            '''
+            toDelete = command.data
+            change = {'Op': 'DEL', 'Name': toDelete}
+            sr.applyChange(change)
+            #update FS
+            await self.updateFileFile(change)
+            #send success to sender
+            await self.reply(command, CommandObject(SUCCESS))
+
+        if command.command == STATS:
+            '''
+            STATS COMMAND:
+            Sends back the stats of the server: time taken by every
+            command, queues and bytes of every connection, disk, cache,
+            chunk store, replication and peers.
+            '''
+            await self.reply(command, CommandObject(STATS, metrics.snapshot()))
+
+        if command.command == BATCH:
+            '''
+            BATCH COMMAND:
+            Many CREATE, NEWFOLDER, UPDATE, RENAME and FILE operations in
+            one frame, {'Ops': [{'Command': CREATE, 'Data': data}, ...]}
+            with the data each is sent with on its own. They run in order
+            and the changes of the whole batch are saved with one journal
+            write and sent with one broadcast. The reply has a result for
+            every operation, and the FS only if 'Fs' is set.
+            '''
+            if command.reply:
+                #a reply to a BATCH no longer waited for
+                return
+            if not 'Ops' in command.data.keys():
+                await self.reply(command, CommandObject(INVALID, {'Reason': 'No Ops in the batch'}))
+                return
+            results = await self.runBatch(command.data['Ops'])
+            reply = {'Results': results}
+            if command.data.get('Fs'):
+                reply['FS'] = s.FILES
+            await self.reply(command, CommandObject(BATCH, reply))
+
+        if command.command == QUIT:
+            '''
+            QUIT COMMAND:
+            Quit command sent by a server or client. The server runs the
+            end connection callback
+            '''
+            await self.endConnection()
+
+        if command.command == [ERROR, SUCCESS, INVALID]:
+            '''
+            ERROR, SUCCESS and INVALID COMMAND:
+            Server can't do much.
+            '''
+
+
+    async def receiveFile(self, start):
         '''
-        Description:Picks up a file update
-        Saves it to files.txt
+        Description: Receives a file streamed in chunks. Once spool() has
+        saved all of them, the file is put in the FS and sent to the
+        replicas, or passed on to the primary if this server is not it.
         '''
-        #open file in write more and flush out everything
+        name = start.data['Name']
+        spool = self.spools.pop(start.data['Xfer'])
+        writer = None
+        nodes = False
         try:
-            with open(s.FILES_FILE, 'w+') as f:
-                json.dump(s.FILES, f, indent=4)
-        except Exception as e:
-            print(e)
+            writer, ok, end = await spool
+            nodes = sr.findFile(name)
+            if not ok or nodes == False:
+                result = CommandObject(ERROR)
+            elif not nodes[0] == self.local_server and nodes[0] in s.CONNECTIONS.keys():
+                #not the primary, pass the file on to the primary and its
+                #reply back to the sender
+                result = await self.forwardFile(name, nodes[0], writer.hashes)
+                if result == None:
+                    result = CommandObject(ERROR)
+            else:
+                fields = {'Size': writer.size, 'Chunks': writer.hashes}
+                if not nodes[0] == self.local_server:
+                    #primary server is not connected
+                    #make primary server the current server
+                    fields['Node'] = self.local_server
+                await self.setFields(name, **fields)
+                s.CACHE.invalidate((name, len(s.FILES[name]) - 1))
+                s.REPLICATOR.latency['Primary'].add(time.perf_counter() - start.received)
+                #the primary sends the chunks on to the replicas
+                result = await self.replicateWrite(name, nodes[1:])
+            await self.reply(end, CommandObject(result.command, result.data))
+        finally:
+            if not writer == None:
+                #a replica keeps the chunks for the version on its way
+                writer.release(keep=not nodes == False and self.local_server in nodes)
 
-    async def endConnection(self):
+    async def forwardFile(self, name, node, hashes):
+        '''
+        Description: Streams a file saved in the chunk store to its
+        primary. Returns the reply of the primary, None if the connection
+        ends. It goes after the changes that made the file, on the
+        connection they are sent on.
+        '''
+        s.BROADCAST.flush()
+        peer = s.CONNECTIONS[node]
+        xfer = next(peer.xferIds)
+        if not await peer.send(CommandObject(FILESTART, {'Name': name, 'Xfer': xfer})):
+            return None
+        for h in hashes:
+            data = await s.STORE.get(h)
+            if not await peer.send(CommandObject(FILECHUNK, {'Xfer': xfer, 'Data': data})):
+                return None
+        return await peer.request(CommandObject(FILEEND, {'Xfer': xfer}))
+
+    async def sendFile(self, request, name):
+        '''
+        Description: Streams a file in reply to a GIVEFILE, one chunk
+        at a time.
+        '''
+        entry = s.FILES[name][-1]
+        version = len(s.FILES[name]) - 1
+        if 'Chunks' in entry.keys():
+            await self.reply(request, CommandObject(FILESTART, {'Name': name, 'Size': entry['Size'],
+                                                                'Version': version,
+                                                                'Tag': sr.versionTag(entry)}))
+            for h in entry['Chunks']:
+                chunk = await self.readChunk(h)
+                await self.reply(request, CommandObject(FILECHUNK, {'Data': chunk}))
+            await self.reply(request, CommandObject(FILEEND))
+            return
+        #saved before the chunk store
+        path = entry['Path']
+        size = await s.DISK.run('stat', os.path.getsize, path)
+        await self.reply(request, CommandObject(FILESTART, {'Name': name, 'Size': size, 'Version': version}))
+        if s.CACHE.fits(size):
+            body = memoryview(await self.readPath(name))
+            for i in range(0, len(body), CHUNK_SIZE):
+                await self.reply(request, CommandObject(FILECHUNK, {'Data': body[i:i + CHUNK_SIZE]}))
+            await self.reply(request, CommandObject(FILEEND))
+            return
+        f = await s.DISK.run('open', open, path, 'rb')
+        try:
+            while True:
+                chunk = await s.DISK.run('read', f.read, CHUNK_SIZE)
+                if not chunk:
+                    break
+                await self.reply(request, CommandObject(FILECHUNK, {'Data': chunk}))
+        finally:
+            await s.DISK.run('close', f.close)
+        await self.reply(request, CommandObject(FILEEND))
+
+    async def proxyFile(self, request, nodes):
+        '''
+        Description: Streams a file from another server to the sender
+        of a GIVEFILE. The next server is tried if one does not have
+        the file.
+        '''
+        data = dict(request.data)
+        data['Local'] = True
+        for node in nodes:
+            start = time.perf_counter()
+            sent = False
+            try:
+                async for message in self.peerClient(node).stream(CommandObject(GIVEFILE, dict(data))):
+                    if not sent:
+                        sr.recordRtt(node, time.perf_counter() - start)
+                    if message == None or message.command == ERROR:
+                        break
+                    sent = True
+                    await self.reply(request, CommandObject(message.command, message.data))
+            except OSError as e:
+                print('Cannot read from {}: {}'.format(node, e))
+            if sent:
+                if not message == None and message.command in [FILEEND, NOTMODIFIED]:
+                    return
+                break
+        await self.reply(request, CommandObject(ERROR))
+
+    def peerClient(self, node):
+        '''
+        Description: Returns the connection files are read through from
+        another server, made the first time it is needed.
+        '''
+        if not node in s.PEER_CLIENTS.keys():
+            s.PEER_CLIENTS[node] = Client(s.SERVERS[node]['ip'], int(s.SERVERS[node]['port']),
+                                          s.CODEC, exitOnError=False, allowDill=s.ACCEPT_DILL)
+        return s.PEER_CLIENTS[node]
+
+    async def stored(self, name):
+        '''
+        Description: Checks the body of the latest version of a file
+        is on this server.
+        '''
+        entry = s.FILES[name][-1]
+        if 'Chunks' in entry.keys():
+            return len(s.STORE.missing(entry['Chunks'])) == 0
+        return await s.DISK.run('stat', os.path.isfile, entry['Path'])
+
+    async def readBody(self, name):
+        '''
+        Description: Reads the body of the latest version of a file.
+        Empty if this server does not have it.
         '''
-        Description:Finds all pending tasks, waits for all tasks to be
-        finished. Once done, writer is close. connection finished.
+        entry = s.FILES[name][-1]
+        if 'Chunks' in entry.keys():
+            return b''.join([await self.readChunk(h) for h in entry['Chunks']])
+        if await s.DISK.run('stat', os.path.isfile, entry['Path']):
+            return await self.readPath(name)
+        return b''
+
+    async def readChunk(self, h):
+        '''
+        Description: Reads a chunk through the cache. Chunks never
+        change, so they are never invalidated.
+        '''
+        return await s.CACHE.get(h, lambda: s.STORE.get(h))
+
+    async def readPath(self, name):
+        '''
+        Description: Reads the body of the latest version of a file
+        saved before the chunk store through the cache. The FILE and
+        REPLICATEFILE writes invalidate it.
+        '''
+        path = s.FILES[name][-1]['Path']
+        return await s.CACHE.get((name, len(s.FILES[name]) - 1),
+                                 lambda: s.DISK.run('read', diskio.readBytes, path))
+
+    async def saveBody(self, name, body):
+        '''
+        Description: Saves the body of the latest version of a file
+        in the chunk store.
+        '''
+        hashes = await s.STORE.putBody(body)
+        try:
+            await self.setFields(name, Size=len(body), Chunks=hashes)
+            s.CACHE.invalidate((name, len(s.FILES[name]) - 1))
+        finally:
+            s.STORE.unpin(hashes)
+
+    async def replicateWrite(self, name, nodes):
         '''
-        # Find all running tasks:
+        Description: Sends the latest version of a file to the replicas.
+        Returns the reply to the write, an ERROR if the write concern
+        was not met.
+        '''
+        if await s.REPLICATOR.replicate(name, nodes):
+            return CommandObject(SUCCESS)
+        return CommandObject(ERROR, {'Reason': 'Write concern not met'})
+
+    async def runBatch(self, ops):
+        '''
+        Description: Runs the operations of a BATCH. Bodies of FILE
+        operations are saved here if this server is the primary, and
+        sent to the replicas once the changes are saved. The others are
+        passed on to their primary in one BATCH per server, after the
+        changes, which go first on the same connection, and get the
+        results the primary sends back.
+        '''
+        changes = []
+        #name: (index of the result, replicas) of the bodies saved here
+        written = {}
+        #node: (index of the result, FILE operation) passed on to it
+        forward = {}
+        pinned = []
+        results = []
         try:
-            pending = asyncio.Task.all_tasks()
-            # Run loop until tasks done:
-            asyncio.gather(*pending)
+            for op in ops:
+                try:
+                    results.append(await self.batchOp(op, changes, written, forward, pinned, len(results)))
+                except (KeyError, IndexError, TypeError, AttributeError, IOError, OSError) as e:
+                    results.append({'Status': 'ERROR', 'Reason': str(e)})
+            if len(changes) > 0:
+                await self.updateFileFile(*changes)
+                await self.sendChanges(*changes)
         finally:
-            self.writer.transport.close()
-            #print('Connection Ended')
+            for hashes in pinned:
+                s.STORE.unpin(hashes)
+
+        if len(forward) > 0:
+            s.BROADCAST.flush()
+        nodes = list(forward.keys())
+        names = list(written.keys())
+        replies = await asyncio.gather(*[self.forwardBatch(node, forward[node]) for node in nodes],
+                                       *[self.replicateWrite(name, written[name][1]) for name in names])
+        for node, reply in zip(nodes, replies[:len(nodes)]):
+            for (index, fileOp), result in zip(forward[node], reply):
+                results[index] = result
+        for name, reply in zip(names, replies[len(nodes):]):
+            if reply.command == ERROR:
+                results[written[name][0]] = {'Status': 'ERROR', 'Name': name, 'Reason': reply.data['Reason']}
+        return results
+
+    async def forwardBatch(self, node, fileOps):
+        '''
+        Description: Passes FILE operations of a BATCH on to their
+        primary and returns the results it sends back, ERROR for all
+        of them if it does not answer.
+        '''
+        reply = None
+        if node in s.CONNECTIONS.keys():
+            reply = await s.CONNECTIONS[node].request(CommandObject(BATCH, {'Ops': [fileOp for index, fileOp in fileOps]}))
+        if reply == None or not reply.command == BATCH or not len(reply.data['Results']) == len(fileOps):
+            return [{'Status': 'ERROR', 'Name': list(fileOp['Data'].keys())[0],
+                     'Reason': 'Primary {} did not save the file'.format(node)} for index, fileOp in fileOps]
+        return reply.data['Results']
+
+    async def batchOp(self, op, changes, written, forward, pinned, index):
+        '''
+        Description: Runs one operation of a BATCH, like the command it
+        names, and adds its changes to the changes of the batch. Returns
+        its result.
+        '''
+        kind = op['Command']
+        data = op['Data']
+        if kind in [CREATE, NEWFOLDER]:
+            name = list(data.keys())[0]
+            entry = dict(data[name])
+            new_name = sr.checkName(name)
+            if kind == CREATE:
+                node = sr.NodeToSaveOn(new_name)
+                if node == None:
+                    return {'Status': 'ERROR', 'Name': name, 'Reason': 'No server to save on'}
+                nodesForReplication = sr.replicate(node, new_name)
+                entry.update({'Node': node, 'Path': 'files/{}'.format(new_name), 'Version': 0,
+                              'Also': [] if nodesForReplication == None else list(nodesForReplication)})
+            changes.append(sr.makeChange('PUT', new_name, [entry]))
+            return {'Status': 'SUCCESS', 'Name': new_name}
+
+        if kind == UPDATE:
+            if not data in s.FILES.keys():
+                return {'Status': 'ERROR', 'Name': data, 'Reason': 'Not in the FS'}
+            fileInfo = s.FILES[data][-1]
+            newEntry = {'Type':'F',
+                        'Parent':fileInfo['Parent'],
+                        'Version': len(s.FILES[data]),
+                        'Node':fileInfo['Node'],
+                        'Also':fileInfo['Also'], 'Path': 'files/{}{}'.format(len(s.FILES[data]), data)}
+            changes.append(sr.makeChange('APPEND', data, newEntry))
+            return {'Status': 'SUCCESS', 'Name': data}
+
+        if kind == RENAME:
+            oldName = data['old']
+            newName = data['new']
+            if not oldName in s.FILES.keys():
+                return {'Status': 'ERROR', 'Name': oldName, 'Reason': 'Not in the FS'}
+            changes.append(sr.makeChange('RENAME', oldName, newName))
+            #bodies of the batch not sent yet go under the new name
+            if oldName in written.keys():
+                written[newName] = written.pop(oldName)
+            for fileOps in forward.values():
+                for index, fileOp in fileOps:
+                    if oldName in fileOp['Data'].keys():
+                        fileOp['Data'] = {newName: fileOp['Data'][oldName]}
+            return {'Status': 'SUCCESS', 'Name': newName}
+
+        if kind == FILE:
+            name = list(data.keys())[0]
+            nodes = sr.findFile(name)
+            if nodes == False:
+                return {'Status': 'ERROR', 'Name': name, 'Reason': 'Not in the FS'}
+            body = data[name]
+            if isinstance(body, str):
+                body = body.encode('utf-8')
+            if not nodes[0] == self.local_server and nodes[0] in s.CONNECTIONS.keys():
+                #the result is the one the primary sends back
+                forward.setdefault(nodes[0], []).append((index, {'Command': FILE, 'Data': {name: body}}))
+                return {'Status': 'PENDING', 'Name': name, 'Node': nodes[0]}
+            version = len(s.FILES[name]) - 1
+            fields = {}
+            if not nodes[0] == self.local_server:
+                #primary server is not connected
+                #make primary server the current server
+                fields['Node'] = self.local_server
+            hashes = await s.STORE.putBody(body)
+            pinned.append(hashes)
+            fields.update({'Size': len(body), 'Chunks': hashes})
+            changes.append(sr.makeChange('SET', name, {'Version': version, 'Fields': fields}))
+            s.CACHE.invalidate((name, version))
+            written[name] = (index, nodes[1:])
+            return {'Status': 'SUCCESS', 'Name': name}
+
+        return {'Status': 'INVALID', 'Reason': 'Command {} cannot be batched'.format(kind)}
+
+    async def setFields(self, name, **fields):
+        '''
+        Description: Updates fields of the latest version of a file,
+        saves and sends the change if anything is different.
+        '''
+        entry = s.FILES[name][-1]
+        if all(key in entry.keys() and entry[key] == value for key, value in fields.items()):
             return
+        change = sr.makeChange('SET', name, {'Version': len(s.FILES[name]) - 1, 'Fields': fields})
+        await self.updateFileFile(change)
+        await self.sendChanges(change)
 
+    async def saveMerge(self, changes):
+        '''
+        Description: Saves the changes of a merge with the FS of
+        another server
+        '''
+        if len(changes) > 0:
+            await self.updateFileFile(*changes)
 
+    async def updateFileFile(self, *changes):
+        '''
+        Description:Picks up a file update
+        Writes the state of every name touched by the changes to the
+        journal and waits for it to be committed.
+        '''
+        try:
+            await s.JOURNAL.append([sr.stateOf(name) for name in sr.touched(changes)])
+        except Exception as e:
+            print(e)
+
+    def close(self):
+        '''
+        Description: Closes the connection, read() sees it end and
+        runs endConnection
+        '''
+        self.writer.transport.close()
+
+    async def endConnection(self):
+        '''
+        Description: Stops the tasks of the connection and the files
+        still being streamed to this server. Once done, writer is
+        closed and the connection is forgotten. connection finished.
+        '''
+        if self.closed:
+            return
+        self.closed = True
+        #stop the files still being streamed to this server and the
+        #commands still running, they could wait forever on a full
+        #write queue nobody empties
+        for task in list(self.tasks):
+            task.cancel()
+        if not self.resyncTask == None:
+            self.resyncTask.cancel()
+        current = asyncio.current_task()
+        for task in [self.readTask, self.handleTask, self.writeTask]:
+            if not task is current:
+                task.cancel()
+        self.writer.transport.close()
+        for reply in self.pending.values():
+            if not reply.done():
+                reply.set_result(None)
+        #wake up the commands of other connections waiting for room
+        #to send on this one, nothing is sent anymore
+        while not self.write_q.empty():
+            self.write_q.get_nowait()
+        if not self.node == None:
+            s.PEERS.down(self.node, self)
+        elif s.CONNECTIONS.get(self.address) is self:
+            del s.CONNECTIONS[self.address]
@@ -0,0 +1,94 @@
+import json
+import hashlib
+
+class Digest():
+    '''
+    Description: Hash tree of the FS. Names are spread over buckets by
+    the hash of the name, the hash of a bucket is the xor of the hashes
+    of its names and their versions. Buckets are grouped by fanout, a
+    group hash covers its buckets and the root covers all groups.
+    Servers compare the groups first, then the buckets of the groups
+    that differ, and only send the names of the buckets that differ.
+    Xor lets a name be taken out and put back in when it changes, so
+    the digest is kept up to date without being rebuilt.
+    '''
+    def __init__(self, buckets=65536, fanout=256):
+        self.buckets = buckets
+        self.fanout = fanout
+        self.counters = {'Exchanges': 0, 'Buckets': 0, 'Names': 0}
+        self.clear()
+
+    def clear(self):
+        self.leaves = [0] * self.buckets
+        #bucket: set of names, only for buckets with names
+        self.names = {}
+
+    def bucket(self, name):
+        return int.from_bytes(hashlib.blake2b(name.encode('utf-8'), digest_size=8).digest(), 'big') % self.buckets
+
+    def entryHash(self, name, versions):
+        data = json.dumps([name, versions], sort_keys=True).encode('utf-8')
+        #63 bits, sent as a plain integer
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big') >> 1
+
+    def toggle(self, name, versions, sign):
+        '''
+        Description: Puts a name in (sign 1) or takes it out (sign -1)
+        of the digest
+        '''
+        bucket = self.bucket(name)
+        self.leaves[bucket] ^= self.entryHash(name, versions)
+        if sign > 0:
+            if not bucket in self.names.keys():
+                self.names[bucket] = set()
+            self.names[bucket].add(name)
+        elif bucket in self.names.keys():
+            self.names[bucket].discard(name)
+            if len(self.names[bucket]) == 0:
+                del self.names[bucket]
+
+    def hash(self, leaves):
+        data = b''.join(leaf.to_bytes(8, 'big') for leaf in leaves)
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'big') >> 1
+
+    def groups(self):
+        return [self.hash(self.leaves[i:i + self.fanout]) for i in range(0, self.buckets, self.fanout)]
+
+    def summary(self):
+        '''
+        Description: First part of the digest sent to another server
+        '''
+        groups = self.groups()
+        return {'Root': self.hash(groups), 'Groups': groups}
+
+    def differingGroups(self, summary):
+        '''
+        Description: Groups that differ from the summary of another
+        server. None if the digests cannot be compared.
+        '''
+        if not len(summary['Groups']) * self.fanout == self.buckets:
+            return None
+        groups = self.groups()
+        if summary['Root'] == self.hash(groups):
+            return []
+        return [i for i in range(len(groups)) if not summary['Groups'][i] == groups[i]]
+
+    def leavesOf(self, groups):
+        return {group: self.leaves[group * self.fanout:(group + 1) * self.fanout] for group in groups}
+
+    def differingBuckets(self, leaves):
+        '''
+        Description: Buckets that differ from the bucket hashes of
+        another server, sent for some groups.
+        '''
+        buckets = []
+        for group, theirs in leaves.items():
+            start = group * self.fanout
+            buckets += [start + i for i in range(self.fanout) if not theirs[i] == self.leaves[start + i]]
+        return buckets
+
+    def namesIn(self, buckets):
+        names = []
+        for bucket in buckets:
+            names += self.names.get(bucket, ())
+        return names
@@ -0,0 +1,84 @@
+import time
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+class Latency():
+    '''
+    Description: Keeps the last samples of a latency to report
+    count, mean and percentiles.
+    '''
+    def __init__(self, samples=1024):
+        self.samples = deque(maxlen=samples)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, p):
+        if len(self.samples) == 0:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def stats(self):
+        '''
+        Description: Summary in milliseconds
+        '''
+        return {'Count': self.count,
+                'Mean': 1000 * self.total / self.count if self.count else 0.0,
+                'P50': 1000 * self.percentile(50),
+                'P99': 1000 * self.percentile(99),
+                'Max': 1000 * self.max}
+
+class DiskIO():
+    '''
+    Description: Thread pool every file body and metadata write or
+    read goes through, so disk access never blocks the event loop.
+    The latency of every kind of operation is recorded.
+    '''
+    def __init__(self, threads):
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='diskio')
+        self.latency = {}
+
+    async def run(self, op, fn, *args):
+        '''
+        Description: Runs fn(*args) in the pool and returns its result.
+        op names the kind of operation in the latency report.
+        '''
+        start = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+        finally:
+            self.record(op, time.perf_counter() - start)
+
+    def record(self, op, seconds):
+        if not op in self.latency.keys():
+            self.latency[op] = Latency()
+        self.latency[op].add(seconds)
+
+    async def watchLoop(self, interval=0.1):
+        '''
+        Description: Measures how late the event loop wakes up from a
+        sleep. Reported as the 'loop lag' operation.
+        '''
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            self.record('loop lag', max(0.0, time.perf_counter() - start - interval))
+
+    def stats(self):
+        return {op: latency.stats() for op, latency in self.latency.items()}
+
+def readBytes(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def writeText(path, data):
+    with open(path, 'w+') as f:
+        f.write(data)
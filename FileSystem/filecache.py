@@ -0,0 +1,70 @@
+import os
+import json
+import shutil
+import hashlib
+
+from protocol import CHUNK_SIZE
+
+def bodyTag(path):
+    '''
+    Description: Tag the server gives a body, the sha256 of the
+    sha256 of every chunk of the file
+    '''
+    hashes = []
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            hashes.append(hashlib.sha256(chunk).hexdigest())
+    return hashlib.sha256(''.join(hashes).encode('ascii')).hexdigest()
+
+class FileCache():
+    '''
+    Description: Copies of the files the client opened, kept between
+    runs. Every copy is saved with the version and tag the server sent
+    it with, so the server can answer NOTMODIFIED instead of sending
+    the file again. Only the last copy of a name is kept.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.indexPath = os.path.join(root, 'index.json')
+        #name: {'Version': v, 'Tag': tag}
+        self.index = {}
+        if not os.path.isdir(root):
+            os.makedirs(root)
+        if os.path.isfile(self.indexPath):
+            try:
+                with open(self.indexPath, 'r') as f:
+                    self.index = json.load(f)
+            except ValueError as e:
+                print('Cache Error: {}'.format(e))
+
+    def path(self, name):
+        return os.path.join(self.root, hashlib.sha1(name.encode('utf-8')).hexdigest())
+
+    def lookup(self, name):
+        '''
+        Description: Version and tag of the copy of a name, None if
+        there is no copy.
+        '''
+        if name in self.index.keys() and os.path.isfile(self.path(name)):
+            return self.index[name]
+        return None
+
+    def add(self, name, version, tag, path):
+        '''
+        Description: Keeps a copy of a file downloaded or saved
+        '''
+        shutil.copyfile(path, self.path(name) + '.tmp')
+        os.replace(self.path(name) + '.tmp', self.path(name))
+        self.index[name] = {'Version': version, 'Tag': tag}
+        self.save()
+
+    def copyTo(self, name, path):
+        shutil.copyfile(self.path(name), path)
+
+    def save(self):
+        with open(self.indexPath + '.tmp', 'w') as f:
+            json.dump(self.index, f)
+        os.replace(self.indexPath + '.tmp', self.indexPath)
@@ -0,0 +1,254 @@
+import os
+import json
+import time
+import itertools
+import asyncio
+
+class Journal():
+    '''
+    Description: Append-only journal of the FS. Every record holds the
+    state of one name after a mutation. Records are written in groups
+    by a background task and the journal is compacted into a snapshot
+    (files.txt) once enough records have been written.
+    The snapshot holds a header line with the last record in it, then
+    one line per name: the name and its versions separated by a tab.
+    '''
+    def __init__(self, path, snapshotPath, disk, fsync='interval', fsyncInterval=1.0,
+                 window=0.002, snapshotEvery=10000):
+        self.path = path
+        self.oldPath = path + '.old'
+        self.snapshotPath = snapshotPath
+        #all writes go through the disk I/O pool
+        self.disk = disk
+        #always: fsync every group, interval: at most every fsyncInterval
+        #seconds, never: leave it to the OS
+        self.fsync = fsync
+        self.fsyncInterval = fsyncInterval
+        self.window = window
+        self.snapshotEvery = snapshotEvery
+        self.lsn = 0
+        self.file = None
+        self.pending = []
+        self.written = 0
+        self.lastSync = 0
+        #snapshot being built in the disk I/O pool
+        self.compacting = None
+        self.wakeup = None
+
+    def loadSnapshot(self):
+        '''
+        Description: Reads the latest snapshot.
+        Returns None if there is no snapshot.
+        '''
+        if not os.path.isfile(self.snapshotPath) or os.stat(self.snapshotPath).st_size == 0:
+            return None
+        files = {}
+        with open(self.snapshotPath, 'r') as f:
+            lsn, lines = self.readSnapshot(f)
+            for line in lines:
+                name, versions = line.split('\t', 1)
+                files[json.loads(name)] = json.loads(versions)
+        self.lsn = lsn
+        return files
+
+    def readSnapshot(self, f):
+        '''
+        Description: Returns the last record in the snapshot file f and
+        its lines, read as they are used. Snapshots written before the
+        journal existed hold the FS only, the first ones of the journal
+        the last record and the FS in one object, their lines are made
+        from it.
+        '''
+        try:
+            head = json.loads(f.readline())
+        except ValueError:
+            head = {}
+        if 'Lsn' in head.keys() and 'Lines' in head.keys():
+            return head['Lsn'], f
+        f.seek(0)
+        data = json.load(f)
+        if 'Lsn' in data.keys() and 'Files' in data.keys():
+            return data['Lsn'], [self.line(name, versions) for name, versions in data['Files'].items()]
+        return 0, [self.line(name, versions) for name, versions in data.items()]
+
+    def snapshotLines(self):
+        '''
+        Description: Yields the name and the line of every name in the
+        snapshot.
+        '''
+        if not os.path.isfile(self.snapshotPath) or os.stat(self.snapshotPath).st_size == 0:
+            return
+        with open(self.snapshotPath, 'r') as f:
+            for line in self.readSnapshot(f)[1]:
+                yield json.loads(line.split('\t', 1)[0]), line
+
+    def records(self, path):
+        '''
+        Description: Reads the records of a journal file. A torn last
+        record from a crash is ignored.
+        '''
+        if not os.path.isfile(path):
+            return
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    print('Journal: ignoring torn record in {}'.format(path))
+                    return
+
+    def replay(self, files):
+        '''
+        Description: Applies the journal records written after the
+        snapshot to the FS loaded from it.
+        '''
+        for path in [self.oldPath, self.path]:
+            for record in self.records(path):
+                if record['Lsn'] <= self.lsn:
+                    continue
+                if record['Op'] == 'PUT':
+                    files[record['Name']] = record['Data']
+                elif record['Op'] == 'DEL':
+                    files.pop(record['Name'], None)
+                self.lsn = record['Lsn']
+        return files
+
+    def open(self, files):
+        '''
+        Description: Called on boot once the FS is rebuilt. Leftover
+        journal files are folded into a fresh snapshot and a new
+        journal is started.
+        '''
+        if os.path.isfile(self.path) or os.path.isfile(self.oldPath):
+            self.writeSnapshot(self.lsn, (self.line(name, versions) for name, versions in files.items()))
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+        self.file = open(self.path, 'a')
+        self.wakeup = asyncio.Event()
+
+    async def append(self, records):
+        '''
+        Description: Adds records to the journal. Returns once the
+        group they were written in is committed.
+        '''
+        future = asyncio.get_running_loop().create_future()
+        lines = []
+        for record in records:
+            self.lsn += 1
+            record['Lsn'] = self.lsn
+            lines.append(json.dumps(record) + '\n')
+        self.pending.append((''.join(lines), future))
+        self.written += len(lines)
+        self.wakeup.set()
+        await future
+
+    async def run(self):
+        '''
+        Description: Group commit loop. Waits for records, lets more
+        records gather for a short window, then writes them all at once.
+        '''
+        while True:
+            await self.wakeup.wait()
+            await asyncio.sleep(self.window)
+            self.wakeup.clear()
+            group, self.pending = self.pending, []
+            if len(group) > 0:
+                try:
+                    await self.disk.run('journal', self.writeGroup, ''.join(line for line, _ in group))
+                    for _, future in group:
+                        future.set_result(True)
+                except Exception as e:
+                    print('Journal Error: {}'.format(e))
+                    for _, future in group:
+                        future.set_exception(e)
+            if self.written >= self.snapshotEvery:
+                await self.compact()
+
+    def writeGroup(self, data):
+        '''
+        Description: Writes a group of records. Runs in the disk I/O pool.
+        '''
+        self.file.write(data)
+        self.file.flush()
+        now = time.monotonic()
+        if self.fsync == 'always' or (self.fsync == 'interval' and now - self.lastSync >= self.fsyncInterval):
+            os.fsync(self.file.fileno())
+            self.lastSync = now
+
+    async def compact(self):
+        '''
+        Description: Rotates the journal and builds the next snapshot
+        from the last one and the rotated journal in the background,
+        group commits go on meanwhile. Once the snapshot is in place
+        the rotated journal is no longer needed.
+        '''
+        if not self.compacting == None and not self.compacting.done():
+            #the rotated journal is still being read
+            return
+        self.written = 0
+        try:
+            await self.disk.run('rotate', self.rotate)
+        except Exception as e:
+            print('Snapshot Error: {}'.format(e))
+            return
+        self.compacting = asyncio.ensure_future(self.buildSnapshot())
+
+    async def buildSnapshot(self):
+        try:
+            await self.disk.run('snapshot', self.mergeSnapshot)
+        except Exception as e:
+            print('Snapshot Error: {}'.format(e))
+
+    def line(self, name, versions):
+        return '{}\t{}\n'.format(json.dumps(name), json.dumps(versions))
+
+    def mergeSnapshot(self):
+        '''
+        Description: Writes the next snapshot: the names of the last
+        snapshot with the records of the rotated journal applied. Runs
+        in the disk I/O pool one name at a time, so the event loop is
+        never held up for long, and never reads the FS.
+        '''
+        lsn = 0
+        states = {}
+        for record in self.records(self.oldPath):
+            states[record['Name']] = record
+            lsn = record['Lsn']
+        if lsn == 0:
+            os.remove(self.oldPath)
+            return
+        lines = (line for name, line in self.snapshotLines() if not name in states.keys())
+        added = (self.line(name, record['Data']) for name, record in states.items() if record['Op'] == 'PUT')
+        self.writeSnapshot(lsn, itertools.chain(lines, added))
+
+    def rotate(self):
+        '''
+        Description: Moves the journal aside and starts a new one.
+        Everything in the moved journal is in the next snapshot.
+        '''
+        self.file.close()
+        if os.path.isfile(self.oldPath):
+            #the last snapshot failed, its records are still needed
+            with open(self.oldPath, 'a') as old, open(self.path, 'r') as f:
+                old.write(f.read())
+            os.remove(self.path)
+        else:
+            os.replace(self.path, self.oldPath)
+        self.file = open(self.path, 'a')
+
+    def writeSnapshot(self, lsn, lines):
+        '''
+        Description: Atomically replaces the snapshot file with the
+        lines of a snapshot holding the records up to lsn, then removes
+        the rotated journal.
+        '''
+        temp = self.snapshotPath + '.tmp'
+        with open(temp, 'w') as f:
+            f.write(json.dumps({'Lsn': lsn, 'Lines': True}) + '\n')
+            for line in lines:
+                f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp, self.snapshotPath)
+        if os.path.isfile(self.oldPath):
+            os.remove(self.oldPath)
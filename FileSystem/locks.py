@@ -0,0 +1,90 @@
+import asyncio
+from collections import deque
+
+class NameLocks():
+    '''
+    Description: Locks on names in the FS, shared by all connections.
+    A name can be held by many readers (shared) or one writer.
+    Waiters are granted in the order they asked, so commands on the
+    same name run in the order they were received.
+    '''
+    def __init__(self):
+        #name: {'Readers': n, 'Writer': bool, 'Waiting': deque of (shared, future)}
+        self.locks = {}
+
+    def compatible(self, lock, shared):
+        if lock['Writer']:
+            return False
+        return shared or lock['Readers'] == 0
+
+    async def acquire(self, names, shared=False):
+        '''
+        Description: Takes the locks of all names. A command gets in line
+        on all its names at once, so commands get every name in the
+        order they asked and two can never wait on each other. If it is
+        cancelled while waiting it gives back the names it holds and
+        its place in line.
+        '''
+        names = sorted(set(names))
+        waiting = {}
+        for name in names:
+            if not name in self.locks.keys():
+                self.locks[name] = {'Readers': 0, 'Writer': False, 'Waiting': deque()}
+            lock = self.locks[name]
+            if len(lock['Waiting']) == 0 and self.compatible(lock, shared):
+                self.take(lock, shared)
+                continue
+            waiting[name] = asyncio.get_event_loop().create_future()
+            lock['Waiting'].append((shared, waiting[name]))
+        try:
+            for future in waiting.values():
+                await future
+        except asyncio.CancelledError:
+            held = [name for name in names
+                    if not name in waiting.keys() or (waiting[name].done() and not waiting[name].cancelled())]
+            for future in waiting.values():
+                future.cancel()
+            self.release(held, shared)
+            for name in waiting.keys():
+                if not name in held:
+                    self.grant(name)
+            raise
+
+    def take(self, lock, shared):
+        if shared:
+            lock['Readers'] += 1
+        else:
+            lock['Writer'] = True
+
+    def release(self, names, shared=False):
+        '''
+        Description: Gives up the locks of all names and wakes up
+        the waiters that can run now.
+        '''
+        for name in set(names):
+            lock = self.locks[name]
+            if shared:
+                lock['Readers'] -= 1
+            else:
+                lock['Writer'] = False
+            self.grant(name)
+
+    def grant(self, name):
+        '''
+        Description: Gives a name to the waiters first in line that can
+        have it, skipping the ones that gave up
+        '''
+        lock = self.locks[name]
+        while len(lock['Waiting']) > 0:
+            waiterShared, future = lock['Waiting'][0]
+            if future.cancelled():
+                lock['Waiting'].popleft()
+                continue
+            if not self.compatible(lock, waiterShared):
+                break
+            lock['Waiting'].popleft()
+            self.take(lock, waiterShared)
+            future.set_result(True)
+        #forget names nobody holds
+        if lock['Readers'] == 0 and not lock['Writer'] and len(lock['Waiting']) == 0:
+            del self.locks[name]
@@ -0,0 +1,94 @@
+import json
+import time
+import asyncio
+
+import settings as s
+import diskio
+from protocol import *
+
+class Histogram():
+    '''
+    Description: Counts of samples under every bound, in milliseconds
+    '''
+    BOUNDS = [0.1, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+
+    def add(self, seconds):
+        ms = 1000 * seconds
+        for i, bound in enumerate(self.BOUNDS):
+            if ms <= bound:
+                self.counts[i] += 1
+                return
+        self.counts[-1] += 1
+
+    def stats(self):
+        stats = {'<={}'.format(bound): count for bound, count in zip(self.BOUNDS, self.counts) if count > 0}
+        if self.counts[-1] > 0:
+            stats['>{}'.format(self.BOUNDS[-1])] = self.counts[-1]
+        return stats
+
+class Metrics():
+    '''
+    Description: Time every command takes on the server, from being
+    read to being processed, and the time it waited in the queue of
+    its connection before it ran.
+    '''
+    def __init__(self):
+        #command: Latency, Histogram
+        self.latency = {}
+        self.histograms = {}
+        self.waits = {}
+        self.started = time.monotonic()
+
+    def record(self, command, seconds, waited):
+        name = COMMAND_NAMES[command] if command < len(COMMAND_NAMES) else str(command)
+        if not name in self.latency.keys():
+            self.latency[name] = diskio.Latency()
+            self.histograms[name] = Histogram()
+            self.waits[name] = diskio.Latency()
+        self.latency[name].add(seconds)
+        self.histograms[name].add(seconds)
+        self.waits[name].add(waited)
+
+    def stats(self):
+        stats = {}
+        for name, latency in self.latency.items():
+            stats[name] = latency.stats()
+            stats[name]['Total'] = 1000 * latency.total
+            stats[name]['Wait'] = self.waits[name].stats()
+            stats[name]['Histogram'] = self.histograms[name].stats()
+        return stats
+
+    async def dumpLoop(self, path, interval):
+        '''
+        Description: Writes the stats of the server to a file every
+        interval
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await s.DISK.run('stats', diskio.writeText, path, json.dumps(snapshot(), indent=1, default=str))
+            except Exception as e:
+                print('Stats Error: {}'.format(e))
+
+def snapshot():
+    '''
+    Description: Stats of every part of the server, sent back by
+    STATS and written to the stats file
+    '''
+    stats = {'Server': '{}/{}'.format(s.HOST, s.PORT),
+             'Uptime': time.monotonic() - s.METRICS.started,
+             'Files': len(s.FILES),
+             'Commands': s.METRICS.stats(),
+             'Connections': {name: connection.queueStats() for name, connection in s.CONNECTIONS.items()},
+             'Load': dict(s.LOAD)}
+    parts = {'Disk': s.DISK, 'Broadcast': s.BROADCAST, 'Store': s.STORE, 'Cache': s.CACHE,
+             'Replicator': s.REPLICATOR, 'Peers': s.PEERS, 'Rebalancer': s.REBALANCER}
+    for name, part in parts.items():
+        if not part == None:
+            stats[name] = part.stats()
+    if not s.DIGEST == None:
+        stats['Digest'] = dict(s.DIGEST.counters)
+    return stats
@@ -0,0 +1,51 @@
+class NameIndex():
+    '''
+    Description: Hands out free names for new files and folders.
+    A taken name gets a suffix: report.txt -> report(1).txt.
+    The next suffix to try is kept for every (stem, extension), so a
+    name taken many times is not probed again from 1 every time.
+    Used by the server and the client.
+    '''
+    def __init__(self, names):
+        #any container of the names in use, like the FS dict
+        self.names = names
+        self.next = {}
+
+    def use(self, names):
+        '''
+        Description: Switches to a new container of names in use.
+        The suffixes handed out so far are kept as hints.
+        '''
+        self.names = names
+
+    def split(self, name):
+        '''
+        Description: Splits a name into stem and extension.
+        Names without an extension (and hidden files) have None.
+        '''
+        temp = name.rsplit('.', 1)
+        if len(temp) == 1 or temp[0] == '':
+            return (name, None)
+        return (temp[0], temp[1])
+
+    def allocate(self, name):
+        '''
+        Description: Returns the name if it is free, else the name
+        with the next free suffix.
+        '''
+        if not name in self.names:
+            return name
+        key = self.split(name)
+        i = self.next.get(key, 1)
+        new_name = self.format(key, i)
+        while new_name in self.names:
+            i += 1
+            new_name = self.format(key, i)
+        self.next[key] = i + 1
+        return new_name
+
+    def format(self, key, i):
+        stem, ext = key
+        if ext == None:
+            return '{}({})'.format(stem, i)
+        return '{}({}).{}'.format(stem, i, ext)
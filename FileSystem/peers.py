@@ -0,0 +1,151 @@
+import time
+import random
+import asyncio
+
+import settings as s
+import services as sr
+from protocol import *
+
+class PeerManager():
+    '''
+    Description: Keeps this server connected to the other servers of
+    the config. Of every two servers the one with the lower name dials,
+    the other waits for it, so there is one connection between them.
+    Every peer is dialed at the same time, a failed dial is retried
+    after a backoff that doubles up to backoffMax, with jitter so
+    restarted servers do not all dial together.
+    Every interval a PING is sent to every connected peer. A peer that
+    was not heard from for timeout seconds is taken as down and its
+    connection is closed, it is dialed again if this server dials it.
+    '''
+    def __init__(self, local, interval=1.0, timeout=5.0, backoff=0.5, backoffMax=30.0):
+        self.local = local
+        self.interval = interval
+        self.timeout = timeout
+        self.backoff = backoff
+        self.backoffMax = backoffMax
+        #node: monotonic time the peer was last heard from
+        self.lastSeen = {}
+        #node: set when the connection to the peer is lost
+        self.lost = {}
+        #node: monotonic time the peer went down, peers start down
+        self.downSince = {node: time.monotonic() for node in self.peers()}
+        self.counters = {'Dials': 0, 'DialFailures': 0, 'Pings': 0, 'Pongs': 0, 'Suspected': 0, 'Lost': 0}
+
+    def peers(self):
+        return [node for node in s.SERVERS.keys() if not node == self.local]
+
+    def dials(self, node):
+        return self.local < node
+
+    async def run(self, connected):
+        '''
+        Description: Dials the peers and sends heartbeats. connected is
+        called with the reader, writer and name of every peer dialed.
+        '''
+        for node in self.peers():
+            self.lost[node] = asyncio.Event()
+        await asyncio.gather(self.heartbeat(),
+                             *[self.dial(node, connected) for node in self.peers() if self.dials(node)])
+
+    async def dial(self, node, connected):
+        '''
+        Description: Keeps one peer connected
+        '''
+        backoff = self.backoff
+        while True:
+            if node in s.CONNECTIONS.keys():
+                await self.lost[node].wait()
+                self.lost[node].clear()
+                continue
+            self.counters['Dials'] += 1
+            try:
+                reader, writer = await asyncio.open_connection(s.SERVERS[node]['ip'], int(s.SERVERS[node]['port']))
+            except OSError:
+                self.counters['DialFailures'] += 1
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.5))
+                backoff = min(backoff * 2, self.backoffMax)
+                continue
+            backoff = self.backoff
+            await connected(reader, writer, node)
+
+    def up(self, node, connection):
+        '''
+        Description: Called once a connection is known to be to a peer.
+        An older connection to the same peer is closed. The peer is only
+        taken as up once something is read from it, a dial can succeed
+        while the server on the other side is stuck.
+        '''
+        old = s.CONNECTIONS.get(node)
+        if not old == None and not old is connection:
+            old.close()
+        connection.node = node
+        s.CONNECTIONS[node] = connection
+        self.lastSeen[node] = time.monotonic()
+
+    def down(self, node, connection):
+        '''
+        Description: Called when a connection to a peer ended
+        '''
+        if not s.CONNECTIONS.get(node) is connection:
+            return
+        del s.CONNECTIONS[node]
+        if s.SERVERS[node]['connected']:
+            s.SERVERS[node]['connected'] = False
+            self.downSince[node] = time.monotonic()
+        self.counters['Lost'] += 1
+        if node in self.lost.keys():
+            self.lost[node].set()
+
+    def seen(self, node):
+        self.lastSeen[node] = time.monotonic()
+        if not s.SERVERS[node]['connected']:
+            s.SERVERS[node]['connected'] = True
+            self.downSince.pop(node, None)
+            if not s.REBALANCER == None:
+                s.REBALANCER.notify()
+
+    def pong(self, node, data):
+        '''
+        Description: Called with the PONG of a peer, the round trip
+        time is added to the one read routing uses.
+        '''
+        self.counters['Pongs'] += 1
+        self.seen(node)
+        sr.recordRtt(node, time.monotonic() - data['Sent'])
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            for node in self.peers():
+                connection = s.CONNECTIONS.get(node)
+                if connection == None:
+                    continue
+                if now - self.lastSeen.get(node, now) > self.timeout:
+                    self.counters['Suspected'] += 1
+                    print('{} did not answer for {:.1f}s'.format(node, now - self.lastSeen[node]))
+                    connection.close()
+                    continue
+                self.counters['Pings'] += 1
+                connection.push(CommandObject(PING, {'Sent': now}))
+
+    def downFor(self, node):
+        '''
+        Description: Seconds a peer has been down, 0 if it is up
+        '''
+        if not node in self.downSince.keys():
+            return 0.0
+        return time.monotonic() - self.downSince[node]
+
+    def alive(self, node):
+        return node == self.local or s.SERVERS[node]['connected']
+
+    def stats(self):
+        stats = dict(self.counters)
+        now = time.monotonic()
+        stats['Peers'] = {node: {'Alive': self.alive(node),
+                                 'Rtt': s.RTT.get(node),
+                                 'LastSeen': now - self.lastSeen[node] if node in self.lastSeen.keys() else None}
+                          for node in self.peers()}
+        return stats
@@ -0,0 +1,109 @@
+import bisect
+import hashlib
+
+import settings as s
+import services as sr
+
+def ringHash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+class LoadPlacement():
+    '''
+    Description: Puts new files on the servers with the fewest files
+    and bytes. Even, but where a file goes depends on everything saved
+    before it. Servers with the same load, as when every file is on
+    every server, take turns being the primary so writes are spread.
+    '''
+    def primary(self, name):
+        nodes = [node for node in s.SERVERS.keys() if sr.alive(node)]
+        if len(nodes) == 0:
+            return None
+        return min(nodes, key=lambda node: (sr.nodeLoad(node), sr.primaries(node), node))
+
+    def replicas(self, name, primary, number):
+        '''
+        Description: The least loaded servers other than the primary,
+        servers that are up before the ones that are down
+        '''
+        servers = [server for server in s.SERVERS.keys() if not server == primary]
+        servers.sort(key=lambda node: (not sr.alive(node), sr.nodeLoad(node), node))
+        return servers[:number]
+
+    def preferred(self, name, number):
+        '''
+        Description: Servers a file should be on, None if any servers
+        with room will do
+        '''
+        return None
+
+class RingPlacement():
+    '''
+    Description: Consistent hashing. Every server is put on a ring of
+    hashes vnodes times its 'weight' in the config, a file goes to the
+    first servers after the hash of its name. Where a file goes only
+    depends on its name and the servers, and a server joining or
+    leaving only moves the files next to its points on the ring.
+    Servers that are down are skipped.
+    '''
+    def __init__(self, vnodes=64):
+        self.vnodes = vnodes
+        self.members = None
+        self.hashes = []
+        self.nodes = []
+
+    def ring(self):
+        members = tuple(sorted((node, float(addr.get('weight', 1))) for node, addr in s.SERVERS.items()))
+        if not members == self.members:
+            points = sorted((ringHash('{}#{}'.format(node, i)), node)
+                            for node, weight in members for i in range(max(1, int(round(self.vnodes * weight)))))
+            self.hashes = [point[0] for point in points]
+            self.nodes = [point[1] for point in points]
+            self.members = members
+        return self.hashes, self.nodes
+
+    def walk(self, name):
+        '''
+        Description: Servers in the order they come after the hash of
+        the name on the ring
+        '''
+        hashes, nodes = self.ring()
+        if len(nodes) == 0:
+            return
+        start = bisect.bisect(hashes, ringHash(name))
+        seen = set()
+        for i in range(len(nodes)):
+            node = nodes[(start + i) % len(nodes)]
+            if not node in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.members):
+                    return
+
+    def primary(self, name):
+        for node in self.walk(name):
+            if sr.alive(node):
+                return node
+        return None
+
+    def replicas(self, name, primary, number):
+        servers = [node for node in self.walk(name) if not node == primary]
+        #sort is stable, the ring order is kept
+        servers.sort(key=lambda node: not sr.alive(node))
+        return servers[:number]
+
+    def preferred(self, name, number):
+        nodes = []
+        for node in self.walk(name):
+            if sr.alive(node):
+                nodes.append(node)
+                if len(nodes) == number:
+                    break
+        return nodes
+
+def engine(kind, vnodes=64):
+    '''
+    Description: Placement of new files by name, 'load' or 'ring'
+    '''
+    if kind == 'ring':
+        return RingPlacement(vnodes)
+    return LoadPlacement()
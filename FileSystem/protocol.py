@@ -0,0 +1,26 @@
+CREATE, UPDATE, FS, FILE, REPLICATEFILE, GIVEFILE, NEWFOLDER, RENAME, QUIT, ERROR, SUCCESS, CONN, INVALID, DEL, DELTA, SYNC, FILESTART, FILECHUNK, FILEEND, CHUNKS, GIVECHUNKS, CHUNKDATA, NOTMODIFIED, ACK, DIGEST, HELLO, PING, PONG, STATS, BATCH = range(30)
+
+#names of the commands, in the order above
+COMMAND_NAMES = ['CREATE', 'UPDATE', 'FS', 'FILE', 'REPLICATEFILE', 'GIVEFILE', 'NEWFOLDER', 'RENAME', 'QUIT',
+                 'ERROR', 'SUCCESS', 'CONN', 'INVALID', 'DEL', 'DELTA', 'SYNC', 'FILESTART', 'FILECHUNK',
+                 'FILEEND', 'CHUNKS', 'GIVECHUNKS', 'CHUNKDATA', 'NOTMODIFIED', 'ACK', 'DIGEST', 'HELLO',
+                 'PING', 'PONG', 'STATS', 'BATCH']
+
+#size of the chunks files are streamed in
+CHUNK_SIZE = 65536
+
+class CommandObject(object):
+    '''
+    A command object to pass. It ensures security
+    id: set by the sender of a request, copied into the reply so
+    many requests can be in flight on one connection.
+    reply: True if this is the reply to a request.
+    '''
+    id = None
+    reply = False
+
+    def __init__(self, command, data=None, id=None, reply=False):
+        self.command = command
+        self.data = data
+        self.id = id
+        self.reply = reply
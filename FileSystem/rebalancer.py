@@ -0,0 +1,217 @@
+import time
+import asyncio
+
+import settings as s
+import services as sr
+import replication
+
+class Rebalancer():
+    '''
+    Description: Looks through the FS every interval for files with
+    fewer copies than the servers should keep, replicas that never got
+    the latest version, or a replica on a server holding many more
+    files than one without a copy (with 'ring' placement, on a server
+    the ring does not pick), and copies the latest version.
+    A server that has been down for longer than grace no longer counts
+    as a copy and is taken out of Node/Also. A file is only fixed by the first of its servers that
+    is up and has the body, so two servers never fix the same file.
+    At most concurrency copies run at once and they are paced to
+    bandwidth bytes a second, so they do not hold up the clients.
+    '''
+    def __init__(self, local, interval=30.0, grace=60.0, concurrency=2, bandwidth=10485760, skew=0.2):
+        self.local = local
+        self.interval = interval
+        self.grace = grace
+        self.bandwidth = bandwidth
+        self.skew = skew
+        self.slots = asyncio.Semaphore(concurrency)
+        self.wakeup = asyncio.Event()
+        #time the next copy may start at to stay under the bandwidth
+        self.nextCopy = 0.0
+        self.tasks = set()
+        #(name, node) of the copies running
+        self.copying = set()
+        self.counters = {'Scans': 0, 'Checked': 0, 'UnderReplicated': 0, 'Skewed': 0,
+                         'Copies': 0, 'CopiedBytes': 0, 'Failed': 0, 'LastScan': 0.0}
+
+    def notify(self):
+        '''
+        Description: Called when a server joins, the FS is looked
+        through without waiting for the interval.
+        '''
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            try:
+                await self.scan()
+            except Exception as e:
+                print('Rebalance Error: {}'.format(e))
+
+    async def scan(self):
+        '''
+        Description: Looks through every file once, the copies it
+        starts are waited for before the next scan.
+        '''
+        start = time.perf_counter()
+        self.counters['Scans'] += 1
+        for i, name in enumerate(list(s.FILES.keys())):
+            #let the clients in between
+            if i % 100 == 0:
+                await asyncio.sleep(0)
+            plan = self.plan(name)
+            if plan == None:
+                continue
+            await self.slots.acquire()
+            task = asyncio.ensure_future(self.fix(name, *plan))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        if len(self.tasks) > 0:
+            await asyncio.wait(list(self.tasks))
+        self.counters['LastScan'] = time.perf_counter() - start
+
+    def gone(self, node):
+        return not sr.alive(node) and s.PEERS.downFor(node) >= self.grace
+
+    def plan(self, name):
+        '''
+        Description: Returns the new Node and Also of a file and the
+        servers to copy it to, None if nothing has to be done
+        '''
+        if not name in s.FILES.keys():
+            return None
+        entry = s.FILES[name][-1]
+        if not entry['Type'] == 'F' or not 'Chunks' in entry.keys() or not 'Node' in entry.keys():
+            return None
+        self.counters['Checked'] += 1
+        holders = [entry['Node']] + list(entry['Also'])
+        up = [node for node in holders if node in s.SERVERS.keys() and sr.alive(node)]
+        if len(up) == 0 or not up[0] == self.local or len(s.STORE.missing(entry['Chunks'])) > 0:
+            return None
+        keep = [node for node in holders if node in s.SERVERS.keys() and not self.gone(node)]
+        node = entry['Node'] if entry['Node'] in keep else self.local
+        also = [other for other in keep if not other == node]
+        free = [other for other in s.SERVERS.keys() if sr.alive(other) and not other in holders]
+        free.sort(key=lambda other: (sr.nodeLoad(other), other))
+        #replicas that never got the latest version
+        behind = [other for other in also if other in s.LAGGING.get(name, ()) and sr.alive(other)
+                  and not (name, other) in self.copying]
+        missing = sr.copiesWanted() - 1 - len(also)
+        if missing > 0 or len(behind) > 0:
+            if len(free) == 0 and len(behind) == 0 and len(also) == len(entry['Also']):
+                return None
+            self.counters['UnderReplicated'] += 1
+            return (node, also + free[:missing], behind + free[:max(0, missing)])
+        if len(free) == 0 or len(also) == 0:
+            return None
+        preferred = s.PLACER.preferred(name, sr.copiesWanted())
+        if not preferred == None:
+            #move a replica to a server the placement engine wants
+            #the file on
+            out = [other for other in also if not other in preferred]
+            into = [other for other in preferred if other in free]
+            if len(out) == 0 or len(into) == 0:
+                return None
+            self.counters['Skewed'] += 1
+            return (node, [into[0] if other == out[0] else other for other in also], [into[0]])
+        #move the replica on the busiest server to the least busy one
+        busiest = max(also, key=lambda other: (sr.nodeLoad(other), other))
+        if sr.nodeLoad(busiest) <= (1 + self.skew) * sr.nodeLoad(free[0]) + 1:
+            return None
+        self.counters['Skewed'] += 1
+        return (node, [free[0] if other == busiest else other for other in also], [free[0]])
+
+    async def fix(self, name, node, also, targets):
+        '''
+        Description: Copies the latest version of a file to the targets
+        and only then makes the new servers copies in Also. A replica
+        moved to another server is dropped once that server ACKs, if
+        the copy fails the file keeps the replicas it had.
+        '''
+        try:
+            await s.LOCKS.acquire([name])
+            try:
+                entry = s.FILES[name][-1] if name in s.FILES.keys() else None
+                if entry == None or not 'Chunks' in entry.keys():
+                    return
+                #servers that are gone are taken out now, the new ones
+                #are added once they have the body
+                holders = [entry['Node']] + list(entry['Also'])
+                kept = [other for other in holders if not other == node and other in s.SERVERS.keys()
+                        and not self.gone(other)]
+                if not entry['Node'] == node or not entry['Also'] == kept:
+                    await self.setFields(name, Node=node, Also=kept)
+                version = len(s.FILES[name]) - 1
+                chunks = entry['Chunks']
+                size = entry['Size'] if 'Size' in entry.keys() else 0
+            finally:
+                s.LOCKS.release([name])
+            added = [other for other in also if not other in kept]
+            copied = []
+            for target in targets:
+                self.copying.add((name, target))
+                try:
+                    await self.pace(size)
+                    ok = await s.REPLICATOR.send(name, version, chunks, target)
+                finally:
+                    self.copying.discard((name, target))
+                if ok:
+                    copied.append(target)
+                    self.counters['Copies'] += 1
+                    self.counters['CopiedBytes'] += size
+                else:
+                    self.counters['Failed'] += 1
+                    if target in added:
+                        #never became a copy, nothing to lag behind
+                        replication.caughtUp(name, target)
+            new = [other for other in added if other in copied]
+            if len(new) == 0:
+                return
+            await s.LOCKS.acquire([name])
+            try:
+                entry = s.FILES[name][-1] if name in s.FILES.keys() else None
+                #a newer version or placement was written meanwhile
+                if entry == None or not entry.get('Chunks') == chunks or not entry['Node'] == node \
+                        or not entry['Also'] == kept:
+                    return
+                if len(new) == len(added):
+                    await self.setFields(name, Also=also)
+                else:
+                    await self.setFields(name, Also=kept + new)
+            finally:
+                s.LOCKS.release([name])
+        except Exception as e:
+            self.counters['Failed'] += 1
+            print('Rebalance Error in {}: {}'.format(name, e))
+        finally:
+            self.slots.release()
+
+    async def pace(self, size):
+        '''
+        Description: Waits until a copy of size bytes can start
+        without going over the bandwidth
+        '''
+        now = time.monotonic()
+        start = max(now, self.nextCopy)
+        self.nextCopy = start + size / self.bandwidth
+        if start > now:
+            await asyncio.sleep(start - now)
+
+    async def setFields(self, name, **fields):
+        '''
+        Description: Updates fields of the latest version of a file,
+        saves and sends the change
+        '''
+        change = sr.makeChange('SET', name, {'Version': len(s.FILES[name]) - 1, 'Fields': fields})
+        await s.JOURNAL.append([sr.stateOf(other) for other in sr.touched([change])])
+        s.BROADCAST.notify(1)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['Running'] = len(self.tasks)
+        return stats
@@ -0,0 +1,131 @@
+import time
+import asyncio
+import itertools
+
+import settings as s
+from protocol import *
+from diskio import Latency
+
+class Replicator():
+    '''
+    Description: Sends the new versions of files to their replicas, all
+    at the same time, and counts the ACKs they send back. A write is
+    done once the write concern is met:
+    - async: right away, replication goes on in the background
+    - one: one replica has the version
+    - majority: most of the copies (the primary counts as one)
+    A replica that does not ACK in time is sent the version again, with
+    a longer wait every time, and is lagging until it ACKs.
+    '''
+    def __init__(self, concern='async', timeout=10.0, retries=3):
+        self.concern = concern
+        self.timeout = timeout
+        self.retries = retries
+        self.ids = itertools.count(1)
+        #ack: future
+        self.acks = {}
+        self.latency = {'Primary': Latency(), 'Replica': Latency(), 'Concern': Latency()}
+        self.counters = {'Writes': 0, 'Acks': 0, 'Retries': 0, 'Failed': 0, 'ConcernMissed': 0}
+
+    def needed(self, replicas):
+        '''
+        Description: Number of replica ACKs the write concern asks for
+        '''
+        if self.concern == 'one':
+            return min(1, replicas)
+        if self.concern == 'majority':
+            return (1 + replicas) // 2
+        return 0
+
+    async def replicate(self, name, nodes):
+        '''
+        Description: Sends the latest version of a file to its replicas.
+        Returns once the write concern is met, False if it cannot be.
+        '''
+        self.counters['Writes'] += 1
+        start = time.perf_counter()
+        #an UPDATE from another server can add a version without a
+        #body while the file is written, the written one is sent
+        version = len(s.FILES[name]) - 1
+        while version > 0 and not 'Chunks' in s.FILES[name][version].keys():
+            version -= 1
+        entry = s.FILES[name][version]
+        if not 'Chunks' in entry.keys():
+            return False
+        tasks = [asyncio.ensure_future(self.send(name, version, entry['Chunks'], node)) for node in nodes]
+        needed = self.needed(len(nodes))
+        if needed == 0:
+            return True
+        acked = 0
+        for task in asyncio.as_completed(tasks):
+            if await task:
+                acked += 1
+                if acked == needed:
+                    self.latency['Concern'].add(time.perf_counter() - start)
+                    return True
+        self.counters['ConcernMissed'] += 1
+        return False
+
+    async def send(self, name, version, chunks, node):
+        '''
+        Description: Sends a version to one replica until it ACKs or
+        the retries run out.
+        '''
+        lagging(name, node)
+        wait = self.timeout
+        for attempt in range(1 + self.retries):
+            if attempt > 0:
+                self.counters['Retries'] += 1
+                #a newer version was written, it is sent on its own
+                if not name in s.FILES.keys() or not s.FILES[name][-1].get('Chunks') == chunks:
+                    return False
+            if not node in s.CONNECTIONS.keys():
+                await asyncio.sleep(wait)
+                wait *= 2
+                continue
+            ack = next(self.ids)
+            future = asyncio.get_running_loop().create_future()
+            self.acks[ack] = future
+            start = time.perf_counter()
+            try:
+                await s.CONNECTIONS[node].write_q.put(CommandObject(CHUNKS, {'Name': name,
+                                                                            'Version': version,
+                                                                            'Chunks': chunks,
+                                                                            'Ack': ack}))
+                await asyncio.wait_for(future, wait)
+                self.latency['Replica'].add(time.perf_counter() - start)
+                self.counters['Acks'] += 1
+                caughtUp(name, node)
+                return True
+            except asyncio.TimeoutError:
+                wait *= 2
+            finally:
+                self.acks.pop(ack, None)
+        self.counters['Failed'] += 1
+        return False
+
+    def acked(self, ack):
+        '''
+        Description: Called when a replica ACKs a version
+        '''
+        future = self.acks.get(ack)
+        if not future == None and not future.done():
+            future.set_result(True)
+
+    def stats(self):
+        stats = dict(self.counters)
+        stats['Lagging'] = {name: sorted(nodes) for name, nodes in s.LAGGING.items()}
+        for kind, latency in self.latency.items():
+            stats[kind] = latency.stats()
+        return stats
+
+def lagging(name, node):
+    if not name in s.LAGGING.keys():
+        s.LAGGING[name] = set()
+    s.LAGGING[name].add(node)
+
+def caughtUp(name, node):
+    if name in s.LAGGING.keys():
+        s.LAGGING[name].discard(node)
+        if len(s.LAGGING[name]) == 0:
+            del s.LAGGING[name]
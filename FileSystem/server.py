@@ -4,38 +4,57 @@ import json
 import sys
 import asyncio
 import functools
+import time
+from collections import deque
 
 import settings as s
 import connection
-
-
-async def client_connected(reader, writer, fs=False):
+import services as sr
+from protocol import *
+from journal import Journal
+from locks import NameLocks
+from diskio import DiskIO
+from broadcast import Broadcaster
+from chunks import ChunkStore
+from cache import LRUCache
+from replication import Replicator
+from digest import Digest
+from peers import PeerManager
+from rebalancer import Rebalancer
+import placement
+from metrics import Metrics
+
+
+async def client_connected(reader, writer, node=None):
     '''
     Description: Accepts any connections that comes.
     Makes a connection instance that takes care of the reading and writing
-    Also, if fs = true, sends an FS request to the client.
+    Connections are saved by the address of the other side until a
+    server says who it is with HELLO.
+    If node is given this server dialed that server, it is sent a
+    HELLO and the digest of the FS.
     '''
     addr = writer.get_extra_info('peername')
     print('connected with {} at {}'.format(addr[0],addr[1]))
 
-    adr = '{}/{}'.format(addr[0],addr[1])
-    s.CONNECTIONS[adr] = connection.Connection(reader, writer)
-
-    if fs == True:
+    conn = connection.Connection(reader, writer)
+    if node == None:
+        s.CONNECTIONS[conn.address] = conn
+    else:
+        s.PEERS.up(node, conn)
+        await conn.write_q.put(CommandObject(HELLO, {'Name': '{}/{}'.format(s.HOST, s.PORT)}))
         #send for Fs
-        await s.CONNECTIONS[adr].sendFs()
+        await conn.sendFs()
 
 def loadFs():
     '''
     Description: Tries to pick up the file structure on boot.
+    Loads the latest snapshot and replays the journal written after it.
     If none present, an empty dict is sent.
     '''
+    files = None
     try:
-        if os.stat(s.FILES_FILE).st_size > 0:
-            f2 = open(s.FILES_FILE ,'r+')
-            files = json.load(f2)
-            f2.close()
-            return files
+        files = s.JOURNAL.loadSnapshot()
     except OSError as e:
         #error in open
         print(e)
@@ -46,7 +65,9 @@ def loadFs():
         print(e)
         f2 = open(s.FILES_FILE, 'w+')
         f2.close()
-    return {"files": [{ "Type": "Root"}]}
+    if files == None:
+        files = {"files": [{ "Type": "Root"}]}
+    return s.JOURNAL.replay(files)
 
 def boot():
     '''
@@ -65,6 +86,45 @@ def boot():
             port = data['port'] if 'port' in data.keys() else ''
             servers = data['servers'] if 'servers' in data.keys() else {}
             root = data['root'] if 'root' in data.keys() else ''
+            #optional settings
+            s.CHANGELOG_SIZE = data['changelog'] if 'changelog' in data.keys() else s.CHANGELOG_SIZE
+            s.FSYNC = data['fsync'] if 'fsync' in data.keys() else s.FSYNC
+            s.FSYNC_INTERVAL = data['fsyncInterval'] if 'fsyncInterval' in data.keys() else s.FSYNC_INTERVAL
+            s.GROUP_COMMIT = data['groupCommit'] if 'groupCommit' in data.keys() else s.GROUP_COMMIT
+            s.SNAPSHOT_EVERY = data['snapshotEvery'] if 'snapshotEvery' in data.keys() else s.SNAPSHOT_EVERY
+            s.BYTES_PER_FILE = data['bytesPerFile'] if 'bytesPerFile' in data.keys() else s.BYTES_PER_FILE
+            s.WORKERS_SIZE = data['workers'] if 'workers' in data.keys() else s.WORKERS_SIZE
+            s.TRANSFER_QUEUE = data['transferQueue'] if 'transferQueue' in data.keys() else s.TRANSFER_QUEUE
+            s.CODEC = data['codec'] if 'codec' in data.keys() else s.CODEC
+            s.ACCEPT_DILL = data['acceptDill'] if 'acceptDill' in data.keys() else s.ACCEPT_DILL
+            s.MSG_QUEUE = data['msgQueue'] if 'msgQueue' in data.keys() else s.MSG_QUEUE
+            s.WRITE_QUEUE = data['writeQueue'] if 'writeQueue' in data.keys() else s.WRITE_QUEUE
+            s.WRITE_BATCH = data['writeBatch'] if 'writeBatch' in data.keys() else s.WRITE_BATCH
+            s.HIGH_WATER = data['highWater'] if 'highWater' in data.keys() else s.HIGH_WATER
+            s.LOW_WATER = data['lowWater'] if 'lowWater' in data.keys() else s.LOW_WATER
+            s.IO_THREADS = data['ioThreads'] if 'ioThreads' in data.keys() else s.IO_THREADS
+            s.BROADCAST_WINDOW = data['broadcastWindow'] if 'broadcastWindow' in data.keys() else s.BROADCAST_WINDOW
+            s.BROADCAST_MAX = data['broadcastMax'] if 'broadcastMax' in data.keys() else s.BROADCAST_MAX
+            s.CACHE_BYTES = data['cacheBytes'] if 'cacheBytes' in data.keys() else s.CACHE_BYTES
+            s.READ_ROUTING = data['readRouting'] if 'readRouting' in data.keys() else s.READ_ROUTING
+            s.READ_PROXY = data['readProxy'] if 'readProxy' in data.keys() else s.READ_PROXY
+            s.WRITE_CONCERN = data['writeConcern'] if 'writeConcern' in data.keys() else s.WRITE_CONCERN
+            s.ACK_TIMEOUT = data['ackTimeout'] if 'ackTimeout' in data.keys() else s.ACK_TIMEOUT
+            s.ACK_RETRIES = data['ackRetries'] if 'ackRetries' in data.keys() else s.ACK_RETRIES
+            s.DIGEST_BUCKETS = data['digestBuckets'] if 'digestBuckets' in data.keys() else s.DIGEST_BUCKETS
+            s.HEARTBEAT_INTERVAL = data['heartbeatInterval'] if 'heartbeatInterval' in data.keys() else s.HEARTBEAT_INTERVAL
+            s.HEARTBEAT_TIMEOUT = data['heartbeatTimeout'] if 'heartbeatTimeout' in data.keys() else s.HEARTBEAT_TIMEOUT
+            s.DIAL_BACKOFF = data['dialBackoff'] if 'dialBackoff' in data.keys() else s.DIAL_BACKOFF
+            s.DIAL_BACKOFF_MAX = data['dialBackoffMax'] if 'dialBackoffMax' in data.keys() else s.DIAL_BACKOFF_MAX
+            s.REBALANCE_INTERVAL = data['rebalanceInterval'] if 'rebalanceInterval' in data.keys() else s.REBALANCE_INTERVAL
+            s.REBALANCE_GRACE = data['rebalanceGrace'] if 'rebalanceGrace' in data.keys() else s.REBALANCE_GRACE
+            s.REBALANCE_CONCURRENCY = data['rebalanceConcurrency'] if 'rebalanceConcurrency' in data.keys() else s.REBALANCE_CONCURRENCY
+            s.REBALANCE_BANDWIDTH = data['rebalanceBandwidth'] if 'rebalanceBandwidth' in data.keys() else s.REBALANCE_BANDWIDTH
+            s.REBALANCE_SKEW = data['rebalanceSkew'] if 'rebalanceSkew' in data.keys() else s.REBALANCE_SKEW
+            s.PLACEMENT = data['placement'] if 'placement' in data.keys() else s.PLACEMENT
+            s.RING_VNODES = data['ringVnodes'] if 'ringVnodes' in data.keys() else s.RING_VNODES
+            s.STATS_FILE = data['statsFile'] if 'statsFile' in data.keys() else s.STATS_FILE
+            s.STATS_INTERVAL = data['statsInterval'] if 'statsInterval' in data.keys() else s.STATS_INTERVAL
             #make files folder
             if not os.path.isdir(root):
                 os.mkdir(root)
@@ -88,28 +148,6 @@ def boot():
     return (None, None, {}, None)
 
 
-async def send_connect():
-    '''
-    Description: Tries to connect with all the servers already in the config
-    file. Keeps on retrying until all connections have been connected.
-    then breaks out of the loop.
-    '''
-    done = False
-    while not done:
-        await asyncio.sleep(5)
-        for connection, addr  in s.SERVERS.items():
-            if connection == '{}/{}'.format(s.HOST,s.PORT) or addr['connected'] == True:
-                continue
-            elif addr['connected'] == False:
-                try:
-                    reader, writer = await asyncio.open_connection(addr['ip'] , int(addr['port']))
-                    addr['connected'] = True
-                    done = True
-                    await client_connected(reader, writer, fs=True)
-                except Exception as e:
-                    #print('Error in {} {}: {}'.format(addr['ip'] , addr['port'], e))
-                    done = False
-
 async def server():
     '''
     Description: Makes the server. Starts the server.
@@ -137,17 +175,50 @@ async def main():
     for connection, addr  in s.SERVERS.items():
         addr['connected'] = False
 
+    s.METRICS = Metrics()
+    s.DISK = DiskIO(s.IO_THREADS)
+    s.JOURNAL = Journal(s.JOURNAL_FILE, s.FILES_FILE, s.DISK, s.FSYNC, s.FSYNC_INTERVAL,
+                        s.GROUP_COMMIT, s.SNAPSHOT_EVERY)
+    s.STORE = ChunkStore(s.CHUNKS_DIR, s.DISK)
+    s.STORE.open()
+    s.DIGEST = Digest(s.DIGEST_BUCKETS)
     s.FILES = loadFs()
+    sr.buildIndex()
+    s.STORE.sweep()
+    s.CACHE = LRUCache(s.CACHE_BYTES)
+    s.PLACER = placement.engine(s.PLACEMENT, s.RING_VNODES)
+    s.REPLICATOR = Replicator(s.WRITE_CONCERN, s.ACK_TIMEOUT, s.ACK_RETRIES)
+    #changes are numbered from the start in every run of the server
+    s.EPOCH = int(time.time())
+    s.CHANGES = deque(maxlen=s.CHANGELOG_SIZE)
+    s.REMOVED = deque(maxlen=s.CHANGELOG_SIZE)
 
     #if there was an error, exit
     if None in [s.HOST,s.PORT]:
         print('Error in Boot. Reconfigure')
         sys.exit(0)
 
+    s.JOURNAL.open(s.FILES)
+    s.LOCKS = NameLocks()
+    s.WORKERS = asyncio.Semaphore(s.WORKERS_SIZE)
+    s.BROADCAST = Broadcaster('{}/{}'.format(s.HOST, s.PORT), s.BROADCAST_WINDOW, s.BROADCAST_MAX)
+    s.PEERS = PeerManager('{}/{}'.format(s.HOST, s.PORT), s.HEARTBEAT_INTERVAL, s.HEARTBEAT_TIMEOUT,
+                          s.DIAL_BACKOFF, s.DIAL_BACKOFF_MAX)
+    s.REBALANCER = Rebalancer('{}/{}'.format(s.HOST, s.PORT), s.REBALANCE_INTERVAL, s.REBALANCE_GRACE,
+                              s.REBALANCE_CONCURRENCY, s.REBALANCE_BANDWIDTH, s.REBALANCE_SKEW)
+
     #do the connections
+    loops = []
+    if not s.STATS_FILE == None:
+        loops.append(s.METRICS.dumpLoop(s.STATS_FILE, s.STATS_INTERVAL))
     await asyncio.gather(
-        send_connect(),
+        s.JOURNAL.run(),
+        s.DISK.watchLoop(),
+        s.BROADCAST.run(),
+        s.PEERS.run(client_connected),
+        s.REBALANCER.run(),
         server(),
+        *loops,
     )
     return
 
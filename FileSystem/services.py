@@ -1,6 +1,9 @@
 import settings as s
-from collections import Counter
+import itertools
+import hashlib
+import json
 import random
+from names import NameIndex
 
 def rename(old, new):
     '''
@@ -8,9 +11,14 @@ def rename(old, new):
     new file name and returns true is succcessful
     '''
     if old in s.FILES.keys():
+        indexName(new, -1)
         data = s.FILES[old]
+        if not s.DIGEST == None:
+            s.DIGEST.toggle(old, data, -1)
         del s.FILES[old]
         s.FILES[new] = data
+        if not s.DIGEST == None:
+            s.DIGEST.toggle(new, data, 1)
         return True
 
     return False
@@ -30,120 +38,341 @@ def findFile(name):
     else:
         return False
 
-def updateFs(remoteFs):
-    '''
-    Description: Function to simply update the fs with the remoteFs
-    if file already exists, a value is added in the version list.
-    '''
-    for file, des in remoteFs.items():
-        #if file found in currFs and that value has different length than the remote Fs
-        if file in s.FILES.keys() and len(s.FILES[file]) != len(remoteFs[file]):
-            #for the difference
-            for l in range(len(remoteFs[file]) - len(s.FILES[file]), 0, -1):
-                try:
-                    #pick that entry in the remoteFs
-                    entryNo = '-{}'.format(l)
-                    #update the fs
-                    s.FILES[file].append(remoteFs[file][int(entryNo)])
-                except Exception as e:
-                    print('Error in updating FS: {}'.format(e))
-                    return False
-        elif file not in s.FILES.keys():
-            s.FILES[file] = des
+def newer(mine, theirs):
+    '''
+    Description: Checks a version sent by another server wins over the
+    same version here. Every SET of a version counts up its 'Rev', the
+    one changed most wins. Ties are broken the same way on every
+    server, so two servers merging each other's FS agree.
+    '''
+    if mine == theirs:
+        return False
+    return (theirs.get('Rev', 0), json.dumps(theirs, sort_keys=True)) > \
+        (mine.get('Rev', 0), json.dumps(mine, sort_keys=True))
 
-    return True
+def mergeVersions(mine, theirs):
+    '''
+    Description: Merges two version lists of a name one version at a
+    time, versions only one of them has are kept.
+    '''
+    merged = [theirs[i] if i < len(theirs) and newer(mine[i], theirs[i]) else mine[i] for i in range(len(mine))]
+    return merged + theirs[len(mine):]
 
-def NodeToSaveOn():
+def removedNames(buckets=None):
     '''
-    Description: Finds the node to save a new file on creation.
-    Assumes the one with the lesser number of files is the free one
-    and hence that will be the node selected.
-    '''
-    #get file structure
-    files = s.FILES
-    #figure out which node to save file on
-    #saving in whichever has the lowest data
-    counts = Counter()
-    for items, des in s.FILES.items():
-        if 'Node' in des[-1].keys():
-            counts[des[-1]['Node']] += 1
-        if 'Also' in des[-1].keys():
-            if len(des[-1]['Also']) > 0:
-                counts[des[-1]['Also'][-1]] += 1
-
-        if len(counts) < len(s.SERVERS):
-            for server in s.SERVERS.keys():
-                if server not in counts.keys():
-                    return server
+    Description: Names deleted or renamed away that are still not in
+    the FS, the last CHANGELOG_SIZE of them. Only the names in buckets
+    of the digest if given.
+    '''
+    names = set(name for name in s.REMOVED if not name in s.FILES.keys())
+    if not buckets == None:
+        buckets = set(buckets)
+        names = set(name for name in names if s.DIGEST.bucket(name) in buckets)
+    return names
+
+def replacedNames(remoteFs, origin, applied):
+    '''
+    Description: Names here the whole FS of origin (remoteFs) removes.
+    They are not in it and either origin is their primary, or this
+    server is and has not changed them since the change origin last
+    applied from it (applied). Names of other primaries are left to
+    their primary.
+    '''
+    local = '{}/{}'.format(s.HOST, s.PORT)
+    epoch, seq = applied if not applied == None else (None, 0)
+    unseen = changesSince(seq if epoch == s.EPOCH else 0)
+    kept = None if unseen == None else set(touched(unseen))
+    names = set()
+    for name, versions in s.FILES.items():
+        if name in remoteFs.keys():
+            continue
+        node = versions[-1].get('Node')
+        if node == origin or (node == local and not kept == None and not name in kept):
+            names.add(name)
+    return names
+
+def updateFs(remoteFs, covered=(), removed=()):
+    '''
+    Description: Merges the FS, or a part of it, sent by another server.
+    Versions are merged one by one with mergeVersions. covered are the
+    names here the other server would have sent if it had them, they
+    are removed if it deleted or renamed them (removed). Names removed
+    here are not taken back. Changes go through applyChange so the
+    indexes stay right. Returns the change records applied.
+    '''
+    changes = []
+    mine = removedNames() if len(remoteFs) > 0 else set()
+    for name, versions in remoteFs.items():
+        if name in s.FILES.keys():
+            merged = mergeVersions(s.FILES[name], versions)
+            if merged == s.FILES[name]:
+                continue
+        elif name in mine:
+            continue
         else:
-            counts = counts.most_common()
-            return counts[-1][0]
+            merged = versions
+        changes.append({'Op': 'PUT', 'Name': name, 'Data': merged})
+    removed = set(removed)
+    for name in covered:
+        if name in remoteFs.keys() or not name in s.FILES.keys():
+            continue
+        if name in removed:
+            changes.append({'Op': 'DEL', 'Name': name})
+    for change in changes:
+        applyChange(change)
+    return changes
+
+def applyChange(change):
+    '''
+    Description: Applies a single change record to the FS.
+    PUT replaces the version list of a name, APPEND adds the next
+    version of a file, SET updates fields of a version, RENAME
+    moves a name and DEL removes it.
+    Applying the same change twice leaves the FS unchanged.
+    '''
+    op = change['Op']
+    name = change['Name']
+    if op in ['RENAME', 'DEL'] and name in s.FILES.keys():
+        s.REMOVED.append(name)
+    if op == 'RENAME':
+        return rename(name, change['Data'])
+    indexName(name, -1)
+    if op == 'PUT':
+        s.FILES[name] = change['Data']
+    elif op == 'APPEND':
+        #only append if this is the next version of the file
+        if name in s.FILES.keys() and len(s.FILES[name]) == change['Data']['Version']:
+            s.FILES[name].append(change['Data'])
+    elif op == 'SET':
+        #update fields of one version of a file
+        version = change['Data']['Version']
+        if name in s.FILES.keys() and len(s.FILES[name]) > version:
+            s.FILES[name][version].update(change['Data']['Fields'])
+    elif op == 'DEL':
+        s.FILES.pop(name, None)
+    indexName(name, 1)
+    return True
+
+def makeChange(op, name, data=None):
+    '''
+    Description: Applies a local mutation to the FS and records it
+    in the change log. Returns the sequenced change record that
+    is sent to the other servers.
+    '''
+    if op == 'SET' and name in s.FILES.keys() and len(s.FILES[name]) > data['Version']:
+        #merges of the FS keep the version changed most
+        data['Fields']['Rev'] = s.FILES[name][data['Version']].get('Rev', 0) + 1
+    s.SEQ += 1
+    change = {'Seq': s.SEQ, 'Op': op, 'Name': name, 'Data': data}
+    applyChange(change)
+    s.CHANGES.append(change)
+    return change
+
+def touched(changes):
+    '''
+    Description: Returns the names changed by a list of changes
+    '''
+    names = []
+    for change in changes:
+        names.append(change['Name'])
+        if change['Op'] == 'RENAME':
+            names.append(change['Data'])
+    return names
+
+def stateOf(name):
+    '''
+    Description: Returns a record of the current state of a name
+    in the FS, used by the journal.
+    '''
+    if name in s.FILES.keys():
+        return {'Op': 'PUT', 'Name': name, 'Data': s.FILES[name]}
+    return {'Op': 'DEL', 'Name': name}
+
+def versionTag(entry):
+    '''
+    Description: Tag of the body of a version, changes whenever the
+    body does. None for bodies saved before the chunk store.
+    '''
+    if not 'Chunks' in entry.keys():
+        return None
+    return hashlib.sha256(''.join(entry['Chunks']).encode('ascii')).hexdigest()
+
+def applyChanges(origin, epoch, changes):
+    '''
+    Description: Incremental update of the FS with the changes sent
+    by another server. Changes already applied are skipped.
+    Returns False if a change is missing, in which case the
+    server is too far behind and has to sync with the origin.
+    '''
+    lastEpoch, last = s.APPLIED.get(origin, (None, 0))
+    #origin restarted, its sequence starts from the beginning
+    if not lastEpoch == epoch:
+        last = 0
+    for change in changes:
+        if change['Seq'] <= last:
+            continue
+        if not change['Seq'] == last + 1:
+            s.APPLIED[origin] = (epoch, last)
+            return False
+        applyChange(change)
+        last = change['Seq']
+    s.APPLIED[origin] = (epoch, last)
+    return True
+
+def changesSince(seq):
+    '''
+    Description: Finds the local changes after seq.
+    Returns None if the change log does not go back that far
+    and a full FS has to be sent instead.
+    '''
+    if seq >= s.SEQ:
+        return []
+    if len(s.CHANGES) == 0 or s.CHANGES[0]['Seq'] > seq + 1:
+        return None
+    start = seq + 1 - s.CHANGES[0]['Seq']
+    return list(itertools.islice(s.CHANGES, start, None))
 
-    return None
+def indexName(name, sign):
+    '''
+    Description: Adds (sign 1) or removes (sign -1) the latest version
+    of a name from the node load index, the chunks of its versions
+    held by this server from the chunk store and the name from the
+    digest. Called around every change to the FS so the indexes never
+    have to be rebuilt.
+    '''
+    if not name in s.FILES.keys():
+        return
+    if not s.DIGEST == None:
+        s.DIGEST.toggle(name, s.FILES[name], sign)
+    if not s.STORE == None:
+        local = '{}/{}'.format(s.HOST, s.PORT)
+        for version in s.FILES[name]:
+            if 'Chunks' in version.keys() and (version['Node'] == local or local in version['Also']):
+                s.STORE.ref(version['Chunks'], sign)
+    entry = s.FILES[name][-1]
+    if not 'Node' in entry.keys():
+        return
+    size = entry['Size'] if 'Size' in entry.keys() else 0
+    nodes = [entry['Node']]
+    if 'Also' in entry.keys():
+        nodes += entry['Also']
+    for node in nodes:
+        if not node in s.LOAD.keys():
+            s.LOAD[node] = {'Files': 0, 'Bytes': 0, 'Primaries': 0}
+        s.LOAD[node]['Files'] += sign
+        s.LOAD[node]['Bytes'] += sign * size
+    #writes go to the primary
+    s.LOAD[entry['Node']]['Primaries'] += sign
+
+def buildIndex():
+    '''
+    Description: Builds the node load index, the name index, the
+    chunk counts and the digest from the FS on boot
+    '''
+    s.LOAD = {}
+    if not s.STORE == None:
+        s.STORE.refs = {}
+    if not s.DIGEST == None:
+        s.DIGEST.clear()
+    for name in s.FILES.keys():
+        indexName(name, 1)
+    s.NAMES = NameIndex(s.FILES)
 
-def replicate(nodeSaved):
+def nodeLoad(node):
+    '''
+    Description: Load of a node. Every BYTES_PER_FILE bytes stored
+    weigh as much as one file.
+    '''
+    if not node in s.LOAD.keys():
+        return 0
+    return s.LOAD[node]['Files'] + s.LOAD[node]['Bytes'] / s.BYTES_PER_FILE
+
+def primaries(node):
+    '''
+    Description: Number of files a node is the primary of
+    '''
+    if not node in s.LOAD.keys():
+        return 0
+    return s.LOAD[node]['Primaries']
+
+def alive(node):
+    '''
+    Description: Checks a server is up, this server or a peer it is
+    connected to
+    '''
+    return s.SERVERS[node].get('connected', True)
+
+def NodeToSaveOn(name=None):
+    '''
+    Description: Finds the node to save a new file on creation.
+    The placement engine picks it, the least loaded server with 'load'
+    or the first server after the name on the hash ring with 'ring'.
+    Only servers that are up are picked.
+    '''
+    return s.PLACER.primary(name)
+
+def replicate(nodeSaved, name=None):
     '''
     Description: Replication function that runs on file creation.
     Assumption: Majority of the servers should have replication.
+    The placement engine picks them, servers that are up before the
+    ones that are down.
     '''
-    counts = Counter()
-    for items, des in s.FILES.items():
-        if 'Node' in des[-1].keys():
-            counts[des[-1]['Node']] += 1
-        if 'Also' in des[-1].keys():
-            if len(des[-1]['Also']) > 0:
-                counts[des[-1]['Also'][-1]] += 1
-
     #find how many nodes to replicate on
     #int to get a whole number.
-    #wont add the plus 1 because already saved on one server which is
-    #the primary
     number = int(len(s.SERVERS)/2)+1
-    nodes = set()
-    counts = counts.most_common()
-    servers = list(s.SERVERS.keys())
-    if len(counts) == 0:
-        for _ in range(number):
-            i =  random.randint(0,len(servers)-1)
-            if not servers[i] == nodeSaved:
-                nodes.add(servers[i])
-            else:
-                if len(servers) > i+1:
-                    nodes.add(servers[i+1])
-                else:
-                    nodes.add(servers[i-1])
-        return nodes
-
-    if len(counts) == 1:
-        for i in range(number):
-            if not servers[i] == counts[0][0] and not servers[i] == nodeSaved:
-                nodes.add(servers[i])
-        return nodes
+    return s.PLACER.replicas(name, nodeSaved, number)
 
-    if len(counts) == 2:
-        for server in servers:
-            if not server == nodeSaved:
-                if server not in [counts[0][0],counts[1][0]]:
-                    nodes.add(server)
-                    if len(nodes) == number - 1:
-                        return nodes
-        return nodes
+def copiesWanted():
+    '''
+    Description: Number of copies of a file the servers keep, the
+    primary and the replicas replicate() picks
+    '''
+    return min(len(s.SERVERS), int(len(s.SERVERS)/2) + 2)
 
-    if len(counts) > number:
-        for i in range(2,(2+number)):
-            nodes.add(counts[int('-'+str(i))][0])
-        return nodes
+def readCost(node):
+    '''
+    Description: Cost of reading from a node. The measured round trip
+    time with 'latency' read routing, the node load with 'load'.
+    '''
+    if s.READ_ROUTING == 'latency':
+        return s.RTT.get(node, 0.0)
+    return nodeLoad(node)
 
+def readNodes(name, exclude=()):
+    '''
+    Description: Connected servers that hold the latest version of a
+    file, in the order to read from them. The first is the cheaper of
+    two picked at random, so the readers of a popular file are spread
+    over its replicas instead of all going to the cheapest one.
+    Replicas still lagging behind the latest version are left out.
+    '''
+    nodes = findFile(name)
+    if nodes == False:
+        return []
+    lagging = s.LAGGING.get(name, ())
+    nodes = [node for node in nodes if node in s.CONNECTIONS.keys() and not node in exclude
+             and not node in lagging]
+    nodes.sort(key=lambda node: (readCost(node), node))
+    if len(nodes) > 1:
+        #ties go to whichever was picked first
+        first = min(random.sample(nodes, 2), key=readCost)
+        nodes.remove(first)
+        nodes.insert(0, first)
     return nodes
 
-def checkName(name):
-    if name not in s.FILES.keys():
-        return name
+def recordRtt(node, seconds):
+    '''
+    Description: Adds a round trip time measured to a node to its
+    moving average
+    '''
+    if node in s.RTT.keys():
+        s.RTT[node] = 0.8 * s.RTT[node] + 0.2 * seconds
     else:
-        i = 1
-        temp = name.rsplit('.',1)
-        name = '{}({}).{}'.format(temp[0],i,temp[1])
-        while name in s.FILES.keys():
-            i += 1
-            name = '{}({}).{}'.format(temp[0],i,temp[1])
-    return name
+        s.RTT[node] = seconds
+
+def checkName(name):
+    '''
+    Description: Returns a free name for a new entry in the FS
+    '''
+    return s.NAMES.allocate(name)
@@ -0,0 +1,147 @@
+import asyncio
+import struct
+import sys
+import itertools
+
+from protocol import *
+import codec
+
+class Client():
+    '''
+    Description: Long lived connection to a server. Every request gets
+    an id and the server copies it into the reply, so many requests
+    can be in flight on the one connection at the same time.
+    '''
+    def __init__(self, ip, port, codec='binary', exitOnError=True, allowDill=True):
+        self.ip = ip
+        self.port = port
+        #binary, or dill for servers not updated yet
+        self.codec = codec
+        #dill replies are decoded
+        self.allowDill = allowDill
+        #servers use clients to each other and must not exit
+        self.exitOnError = exitOnError
+        self.reader = None
+        self.writer = None
+        self.readTask = None
+        self.lock = None
+        self.ids = itertools.count(1)
+        self.pending = {}
+
+    async def connect(self):
+        '''
+        Description: Connects with the server unless already connected
+        '''
+        if self.lock == None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            if not self.writer == None and not self.writer.is_closing():
+                return
+            try:
+                self.reader, self.writer = await asyncio.open_connection(self.ip, self.port)
+            except Exception as e:
+                print(e)
+                if not self.exitOnError:
+                    raise
+                sys.exit()
+            self.readTask = asyncio.ensure_future(self.read())
+
+    async def __aenter__(self):
+        '''
+        Description: Function to enter and connect with the server.
+        The connection stays open after the block.
+        '''
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *args, **kwargs):
+        pass
+
+    async def send(self, data):
+        '''
+        Description: Function to send data to the server
+        '''
+        await self.connect()
+        parts = codec.encode(data, self.codec)
+        header = struct.pack('!I', sum(len(part) for part in parts))
+        self.writer.write(header)
+        for part in parts:
+            self.writer.write(part)
+
+    async def request(self, data):
+        '''
+        Description: Sends a request and waits for the reply with
+        the same id. Returns None if the connection is lost.
+        '''
+        async for message in self.stream(data):
+            return message
+
+    async def stream(self, data):
+        '''
+        Description: Sends a request and yields every reply with the
+        same id. A streamed file comes as FILESTART, FILECHUNKs and
+        FILEEND; any other reply ends the stream. Yields None if the
+        connection is lost.
+        '''
+        data.id = next(self.ids)
+        replies = asyncio.Queue()
+        self.pending[data.id] = replies
+        try:
+            await self.send(data)
+            while True:
+                message = await replies.get()
+                yield message
+                if message == None or not message.command in [FILESTART, FILECHUNK]:
+                    return
+        finally:
+            self.pending.pop(data.id, None)
+
+    async def sendFile(self, name, f):
+        '''
+        Description: Streams an open file to the server in chunks.
+        Returns the reply to the end of the transfer.
+        '''
+        xfer = next(self.ids)
+        await self.send(CommandObject(FILESTART, {'Name': name, 'Xfer': xfer}))
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            await self.send(CommandObject(FILECHUNK, {'Xfer': xfer, 'Data': chunk}))
+            await self.writer.drain()
+        return await self.request(CommandObject(FILEEND, {'Xfer': xfer}))
+
+    async def read(self):
+        '''
+        Description: Reads every message from the server and hands
+        replies to the request waiting for them.
+        '''
+        try:
+            while True:
+                header = await self.reader.readexactly(4)
+                length = struct.unpack('!I', header)[0]
+
+                data = await self.reader.readexactly(length)
+                try:
+                    message = codec.decode(data, CommandObject, self.allowDill)
+                except Exception as e:
+                    print('Invalid message: {}'.format(e))
+                    continue
+                replies = self.pending.get(message.id)
+                if not replies == None:
+                    replies.put_nowait(message)
+        except (asyncio.CancelledError, asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionResetError) as e:
+            print(e)
+        finally:
+            self.writer.transport.close()
+            for replies in self.pending.values():
+                replies.put_nowait(None)
+
+    async def close(self):
+        '''
+        Description: Closes the connection with the server
+        '''
+        if not self.writer == None:
+            self.writer.transport.close()
+        if not self.readTask == None:
+            self.readTask.cancel()
@@ -1,9 +1,74 @@
+from collections import deque
+
 def init():
     global CONFIG_FILE
     global FILES_FILE
     global CONNECTIONS
     global SERVERS
     global FILES
+    global CHANGES
+    global CHANGELOG_SIZE
+    global SEQ
+    global EPOCH
+    global APPLIED
+    global REMOVED
+    global JOURNAL_FILE
+    global JOURNAL
+    global FSYNC
+    global FSYNC_INTERVAL
+    global GROUP_COMMIT
+    global SNAPSHOT_EVERY
+    global LOAD
+    global BYTES_PER_FILE
+    global NAMES
+    global LOCKS
+    global WORKERS
+    global WORKERS_SIZE
+    global TRANSFER_QUEUE
+    global CODEC
+    global ACCEPT_DILL
+    global MSG_QUEUE
+    global WRITE_QUEUE
+    global WRITE_BATCH
+    global HIGH_WATER
+    global LOW_WATER
+    global DISK
+    global IO_THREADS
+    global BROADCAST
+    global BROADCAST_WINDOW
+    global BROADCAST_MAX
+    global STORE
+    global CHUNKS_DIR
+    global CACHE
+    global CACHE_BYTES
+    global READ_ROUTING
+    global READ_PROXY
+    global RTT
+    global PEER_CLIENTS
+    global REPLICATOR
+    global WRITE_CONCERN
+    global ACK_TIMEOUT
+    global ACK_RETRIES
+    global LAGGING
+    global DIGEST
+    global DIGEST_BUCKETS
+    global PEERS
+    global HEARTBEAT_INTERVAL
+    global HEARTBEAT_TIMEOUT
+    global DIAL_BACKOFF
+    global DIAL_BACKOFF_MAX
+    global REBALANCER
+    global REBALANCE_INTERVAL
+    global REBALANCE_GRACE
+    global REBALANCE_CONCURRENCY
+    global REBALANCE_BANDWIDTH
+    global REBALANCE_SKEW
+    global PLACEMENT
+    global PLACER
+    global RING_VNODES
+    global METRICS
+    global STATS_FILE
+    global STATS_INTERVAL
 
     global HOST
     global PORT
@@ -11,10 +76,125 @@ def init():
 
     CONFIG_FILE = 'config.txt'
     FILES_FILE = 'files.txt'
+    JOURNAL_FILE = 'files.journal'
     SERVERS = {}
     CONNECTIONS = {}
     FILES = {}
 
+    #change log of local mutations sent to the other servers
+    CHANGELOG_SIZE = 10000
+    CHANGES = deque(maxlen=CHANGELOG_SIZE)
+    SEQ = 0
+    EPOCH = 0
+    #last change applied from every other server: {server: (epoch, seq)}
+    APPLIED = {}
+    #names deleted or renamed away, not taken back from another server
+    REMOVED = deque(maxlen=CHANGELOG_SIZE)
+
+    #journal of FS mutations, files.txt holds the last snapshot
+    JOURNAL = None
+    FSYNC = 'interval'
+    FSYNC_INTERVAL = 1.0
+    GROUP_COMMIT = 0.002
+    SNAPSHOT_EVERY = 10000
+
+    #files and bytes stored on every node: {node: {'Files': n, 'Bytes': n}}
+    LOAD = {}
+    BYTES_PER_FILE = 1048576
+    #free name allocation for new entries
+    NAMES = None
+
+    #per name locks and the pool running file transfers
+    LOCKS = None
+    WORKERS = None
+    WORKERS_SIZE = 16
+    #chunks of a streamed file buffered before the reader waits
+    TRANSFER_QUEUE = 8
+    #codec used to send messages, binary or dill
+    CODEC = 'binary'
+    #dill frames are decoded, turned off once every node sends binary
+    ACCEPT_DILL = True
+
+    #limits on the messages and bytes a connection buffers
+    MSG_QUEUE = 64
+    WRITE_QUEUE = 256
+    WRITE_BATCH = 64
+    HIGH_WATER = 1048576
+    LOW_WATER = 262144
+
+    #thread pool for disk I/O
+    DISK = None
+    IO_THREADS = 8
+
+    #changes to peers are sent together every window (seconds)
+    #or once BROADCAST_MAX are waiting
+    BROADCAST = None
+    BROADCAST_WINDOW = 0.005
+    BROADCAST_MAX = 256
+
+    #content addressed store of file bodies
+    STORE = None
+    CHUNKS_DIR = 'chunks'
+
+    #memory for file contents read by GIVEFILE
+    CACHE = None
+    CACHE_BYTES = 67108864
+
+    #reads of files not on this server go to a replica picked by
+    #'load' or 'latency'. With READ_PROXY the file is streamed through
+    #this server instead of sending the client to the replica
+    READ_ROUTING = 'load'
+    READ_PROXY = False
+    #measured round trip time to every server in seconds
+    RTT = {}
+    #connections to other servers to read files through
+    PEER_CLIENTS = {}
+
+    #a write is answered once the write concern is met: 'async',
+    #'one' replica or 'majority' of the copies
+    REPLICATOR = None
+    WRITE_CONCERN = 'async'
+    ACK_TIMEOUT = 10.0
+    ACK_RETRIES = 3
+    #replicas that did not ACK the latest version: {name: set of nodes}
+    LAGGING = {}
+
+    #hash tree of the FS compared with other servers on connect
+    DIGEST = None
+    DIGEST_BUCKETS = 65536
+
+    #dials the other servers and sends them heartbeats (seconds), a
+    #server not heard from for HEARTBEAT_TIMEOUT is taken as down
+    PEERS = None
+    HEARTBEAT_INTERVAL = 1.0
+    HEARTBEAT_TIMEOUT = 5.0
+    DIAL_BACKOFF = 0.5
+    DIAL_BACKOFF_MAX = 30.0
+
+    #copies files to restore their number of copies and to even out
+    #the load of the servers. A server down for REBALANCE_GRACE seconds
+    #no longer counts as a copy. Copies are limited to
+    #REBALANCE_CONCURRENCY at once and REBALANCE_BANDWIDTH bytes a second
+    REBALANCER = None
+    REBALANCE_INTERVAL = 30.0
+    REBALANCE_GRACE = 60.0
+    REBALANCE_CONCURRENCY = 2
+    REBALANCE_BANDWIDTH = 10485760
+    REBALANCE_SKEW = 0.2
+
+    #where new files go: 'load' for the least loaded servers, 'ring'
+    #for consistent hashing with RING_VNODES points per server (times
+    #its 'weight' in the config)
+    PLACEMENT = 'load'
+    PLACER = None
+    RING_VNODES = 64
+
+    #time taken by every command, sent back by STATS. With STATS_FILE
+    #the stats are also written to it every STATS_INTERVAL seconds
+    METRICS = None
+    STATS_FILE = None
+    STATS_INTERVAL = 10.0
+
     HOST = ''
     PORT = 0
     ROOT = ''